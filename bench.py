@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for cargozhip on a generated asset tree.
+#
+# The tree is generated from a seed so the same parameters give the same tree on every run, and
+# the phases walk, match, scan, compress (per format), copy and decompress (per format) are timed
+# separately. The results are written as json which can be given to a later run with --compare
+# to see the changes between two commits.
+#
+import argparse, json, logging, math, os, platform, random, shutil, subprocess, sys, time
+from cargozhipsrc import cz, cz_api
+from cargozhipsrc.log import inf, set_log_colors, logger as log
+
+BENCHOUTPUT = 'benchoutput'
+EXTENSIONS = ['.txt', '.json', '.h', '.a', '.bin', '.png', '.ogg']
+WORDS = [b'cargo', b'zhip', b'asset', b'texture', b'mesh', b'sound', b'level', b'shader', b'0', b'1', b'{', b'}']
+
+
+def generate_tree(root, files, depth, fanout, min_size, max_size, random_fraction, symlink_density, seed):
+    """
+    Generate 'files' files spread over a directory tree 'depth' levels deep with 'fanout' subdirectories
+    per directory. File sizes are log uniform between min_size and max_size, a 'random_fraction' of the
+    files are incompressible and a 'symlink_density' fraction gets a symlink pointing to it.
+    :return: the tree statistics
+    """
+    rng = random.Random(seed)
+    directories = ['']
+    level = ['']
+    for d in range(depth):
+        level = [os.path.join(parent, f'dir_{d}_{i}') for parent in level for i in range(fanout)]
+        directories += level
+    for directory in directories:
+        os.makedirs(os.path.join(root, directory), exist_ok=True)
+
+    # compressible content is cut from a block of words
+    text = b' '.join(rng.choice(WORDS) for _ in range(64 * 1024))
+    nof_bytes = 0
+    symlinks = 0
+    for n in range(files):
+        directory = rng.choice(directories)
+        name = f'file_{n}{rng.choice(EXTENSIONS)}'
+        size = int(math.exp(rng.uniform(math.log(min_size), math.log(max_size))))
+        if rng.random() < random_fraction:
+            data = rng.randbytes(size)
+        else:
+            offset = rng.randrange(len(text))
+            data = (text[offset:] + text * (size // len(text) + 1))[:size]
+        with open(os.path.join(root, directory, name), 'wb') as f:
+            f.write(data)
+        nof_bytes += size
+        if rng.random() < symlink_density:
+            os.symlink(name, os.path.join(root, directory, f'link_{n}'))
+            symlinks += 1
+
+    return {'files': files, 'directories': len(directories), 'bytes': nof_bytes, 'symlinks': symlinks}
+
+
+def generate_config(rules):
+    """
+    A configuration with a 'bench' section including everything with 'rules' rules in total. The
+    exclude rules are a mix of globs and regexes that hardly match, so the rules cost time to
+    evaluate without changing the archive much.
+    """
+    exclude_files = []
+    exclude_dirs = []
+    for i in range(max(rules - 1, 0)):
+        if i % 2:
+            exclude_dirs.append(f'**/nomatch_dir_{i}' if i % 4 == 1 else f'!nomatch_dir_{i}$')
+        else:
+            exclude_files.append(f'**/*.nomatch_{i}' if i % 4 == 0 else f'!nomatch_file_{i}$')
+    return {
+        'config': {'compression': 'zip'},
+        'bench': {
+            'include_files': ['**'],
+            'exclude_files': exclude_files,
+            'exclude_dirs': exclude_dirs
+        }
+    }
+
+
+def walk_tree(root):
+    """
+    List the whole tree as the scan does it, without matching and pruning.
+    :return: (name, is_dir, DirEntry) for everything found
+    """
+    entries = []
+    pending = ['']
+    while pending:
+        directory = pending.pop()
+        listing = cz.list_directory(root, directory)
+        if not listing:
+            continue
+        dirs, files = listing
+        for entry in dirs:
+            entries.append((os.path.join(directory, entry.name), True, entry))
+        entries += [(fqn, False, entry) for fqn, entry in cz.existing_files(directory, files)]
+        pending.extend(os.path.join(directory, entry.name) for entry in reversed(dirs))
+    return entries
+
+
+def timed(function, repeat, prepare=None):
+    """
+    Run function 'repeat' times, calling prepare (untimed) before each run.
+    :return: ({'best': fastest, 'runs': [all]}, the result of the last run)
+    """
+    runs = []
+    result = None
+    for _ in range(repeat):
+        if prepare:
+            prepare()
+        start = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - start)
+    return {'best': min(runs), 'runs': runs}, result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """
+    Generate the tree and time the phases.
+    :return: the results as a dictionary
+    """
+    work = args.workdir
+    tree = os.path.join(work, 'tree')
+    shutil.rmtree(work, ignore_errors=True)
+    os.makedirs(work)
+
+    inf(f'Generating {args.files} files in {tree}')
+    tree_stats = generate_tree(tree, args.files, args.depth, args.fanout, args.min_size, args.max_size,
+                               args.random_fraction, args.symlink_density, args.seed)
+    config = generate_config(args.rules)
+    filters = cz.parse_section(config, 'bench')
+    phases = {}
+
+    # the benchmarked code logs as usual, only warnings are let through
+    level = log.level
+    log.setLevel(logging.WARNING)
+    try:
+        phases['walk'], entries = timed(lambda: walk_tree(tree), args.repeat)
+        phases['match'], _ = timed(lambda: [cz.match_entry(filters, *entry) for entry in entries], args.repeat)
+        phases['scan'], scan_result = timed(lambda: cz.find_files(tree, filters, args.scan_workers), args.repeat)
+
+        for compression in args.formats.split(','):
+            compress_method, extension = cz_api.compression_method(compression)
+            archive = os.path.join(work, 'archive' + extension)
+            destination = os.path.join(work, 'decompressed')
+            phases[f'compress_{compression}'], _ = timed(
+                lambda: cz_api.write_archive(tree, scan_result, archive, compress_method, args.compress_workers),
+                args.repeat)
+            phases[f'compress_{compression}']['bytes'] = os.path.getsize(archive)
+            phases[f'decompress_{compression}'], _ = timed(
+                lambda: cz_api.decompress(archive, destination, workers=args.compress_workers), args.repeat,
+                lambda: shutil.rmtree(destination, ignore_errors=True))
+
+        destination = os.path.join(work, 'copy')
+        phases['copy'], _ = timed(lambda: cz_api.copy(tree, config, 'bench', destination,
+                                                      scan_workers=args.scan_workers),
+                                  args.repeat, lambda: shutil.rmtree(destination, ignore_errors=True))
+    finally:
+        log.setLevel(level)
+
+    if not args.keep:
+        shutil.rmtree(work, ignore_errors=True)
+
+    return {
+        'version': 1,
+        'commit': git_commit(),
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'compare', 'keep', 'workdir')},
+        'tree': dict(tree_stats, matched=scan_result.nof_files),
+        'phases': phases
+    }
+
+
+def compare(previous, results):
+    """
+    Log the best time of each phase next to the previous results.
+    """
+    if previous['parameters'] != results['parameters']:
+        inf('Note: the previous results were made with other parameters')
+    inf(f'{"phase":<24}{"previous":>12}{"now":>12}{"ratio":>10}')
+    for phase, timing in results['phases'].items():
+        if phase in previous['phases']:
+            before = previous['phases'][phase]['best']
+            ratio = timing['best'] / before if before else float('inf')
+            inf(f'{phase:<24}{before:>12.4f}{timing["best"]:>12.4f}{ratio:>10.2f}')
+        else:
+            inf(f'{phase:<24}{"":>12}{timing["best"]:>12.4f}')
+
+
+def main():
+    parser = argparse.ArgumentParser('bench', description='Benchmark cargozhip on a generated asset tree.')
+    parser.add_argument('--files', type=int, default=2000, help='number of files, default 2000')
+    parser.add_argument('--depth', type=int, default=3, help='directory levels, default 3')
+    parser.add_argument('--fanout', type=int, default=4, help='subdirectories per directory, default 4')
+    parser.add_argument('--min-size', type=int, default=100, help='smallest file size, default 100')
+    parser.add_argument('--max-size', type=int, default=200000, help='largest file size, default 200000')
+    parser.add_argument('--random-fraction', type=float, default=0.2,
+                        help='fraction of files with incompressible content, default 0.2')
+    parser.add_argument('--symlink-density', type=float, default=0.05,
+                        help='fraction of files with a symlink pointing to it, default 0.05')
+    parser.add_argument('--rules', type=int, default=20, help='number of rules in the section, default 20')
+    parser.add_argument('--formats', default='zip,lzma,tar.gz',
+                        help='comma separated compressions to time, default zip,lzma,tar.gz')
+    parser.add_argument('--scan-workers', type=int, default=1, metavar='N', help='scan threads, default 1')
+    parser.add_argument('--compress-workers', type=int, default=1, metavar='N',
+                        help='compress and decompress threads, default 1')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per phase, the best is reported. Default 3')
+    parser.add_argument('--seed', type=int, default=1, help='seed for the tree generator, default 1')
+    parser.add_argument('--workdir', default=BENCHOUTPUT, help=f'where the tree is generated, default {BENCHOUTPUT}')
+    parser.add_argument('--keep', action='store_true', help='keep the generated tree and archives')
+    parser.add_argument('--output', help='write the results as json to this file')
+    parser.add_argument('--compare', metavar='JSON', help='results from a previous run to compare with')
+    args = parser.parse_args()
+
+    set_log_colors()
+    log.setLevel(logging.INFO)
+
+    results = run(args)
+
+    for phase, timing in results['phases'].items():
+        inf(f'{phase:<24}{timing["best"]:>10.4f} secs')
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        inf(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-import argparse, logging, os, traceback
+import argparse, logging, os, sys, traceback
 
 # In case this script is separated from the default source folder
 # then one option is to specify where to find the 'cargozhipsrc' folder here:
@@ -8,7 +8,10 @@ import argparse, logging, os, traceback
 
 from cargozhipsrc import cz
 from cargozhipsrc import cz_api
-from cargozhipsrc.log import err, set_log_colors, logger as log
+from cargozhipsrc import cz_profile
+from cargozhipsrc import cz_copy
+from cargozhipsrc import cz_member_cache
+from cargozhipsrc.log import err, set_log_colors, logger as log, handler
 
 set_log_colors()
 
@@ -23,21 +26,62 @@ parser.add_argument('--copy', metavar='source',
                     help='Operation: implies that only the copy part is executed with files copied to destination and left there. '
                          'The actual compression part is skipped. Requires --destination')
 
+parser.add_argument('--profile', metavar='source',
+                    help='Operation: scan the source directory and report the evaluations, hits and time of each '
+                         'rule in the section, and the rules that are dead, shadowed or duplicated')
+
 parser.add_argument('--archive',
                     help='archive name without extension. Default name is the project source directory name '
-                         'and default location is current directory. Used for --compress and --decompress')
+                         'and default location is current directory. Used for --compress and --decompress. '
+                         'With --compress "-" writes the archive to stdout')
 
 parser.add_argument('--destination',
                     help='the destination path for the --copy command')
 
 parser.add_argument('--section',
-                    help='the package configuration section name to use')
+                    help='the package configuration section name to use. For --compress a comma separated list of '
+                         'sections makes an archive per section, named <archive>_<section>, from a single scan')
 parser.add_argument('--config',
                     help=f'the cargozhipsrc configuration file to load. Default ./{cz.default_config}')
 parser.add_argument('--dryrun', action='store_true',
                     help='don\'t actually make the archive')
 parser.add_argument('--compression',
                     help='overrule compressor listed in configuration [lzma|bz2|zip|tar.gz|tar.bz2|tar.xz]')
+parser.add_argument('--scan-workers', type=int, default=1, metavar='N',
+                    help='number of threads listing and matching the source directory tree, default 1')
+parser.add_argument('--scan-cache', metavar='FILE',
+                    help='file keeping the directory listings and match results between scans so unchanged '
+                         'directories are not scanned again')
+parser.add_argument('--compress-workers', type=int, metavar='N',
+                    help='number of threads compressing zip, bz2 and lzma archive members or tar.gz, tar.bz2 and '
+                         'tar.xz blocks. Overrules "compress_workers" in the configuration, default 1')
+parser.add_argument('--decompress-workers', type=int, default=1, metavar='N',
+                    help='number of threads decompressing zip, bz2 and lzma archive members, default 1')
+parser.add_argument('--copy-workers', type=int, default=1, metavar='N',
+                    help='number of threads copying files for --copy, default 1')
+parser.add_argument('--copy-strategy', default='auto', choices=cz_copy.STRATEGIES,
+                    help='how --copy copies files: reflink (copy on write), hardlink, range (os.copy_file_range) '
+                         'or a plain copy, each falling back to the next when not supported. auto is reflink '
+                         'falling back to range and copy, the default')
+parser.add_argument('--incremental', action='store_true',
+                    help='update an existing zip, bz2 or lzma archive by only compressing new and changed files. '
+                         'The archive is the same as a full rebuild')
+parser.add_argument('--member-cache', metavar='DIR',
+                    help='directory keeping the compressed zip, bz2 and lzma members between runs so files with the '
+                         'same content are not compressed again. The archive is the same as without it')
+parser.add_argument('--member-cache-size', type=int, metavar='MB',
+                    help=f'trim the --member-cache to MB megabytes after each run, least recently used first, '
+                         f'default {cz_member_cache.DEFAULT_SIZE // (1024 * 1024)}')
+parser.add_argument('--pipeline', action='store_true',
+                    help='write the archive while the source tree is scanned instead of after it. The members are '
+                         'stored per directory in name order and --scan-workers is not used')
+parser.add_argument('--trace', metavar='FILE',
+                    help='write the scan decision for each file, the rule including it and the rule excluding it, '
+                         'and each pruned directory as json to FILE')
+parser.add_argument('--stats', metavar='FILE',
+                    help='write the timings and counters of --compress, --decompress or --copy as json to FILE')
+parser.add_argument('--profile-sort', default='time', choices=cz_profile.SORT_KEYS,
+                    help='the order of the --profile report, default time')
 parser.add_argument('--quiet', action='store_true',
                     help='no logging, default is informational logging')
 parser.add_argument('--force', action='store_true',
@@ -61,22 +105,51 @@ try:
             config_file = os.path.join(args.compress, cz.default_config)
         else:
             config_file = os.path.abspath(args.config)
-        cz_api.compress(args.compress, config_file, args.section, args.archive, args.dryrun, args.compression)
+        if args.archive == '-':
+            # the archive goes to stdout so the logging goes to stderr
+            handler.setStream(sys.stderr)
+            args.archive = sys.stdout.buffer
+        member_cache_size = args.member_cache_size * 1024 * 1024 if args.member_cache_size is not None else None
+        if args.section and ',' in args.section:
+            if args.pipeline or args.scan_cache:
+                err('--pipeline and --scan-cache work on a single --section')
+            stats = cz_api.compress_sections(args.compress, config_file, args.section.split(','), args.archive,
+                                             args.dryrun, args.compression, args.scan_workers, args.compress_workers,
+                                             args.incremental, args.trace, args.member_cache, member_cache_size)
+        else:
+            stats = cz_api.compress(args.compress, config_file, args.section, args.archive, args.dryrun,
+                                    args.compression, args.scan_workers, args.compress_workers, args.incremental,
+                                    args.scan_cache, args.trace, args.pipeline, args.member_cache,
+                                    member_cache_size)
     elif args.decompress:
-        cz_api.decompress(args.archive, args.decompress, args.force)
+        stats = cz_api.decompress(args.archive, args.decompress, args.force, args.decompress_workers)
     elif args.copy:
         if not args.config:
             config_file = os.path.join(args.copy, cz.default_config)
         else:
             config_file = os.path.abspath(args.config)
-        cz_api.copy(args.copy, config_file, args.section, args.destination)
+        stats = cz_api.copy(args.copy, config_file, args.section, args.destination, scan_workers=args.scan_workers,
+                            scan_cache=args.scan_cache, trace_file=args.trace, copy_workers=args.copy_workers,
+                            strategy=args.copy_strategy)
+    elif args.profile:
+        if args.stats:
+            err('--stats is not written by --profile, its table is the statistics')
+        if not args.config:
+            config_file = os.path.join(args.profile, cz.default_config)
+        else:
+            config_file = os.path.abspath(args.config)
+        cz_api.profile_rules(args.profile, config_file, args.section, args.profile_sort, args.scan_workers)
     else:
-        err('Need an --compress, --decompress or --copy argument')
+        err('Need an --compress, --decompress, --copy or --profile argument')
+
+    if args.stats:
+        stats.save(args.stats)
 
 except Exception as e:
-    print(f'Terminated with exception: \'{e.__str__()}\'')
+    # stderr since stdout can be the archive
+    print(f'Terminated with exception: \'{e.__str__()}\'', file=sys.stderr)
     if args.verbose:
-        print(traceback.format_exc())
+        print(traceback.format_exc(), file=sys.stderr)
     exit(1)
 
 exit(0)
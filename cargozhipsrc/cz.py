@@ -1,10 +1,58 @@
 #!/usr/bin/env python3
-import os, re
+import os, re, stat, time, array, collections, queue, threading, concurrent.futures
 from wcmatch import glob as wcg
-from .log import deb, inf, war, Indent, Unindent, WHITEBOLD, YELLOW, LIGHT_BLUE, GREEN, RESET
+from .cz_stats import Stats
+from .log import deb, inf, war, debug_enabled, WHITEBOLD, RESET
 
 default_config = 'cargozhip.json'
-depth = 0
+# directories the walk of a pipelined scan can be ahead of the archive writer
+PIPELINE_QUEUE = 64
+
+
+class Matcher:
+    """
+    An ordered list of wcmatch globs and '!' prefixed regexes compiled once into as few regular
+    expressions as possible. Consecutive rules are merged into a single alternation with a named
+    group per rule so a single call finds the first matching rule in the original order.
+    Regexes that can't be merged (capture groups, global inline flags) get a chunk of their own.
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.chunks = []
+
+        merged = []
+        for index, pattern in enumerate(patterns):
+            if pattern.startswith('!'):
+                regex = re.compile(pattern[1:])
+                if regex.groups or regex.flags & ~re.UNICODE:
+                    self._add_merged(merged)
+                    merged = []
+                    self.chunks.append((regex.search, index))
+                    continue
+                # regexes are used with search semantics so allow anything before and after
+                merged.append((index, f'(?s:.*?)(?:{pattern[1:]})(?s:.*)'))
+            else:
+                include, _exclude = wcg.translate(pattern, flags=wcg.GLOBSTAR)
+                merged.append((index, '|'.join(include)))
+        self._add_merged(merged)
+
+    def _add_merged(self, merged):
+        if not merged:
+            return
+        regex = re.compile('|'.join(f'(?P<r{index}>{source})' for index, source in merged))
+        self.chunks.append((regex.fullmatch, None))
+
+    def match(self, name):
+        """
+        Return the index of the first rule matching name or None.
+        """
+        for match, index in self.chunks:
+            hit = match(name)
+            if hit:
+                if index is None:
+                    return int(hit.lastgroup[1:])
+                return index
+        return None
 
 
 class Filters:
@@ -13,57 +61,501 @@ class Filters:
         self.include_dirs = []
         self.exclude_files = []
         self.exclude_dirs = []
+        # the section each rule came from and the (kind, rule, section, first section) of dropped duplicates
+        self.sections = {'include_files': [], 'include_dirs': [], 'exclude_files': [], 'exclude_dirs': []}
+        self.duplicates = []
+
+    def add(self, kind, rule, section):
+        """
+        Append a rule from section to the 'kind' rules ('include_files', ...). A rule already added,
+        e.g. by a section inherited through two chains, can never be the first to match again so it
+        is left out and recorded in duplicates.
+        """
+        rules = getattr(self, kind)
+        if rule in rules:
+            self.duplicates.append((kind, rule, section, self.sections[kind][rules.index(rule)]))
+            deb(f'dropping duplicated {kind} rule "{rule}" from section "{section}"')
+            return
+        rules.append(rule)
+        self.sections[kind].append(section)
+
+    def compile(self):
+        """
+        Translate and merge the rules collected by parse_section into the matchers used by find_files.
+        """
+        self.include_files_matcher = Matcher([pattern for _dest, pattern in self.include_files])
+        self.include_dirs_matcher = Matcher(self.include_dirs)
+        self.exclude_files_matcher = Matcher(self.exclude_files)
+        self.exclude_dirs_matcher = Matcher(self.exclude_dirs)
+        # glob exclude_dirs are also tried against the parent directory, regexes are not.
+        self.exclude_parent_dirs_matcher = Matcher([rule for rule in self.exclude_dirs if not rule.startswith('!')])
+        self.pruner = SubtreePruner(self)
+        return self
+
+    def include_file(self, name):
+        """
+        :return: the (dest, name, pattern_length) hit for the first include_files rule matching name or None.
+        """
+        index = self.include_files_matcher.match(name)
+        if index is None:
+            return None
+        dest, pattern = self.include_files[index]
+        if pattern.startswith('!'):
+            return (dest, name, 0)
+        # for now support for @@@ operator works for .../** format only.
+        return (dest, name, len(os.path.commonprefix([name, pattern])))
+
+    def directory_verdict(self, directory):
+        """
+        The include_dirs and exclude_dirs rules only depend on the directory of a file, so the scan looks
+        them up once per directory rather than once per file.
+        :return: (index of the first include_dirs rule matching directory, exclude_dir_rule(directory)),
+                 either is None if no rule matched.
+        """
+        return self.include_dirs_matcher.match(directory), self.exclude_dir_rule(directory)
+
+    def include_dir(self, index, name):
+        """
+        :return: the (None, name, pattern_length) hit for name in a directory matched by the include_dirs rule 'index'.
+        """
+        include_dir = self.include_dirs[index]
+        if include_dir.startswith('!'):
+            return (None, name, 0)
+        return (None, name, len(os.path.commonprefix([name, include_dir])))
+
+    def exclude_dir_rule(self, directory):
+        """
+        :return: the index of the first exclude_dirs rule matching directory or its parent or None.
+        """
+        index = self.exclude_dirs_matcher.match(directory)
+        if index is None:
+            index = self.exclude_parent_dirs_matcher.match(os.path.dirname(directory))
+            if index is None:
+                return None
+            return self.exclude_dirs.index(self.exclude_parent_dirs_matcher.patterns[index])
+        return index
+
+    def exclude_dir(self, directory):
+        return self.exclude_dir_rule(directory) is not None
+
+    def exclude_file(self, name):
+        return self.exclude_files_matcher.match(name) is not None
+
+    def explain(self, name):
+        """
+        The match_entry() decision for name spelled out, for cz_trace.Trace.
+        :return: (kind, rule index) for the rule including name and for the rule excluding it, None if there is none.
+        """
+        directory = os.path.dirname(name)
+        included = None
+        index = self.include_files_matcher.match(name)
+        if index is not None:
+            included = ('include_files', index)
+        else:
+            index = self.include_dirs_matcher.match(directory)
+            if index is not None:
+                included = ('include_dirs', index)
+        if not included:
+            return None, None
+
+        index = self.exclude_dir_rule(directory)
+        if index is not None:
+            return included, ('exclude_dirs', index)
+        index = self.exclude_files_matcher.match(name)
+        if index is not None:
+            return included, ('exclude_files', index)
+        return included, None
+
+
+# Abstract path components used by SubtreePruner for names not yet seen in a walk.
+# A generic name is assumed to differ from every literal found in the rules.
+GENERIC_VISIBLE = 0
+GENERIC_HIDDEN = 1
+
+# regex constructs that could stop a match on a directory from also matching everything below it
+_NOT_PREFIX_STABLE = ('$', '\\Z', '\\b', '\\B', '(?=', '(?!')
+
+
+def _visible(component):
+    if component == GENERIC_VISIBLE:
+        return True
+    if component == GENERIC_HIDDEN:
+        return False
+    return not component.startswith('.')
+
+
+def glob_segments(pattern):
+    """
+    Split a glob into one matcher per path component. Returns None for patterns that are too
+    exotic for the directory level analysis in SubtreePruner.
+    """
+    if not pattern or pattern.startswith(('/', '!')) or pattern.endswith('/') or '\\' in pattern:
+        return None
+    segments = pattern.split('/')
+    result = []
+    for index, segment in enumerate(segments):
+        if segment in ('', '.', '..') or segment.count('[') != segment.count(']'):
+            return None
+        if segment == '**':
+            if result and result[-1][0] == '**':
+                return None
+            if index and index == len(segments) - 1:
+                # a trailing globstar needs at least one (visible) component
+                result.append(('any', None))
+            result.append(('**', None))
+        elif any(c in segment for c in '*?['):
+            include, _exclude = wcg.translate(segment, flags=wcg.GLOBSTAR)
+            result.append((segment, re.compile('|'.join(include)).fullmatch))
+        else:
+            result.append(('literal', segment))
+    return result
+
+
+class SubtreePruner:
+    """
+    Decides at directory level if anything below a directory can end up in the scan result, so the
+    walk can skip it. Each glob is run as a small automaton over path components. Directories not yet
+    seen are explored symbolically, optimistic towards inclusion and pessimistic towards exclusion,
+    so a subtree is only pruned when find_files could never have added anything from it.
+    """
+    def __init__(self, filters):
+        self.include_files = [glob_segments(pattern) for _dest, pattern in filters.include_files]
+        self.include_dirs = [glob_segments(pattern) for pattern in filters.include_dirs]
+        self.exclude_dirs = [segments for segments in map(glob_segments, filters.exclude_dirs) if segments]
+        # regexes and unsupported globs could include anything
+        self.include_anything = None in self.include_files or None in self.include_dirs
+        self.exclude_regexes = Matcher([rule for rule in filters.exclude_dirs
+                                        if rule.startswith('!') and not any(t in rule for t in _NOT_PREFIX_STABLE)])
+
+        literals = set()
+        for segments in self.include_files + self.include_dirs:
+            for kind, value in segments or []:
+                if kind == 'literal':
+                    literals.add(value)
+        self.candidates = sorted(literals) + [GENERIC_VISIBLE, GENERIC_HIDDEN]
+        self.alive_cache = {}
+        self.root = (self._start(self.include_files), self._start(self.include_dirs),
+                     self._start(self.exclude_dirs), False)
+        self.targets = self._targets()
+
+    def _targets(self):
+        """
+        The literal paths the include rules start with, so the scan can go straight to them rather
+        than walk the tree from the root. An include_files rule without wildcards is an exact file,
+        any other rule is a directory to walk, its leading literal components.
+        :return: (exact files, directories) as sorted tuples of path components, or None if a rule
+                 can match at the root level (e.g. '*.txt', '**/lib' or a regex) and the whole tree is walked.
+        """
+        if self.include_anything:
+            return None
+        files = set()
+        dirs = set()
+        for segments, is_file in [(segments, True) for segments in self.include_files] + \
+                                 [(segments, False) for segments in self.include_dirs]:
+            literals = []
+            for kind, value in segments:
+                if kind != 'literal':
+                    break
+                literals.append(value)
+            if is_file and len(literals) == len(segments):
+                files.add(tuple(literals))
+            elif literals:
+                dirs.add(tuple(literals))
+            else:
+                return None
+        # a directory below another directory is walked anyway
+        dirs = [path for path in sorted(dirs) if not any(path[:length] in dirs for length in range(1, len(path)))]
+        return sorted(files), dirs
+
+    def _start(self, patterns):
+        return frozenset(state for index, segments in enumerate(patterns) if segments
+                         for state in self._closure(segments, index, 0))
+
+    @staticmethod
+    def _closure(segments, index, position):
+        states = [(index, position)]
+        while position < len(segments) and segments[position][0] == '**':
+            position += 1
+            states.append((index, position))
+        return states
+
+    @staticmethod
+    def _segment_match(kind, value, component, exclude):
+        if kind == 'any':
+            return _visible(component)
+        if kind == 'literal':
+            return component == value
+        if isinstance(component, str):
+            return bool(value(component))
+        # a generic name matches any wildcard when looking for inclusion, only '*' when excluding
+        return not exclude or (kind == '*' and component == GENERIC_VISIBLE)
+
+    def _advance(self, patterns, states, component, exclude=False):
+        result = set()
+        for index, position in states:
+            segments = patterns[index]
+            if position == len(segments):
+                continue
+            kind, value = segments[position]
+            if kind == '**':
+                if _visible(component):
+                    result.update(self._closure(segments, index, position))
+            elif self._segment_match(kind, value, component, exclude):
+                result.update(self._closure(segments, index, position + 1))
+        return frozenset(result)
+
+    @staticmethod
+    def _accepts(patterns, states):
+        return any(position == len(patterns[index]) for index, position in states)
+
+    def step(self, state, component):
+        """
+        The state of the subdirectory 'component' in the directory with the given state.
+        """
+        include_files, include_dirs, exclude_dirs, _parent_excluded = state
+        return (self._advance(self.include_files, include_files, component),
+                self._advance(self.include_dirs, include_dirs, component),
+                self._advance(self.exclude_dirs, exclude_dirs, component, exclude=True),
+                self._accepts(self.exclude_dirs, exclude_dirs))
+
+    def _files_may_match(self, state):
+        include_files, include_dirs, exclude_dirs, parent_excluded = state
+        if parent_excluded or self._accepts(self.exclude_dirs, exclude_dirs):
+            return False
+        if self._accepts(self.include_dirs, include_dirs):
+            return True
+        return any(self._accepts(self.include_files, self._advance(self.include_files, include_files, name))
+                   for name in self.candidates)
+
+    def alive(self, state):
+        """
+        True if some file in or below the directory with the given state could be added.
+        """
+        if self.include_anything:
+            return True
+        alive = self.alive_cache.get(state)
+        if alive is None:
+            alive = False
+            visited = {state}
+            pending = [state]
+            while pending and not alive:
+                current = pending.pop()
+                alive = self._files_may_match(current)
+                for name in self.candidates:
+                    child = self.step(current, name)
+                    if child not in visited and (child[0] or child[1]):
+                        visited.add(child)
+                        pending.append(child)
+            self.alive_cache[state] = alive
+        return alive
+
+    def prune(self, directory, state):
+        """
+        :return: the reason for skipping the directory or None if it should be walked.
+        """
+        index = self.exclude_regexes.match(directory)
+        if index is not None:
+            return f'excluded by "{self.exclude_regexes.patterns[index]}"'
+        if not self.alive(state):
+            return 'no include rule can reach it'
+        return None
+
+
+# the lstat fields kept for each file in a ScanResult, all the writers need
+Lstat = collections.namedtuple('Lstat', 'st_mode st_ino st_dev st_nlink st_uid st_gid st_size st_mtime')
 
 
 class ScanResult:
-    def __init__(self):
+    """
+    The files found by a scan, kept compact for trees with millions of files. Directory paths and
+    destination keys are stored once in tables, and each file is an entry in a set of arrays with
+    its name, directory, key, pattern length and lstat fields. Paths, destinations and lstat
+    records are made on the fly while iterating.
+    """
+    def __init__(self, stats=None):
+        self.stats = stats or Stats()
         self.nof_files = 0
         self.pattern_length = 0
-        self.file_list = {}
+        self.directories = []
+        self.directory_index = {}
+        self.keys = []
+        self.key_index = {}
+        # one item per entry in each of these
+        self.names = []
+        self.entry_directory = array.array('I')
+        self.entry_key = array.array('I')
+        self.entry_pattern_length = array.array('I')
+        self.modes = array.array('I')
+        self.inodes = array.array('Q')
+        self.devices = array.array('Q')
+        self.nlinks = array.array('I')
+        self.uids = array.array('I')
+        self.gids = array.array('I')
+        self.sizes = array.array('q')
+        self.mtimes = array.array('d')
+        # the entries that are directories (symlinks to), the entry indices in sorted order when sorted
+        self.symlinked_dirs = set()
+        self.order = None
+        # entries by the hash of their normalized destination and, made when first needed, of their path
+        self.sources = {}
+        self.paths = None
+        self.collisions = []
+
+    @staticmethod
+    def destination(key, filename, pattern_length):
+        if key:
+            if key.startswith('@@@'):
+                return os.path.join(key[3:], filename[pattern_length:])
+            if key.startswith('@@'):
+                return os.path.join(key[2:], filename)
+            return os.path.join(key[1:], os.path.basename(filename))
+        return filename
 
-    def add(self, hit):
+    @staticmethod
+    def _intern(value, table, index):
+        position = index.get(value)
+        if position is None:
+            position = index[value] = len(table)
+            table.append(value)
+        return position
+
+    @staticmethod
+    def _insert(hashes, value, entry):
+        """
+        Add entry to the hash table 'hashes' under the hash of value, an entry or a list of entries.
+        """
+        key = hash(value)
+        existing = hashes.get(key)
+        if existing is None:
+            hashes[key] = entry
+        elif isinstance(existing, list):
+            existing.append(entry)
+        else:
+            hashes[key] = [existing, entry]
+
+    @staticmethod
+    def _lookup(hashes, value, valued):
+        """
+        :return: the entry in the hash table 'hashes' with valued(entry) == value or None.
+        """
+        existing = hashes.get(hash(value))
+        for entry in existing if isinstance(existing, list) else () if existing is None else (existing,):
+            if valued(entry) == value:
+                return entry
+        return None
+
+    def add(self, hit, lstat, is_dir=False):
         key, filename, pattern_length = hit
-        if not self.file_list.get(key):
-            self.file_list[key] = []
-        self.file_list[key].append(filename)
+        entry = len(self.names)
+        directory, name = os.path.split(filename)
+        self.names.append(name)
+        self.entry_directory.append(self._intern(directory, self.directories, self.directory_index))
+        self.entry_key.append(self._intern(key, self.keys, self.key_index))
+        self.entry_pattern_length.append(pattern_length)
+        self.modes.append(lstat.st_mode)
+        self.inodes.append(lstat.st_ino)
+        self.devices.append(lstat.st_dev)
+        self.nlinks.append(lstat.st_nlink)
+        self.uids.append(lstat.st_uid)
+        self.gids.append(lstat.st_gid)
+        self.sizes.append(lstat.st_size)
+        self.mtimes.append(lstat.st_mtime)
+        if is_dir:
+            self.symlinked_dirs.add(entry)
         self.nof_files += 1
         self.pattern_length = pattern_length
+        self.order = None
+        if self.paths is not None:
+            self._insert(self.paths, filename, entry)
+
+        dest = self.destination(key, filename, pattern_length)
+        normalized = os.path.normpath(dest)
+        first = self._lookup(self.sources, normalized, self._normalized_destination)
+        if first is None:
+            self._insert(self.sources, normalized, entry)
+        else:
+            self.collisions.append((dest, self.path(first), filename))
+
+    def path(self, entry):
+        """
+        :return: the path of the file 'entry' relative to the root.
+        """
+        return os.path.join(self.directories[self.entry_directory[entry]], self.names[entry])
+
+    def entry_destination(self, entry):
+        return self.destination(self.keys[self.entry_key[entry]], self.path(entry), self.entry_pattern_length[entry])
+
+    def _normalized_destination(self, entry):
+        return os.path.normpath(self.entry_destination(entry))
+
+    def entry_lstat(self, entry):
+        return Lstat(self.modes[entry], self.inodes[entry], self.devices[entry], self.nlinks[entry],
+                     self.uids[entry], self.gids[entry], self.sizes[entry], self.mtimes[entry])
+
+    def _entry(self, filename):
+        if self.paths is None:
+            self.paths = {}
+            for entry in range(len(self.names)):
+                self._insert(self.paths, self.path(entry), entry)
+        entry = self._lookup(self.paths, filename, self.path)
+        if entry is None:
+            raise KeyError(filename)
+        return entry
+
+    def lstat(self, filename):
+        return self.entry_lstat(self._entry(filename))
+
+    def is_symlink(self, filename):
+        return stat.S_ISLNK(self.modes[self._entry(filename)])
+
+    def is_dir(self, filename):
+        """
+        True for directories (symlinks to), the only kind of directories found in a scan result.
+        """
+        return self._entry(filename) in self.symlinked_dirs
 
     def sort(self):
-        for key in self.file_list.keys():
-            self.file_list[key] = sorted(self.file_list[key])
+        # order the destinations as well, the None (as is) destination first
+        ranks = {position: rank for rank, position in
+                 enumerate(sorted(range(len(self.keys)), key=lambda position: self.keys[position] or ''))}
+        self.order = array.array('I', sorted(range(len(self.names)),
+                                             key=lambda entry: (ranks[self.entry_key[entry]], self.path(entry))))
+
+    def sorted_entries(self):
+        if self.order is None:
+            self.sort()
+        return self.order
 
     def all_destinations(self):
-        result = []
-        for key, file_list in self.file_list.items():
-            for filename in file_list:
-                if key:
-                    if key.startswith('@@@'):
-                        fn = os.path.join(key[3:], filename[self.pattern_length:])
-                        result.append(fn)
-                    elif key.startswith('@@'):
-                        fn = os.path.join(key[2:], filename)
-                        result.append(fn)
-                    else:
-                        fn = os.path.join(key[1:], os.path.basename(filename))
-                        result.append(fn)
-                else:
-                    result.append(filename)
-        return result
+        return [dest for _src, dest in self.as_source_and_dest()]
 
     def as_source_and_dest(self):
-        sourcefiles = []
-        for file_list in self.file_list.values():
-            for filename in file_list:
-                sourcefiles.append(filename)
-        return zip(sourcefiles, self.all_destinations())
+        for entry in self.sorted_entries():
+            path = self.path(entry)
+            yield path, self.destination(self.keys[self.entry_key[entry]], path, self.entry_pattern_length[entry])
+
+    def entries(self):
+        """
+        Iterate the files as (path, destination, lstat, is_dir) so the writers don't look up each path.
+        """
+        for entry in self.sorted_entries():
+            path = self.path(entry)
+            yield (path, self.destination(self.keys[self.entry_key[entry]], path, self.entry_pattern_length[entry]),
+                   self.entry_lstat(entry), entry in self.symlinked_dirs)
 
     def target_file_exist(self, target):
-        target = os.path.normpath(target)
-        for _src, dest in self.as_source_and_dest():
-            if target == dest:
-                return True
-        return False
+        return self._lookup(self.sources, os.path.normpath(target), self._normalized_destination) is not None
+
+    def check_collisions(self):
+        """
+        Raise if two or more files ended up with the same destination.
+        """
+        for dest, first, second in self.collisions:
+            war(f'"{first}" and "{second}" both end up as "{dest}"')
+        if self.collisions:
+            dest, first, second = self.collisions[0]
+            raise Exception(f'Name collision, {len(self.collisions)} file(s) end up as an already used destination, '
+                            f'e.g. "{second}" as "{dest}"')
 
 
 def get_sections(configuration):
@@ -79,14 +571,14 @@ def get_sections(configuration):
     return sections
 
 
-def parse_section(config, section, filters=None):
+def parse_section(config, section, filters=None, depth=0):
     """
     Load the specified section and recursively load upstream sections if found listed in 'inherit'.
+    The returned filters are compiled and ready for find_files.
     """
-    global depth
-    if filters is None:
+    top_level = filters is None
+    if top_level:
         filters = Filters()
-        depth = 0
 
     # try to catch circular recursions before Python does.
     depth += 1
@@ -119,14 +611,17 @@ def parse_section(config, section, filters=None):
                         dest = entry
                         continue
 
-                    filters.include_files.append((dest, entry))
+                    filters.add('include_files', (dest, entry), section)
 
             elif key.startswith('include_dirs'):
-                filters.include_dirs += filterentry
+                for entry in filterentry:
+                    filters.add('include_dirs', entry, section)
             elif key.startswith('exclude_files'):
-                filters.exclude_files += filterentry
+                for entry in filterentry:
+                    filters.add('exclude_files', entry, section)
             elif key.startswith('exclude_dirs'):
-                filters.exclude_dirs += filterentry
+                for entry in filterentry:
+                    filters.add('exclude_dirs', entry, section)
         except IndexError:
             pass
 
@@ -134,145 +629,630 @@ def parse_section(config, section, filters=None):
         inherit_list = _section['inherit']
         for inherit_section in inherit_list:
             deb(f'adding inherited "{inherit_section}"')
-            parse_section(config, inherit_section, filters)
+            parse_section(config, inherit_section, filters, depth)
     except KeyError:
         pass
-    depth -= 1
+    if top_level:
+        filters.compile()
     return filters
 
 
-files_processed = 0
-dirs_processed = 0
-
+def list_directory(directory, root):
+    """
+    List the directory root below directory with os.scandir.
+    :return: lists of DirEntry for the (symlinked) directories and for the files, or None if the
+             directory couldn't be listed.
+    """
+    try:
+        with os.scandir(os.path.join(directory, root)) as scandir:
+            entries = list(scandir)
+    except OSError as e:
+        war(f'unable to scan "{root}" ({e})')
+        return None
 
-def file_scan(directory):
-    global files_processed, dirs_processed
-    for root, dirs, files in os.walk(directory, followlinks=True):
-        root = os.path.relpath(root, directory)
-        if root == '.':
-            root = ''
-        deb(f'{WHITEBOLD}scan: cwd:"{root}" dirs:"{dirs}" files:"{files}"{RESET}')
+    dirs = []
+    files = []
+    for entry in entries:
+        try:
+            # the file type is normally known from the directory listing, only symlinks needs a stat
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            dirs.append(entry)
+        else:
+            files.append(entry)
+    if debug_enabled():
+        deb(f'{WHITEBOLD}scan: cwd:"{root}" dirs:"{[e.name for e in dirs]}" files:"{[e.name for e in files]}"{RESET}')
+    return dirs, files
 
-        dirs_processed += len(dirs)
-        for _dir in dirs:
-            yield os.path.join(root, _dir), True
 
-        files_processed += len(files)
-        for filename in files:
-            fqn = os.path.join(root, filename)
-            ffqn = os.path.join(directory, fqn)
-            if os.path.exists(ffqn):
-                yield fqn, False
-            else:
+def existing_files(root, files):
+    for entry in files:
+        fqn = os.path.join(root, entry.name)
+        if entry.is_symlink():
+            try:
+                entry.stat()
+            except OSError:
                 war(f'ignoring "{fqn}" (broken symlink?)')
                 continue
+        yield fqn, entry
 
 
-def get_processed():
-    return files_processed, dirs_processed
+class PathEntry:
+    """
+    The part of an os.DirEntry used by the scan, for a file looked up by its path rather than listed.
+    """
+    def __init__(self, path, lstat):
+        self.path = path
+        self.name = os.path.basename(path)
+        self.lstat = lstat
 
+    def is_symlink(self):
+        return stat.S_ISLNK(self.lstat.st_mode)
 
-def check_for_exclude_file(name, exclude_files):
-    for exclude_file in exclude_files:
-        if exclude_file[0] == '!':
-            if re.search(exclude_file[1:], name):
-                deb(f'exclude file "{name}" {GREEN}match{RESET} with regex "{exclude_file}"')
-                return True
-        elif wcg.globmatch(name, exclude_file, flags=wcg.GLOBSTAR):
-            deb(f'exclude file "{name}"" {GREEN}match{RESET} with "{exclude_file}"')
-            return True
-        else:
-            deb(f'exclude file "{name}" unmatched with "{exclude_file}"')
-    return False
-
-
-def check_for_exclude_dir(name, exclude_dirs):
-    for exclude_dir in exclude_dirs:
-        if exclude_dir[0] == '!':
-            if re.search(exclude_dir[1:], name):
-                deb(f'exclude dir  "{name}" {GREEN}match{RESET} with regex "{exclude_dir}"')
-                return True
-        elif wcg.globmatch(name, exclude_dir, flags=wcg.GLOBSTAR):
-            deb(f'exclude dir  "{name}" {GREEN}match{RESET} with "{exclude_dir}"')
-            return True
-        else:
-            directory = os.path.dirname(name)
-            if exclude_dir[0] == '!':
-                if re.search(exclude_dir[1:], directory):
-                    deb(f'exclude dir  "{name}" {GREEN}match{RESET} with regex "{exclude_dir}"')
-                    return True
-            elif wcg.globmatch(directory, exclude_dir, flags=wcg.GLOBSTAR):
-                deb(f'exclude dir  "{name}" {GREEN}match{RESET} with "{exclude_dir}"')
-                return True
+    def is_dir(self):
+        if self.is_symlink():
+            return os.path.isdir(self.path)
+        return stat.S_ISDIR(self.lstat.st_mode)
+
+    def stat(self, follow_symlinks=True):
+        if follow_symlinks and self.is_symlink():
+            return os.stat(self.path)
+        return self.lstat
+
+
+def target_directory(root_path, pruner, components, pruned):
+    """
+    Go down the literal path 'components' from the root as the walk would have, following symlinked
+    directories as the walk does. Pruned directories are added to the dictionary 'pruned'.
+    :return: (directory, pruner state, True if all of the path was followed) or None if the walk wouldn't
+             get there. The walk doesn't go into a symlink_loop() so that and the rest of the path is left
+             to the walk of its parent directory.
+    """
+    directory = ''
+    state = pruner.root
+    for component in components:
+        path = os.path.join(directory, component)
+        fqn = os.path.join(root_path, path)
+        try:
+            if not stat.S_ISDIR(os.stat(fqn).st_mode):
+                return None
+        except OSError:
+            return None
+        if os.path.islink(fqn) and symlink_loop(root_path, path):
+            return directory, state, False
+        child = pruner.step(state, component)
+        reason = pruner.prune(path, child)
+        if reason:
+            pruned[path] = reason
+            return None
+        directory, state = path, child
+    return directory, state, True
+
+
+def scan_targets(root_path, filters, trace=None):
+    """
+    The scan of the root when the include rules only reach the literal paths in filters.pruner.targets.
+    Exact files are lstat'ed and matched directly and only the target directories are walked, with the
+    same result as walking the whole tree. The decisions are recorded in the optional cz_trace.Trace.
+    :return: (matches of the exact files, target directories to walk, directory_counters()) or None if
+             the root has to be listed after all.
+    """
+    now = time.perf_counter()
+    pruner = filters.pruner
+    files, dirs = pruner.targets
+    pruned = {}
+    targets = {}
+    exact = []
+    for components in dirs:
+        target = target_directory(root_path, pruner, components, pruned)
+        if target:
+            targets[target[0]] = target[1]
+    for components in files:
+        target = target_directory(root_path, pruner, components[:-1], pruned)
+        if target:
+            directory, state, reached = target
+            if reached:
+                exact.append(os.path.join(directory, components[-1]))
             else:
-                deb(f'exclude dir  "{name}" unmatched with "{exclude_dir}"')
-    return False
-
-
-def check_for_include_file(name, include_files):
-    for dest, pattern in include_files:
-        if pattern[0] == '!':
-            if re.search(pattern[1:], name):
-                deb(f'include file "{name}" {GREEN}match{RESET} with regex "{pattern}"')
-                return (dest, name, 0)
-        elif wcg.globmatch(name, pattern, flags=wcg.GLOBSTAR):
-            deb(f'include file "{name}" {GREEN}match{RESET} with "{pattern}"')
-            # for now support for @@@ operator works for .../** format only.
-            pattern_length = len(os.path.commonprefix([name, pattern]))
-            return (dest, name, pattern_length)
-        else:
-            deb(f'include file "{name}" unmatched with "{pattern}"')
-    return False
-
-
-def check_for_include_dir(directory, name, include_dirs):
-    for include_dir in include_dirs:
-        if include_dir[0] == '!':
-            if re.search(include_dir[1:], directory):
-                deb(f'include dir  "{name}" {GREEN}match{RESET} with regex "{include_dir}"')
-                return (None, name, 0)
-        elif wcg.globmatch(directory, include_dir, flags=wcg.GLOBSTAR):
-            deb(f'include dir  "{name}" {GREEN}match{RESET} with "{include_dir}"')
-            pattern_length = len(os.path.commonprefix([name, include_dir]))
-            return (None, name, pattern_length)
+                targets[directory] = state
+    if '' in targets:
+        return None
+
+    def walked(path):
+        return any(path.startswith(directory + os.sep) for directory in targets)
+
+    exact = [name for name in exact if not walked(name)]
+    walk = [(directory, state) for directory, state in sorted(targets.items()) if not walked(directory)]
+    if trace:
+        for path, reason in pruned.items():
+            trace.pruned(path, reason)
+
+    entries = []
+    for name in exact:
+        fqn = os.path.join(root_path, name)
+        try:
+            entry = PathEntry(fqn, os.lstat(fqn))
+            is_dir = entry.is_dir()
+        except OSError:
+            continue
+        if entry.is_symlink() and not os.path.exists(fqn):
+            war(f'ignoring "{name}" (broken symlink?)')
+            continue
+        entries.append((name, is_dir, entry))
+    if debug_enabled():
+        deb(f'{WHITEBOLD}scan: targets dirs:"{[path for path, _state in walk]}" files:"{exact}"{RESET}')
+    listed = time.perf_counter()
+    counters = directory_counters(len(walk), len(entries), walk_time=listed - now)
+
+    matches = []
+    for name, is_dir, entry in entries:
+        match = match_entry(filters, name, is_dir, entry, counters, trace)
+        if match:
+            matches.append(match)
+    counters['match_time'] = time.perf_counter() - listed
+    return matches, walk, counters
+
+
+def directory_chain(root_path, directory):
+    """
+    :return: the set of (st_dev, st_ino) of directory and of every directory above it up to root_path.
+    """
+    chain = set()
+    while True:
+        _stat = os.stat(os.path.join(root_path, directory))
+        chain.add((_stat.st_dev, _stat.st_ino))
+        if not directory:
+            return chain
+        directory = os.path.dirname(directory)
+
+
+def symlink_loop(root_path, path):
+    """
+    :return: True if the symlinked directory 'path' points at the directory the walk is in or at one
+             above it, so walking it would never end.
+    """
+    try:
+        _stat = os.stat(os.path.join(root_path, path))
+        return (_stat.st_dev, _stat.st_ino) in directory_chain(root_path, os.path.dirname(path))
+    except OSError:
+        return False
+
+
+def walked_directory(pruner, path):
+    """
+    :return: the pruner state of the directory 'path' if the walk goes into it through its real path,
+             i.e. none of the directories on the way is pruned, otherwise None.
+    """
+    directory = ''
+    state = pruner.root
+    for component in path.split(os.sep):
+        directory = os.path.join(directory, component)
+        state = pruner.step(state, component)
+        if pruner.prune(directory, state):
+            return None
+    return state
+
+
+def revisited_directory(root_path, filters, path, state):
+    """
+    Check if the symlinked directory 'path', with the pruner 'state', can be added as just a link since
+    the walk goes into the directory it points at anyway. That is only the case when the rules add the
+    same below both paths, without any relocation: the link is relative and points at a directory in the
+    tree without symlinks on the way, the rules are all globs without exclude_files rules, neither path is
+    excluded and the pruner states of the two directories are the same. Anything else is walked.
+    :return: the path of the directory pointed at, or None if 'path' should be walked.
+    """
+    pruner = filters.pruner
+    if pruner.include_anything or filters.exclude_files or len(pruner.exclude_dirs) != len(filters.exclude_dirs):
+        return None
+    fqn = os.path.join(root_path, path)
+    try:
+        real = os.path.normpath(os.path.join(os.path.dirname(path), os.readlink(fqn)))
+        if os.path.isabs(real) or real.split(os.sep)[0] in ('..', '.'):
+            return None
+        target = os.path.join(root_path, real)
+        if not os.path.samestat(os.stat(fqn), os.stat(target)) or \
+                os.path.realpath(target) != os.path.join(os.path.realpath(root_path), real):
+            return None
+    except OSError:
+        return None
+    if filters.exclude_dir(path) or filters.exclude_dir(real) or walked_directory(pruner, real) != state:
+        return None
+    if any(filters.include_files[index][0] for index, _position in state[0]):
+        return None
+    return real
+
+
+def skipped_links(root_path, filters, root, state, dirs, links, trace=None):
+    """
+    Find the symlinked directories in dirs the walk shouldn't go into. A symlink_loop() is never walked,
+    and a link the rules added as is, 'links' has the hit of each, isn't walked if it is a
+    revisited_directory(). Either
+    symlink is still added if a rule matches it like any other symlinked directory, only its content isn't,
+    that content is in the archive already through the directory it points at. The directories not walked
+    are recorded in the optional cz_trace.Trace.
+    :return: the names of the directories not to walk
+    """
+    skipped = set()
+    for entry in dirs:
+        if not entry.is_symlink():
+            continue
+        path = os.path.join(root, entry.name)
+        if symlink_loop(root_path, path):
+            reason = 'symlink loop'
+        elif entry.name in links and links[entry.name][0] is None and \
+                (real := revisited_directory(root_path, filters, path, filters.pruner.step(state, entry.name))):
+            reason = f'added as a link to "{real}" which is walked as well'
         else:
-            deb(f'include dir  "{name}" unmatched with "{include_dir}"')
-    return False
+            continue
+        skipped.add(entry.name)
+        if trace:
+            trace.pruned(path, reason)
+    return skipped
 
 
-def find_files(root_path, filters):
+def subdirectories(pruner, root, state, dirs, trace=None):
     """
-    The include_... and exclude_... functions above and this function were made before starting
-    using the wcmatch library. It should be possible to replace it all with wcmatch but that
-    will be another day.
-    :return: sorted list of files and symlinks found. Normally directories are ignored but as a
-             special case also include directories that are in fact symlinks.
+    :return: (path, pruner state) for the directories named in dirs in root that should be walked.
+             Pruned directories are recorded in the optional cz_trace.Trace.
     """
-    scan_result = ScanResult()
+    walk = []
+    for name in dirs:
+        path = os.path.join(root, name)
+        child = None
+        if pruner:
+            child = pruner.step(state, name)
+            reason = pruner.prune(path, child)
+            if reason:
+                if trace:
+                    trace.pruned(path, reason)
+                continue
+        walk.append((path, child))
+    return walk
 
-    for name, is_dir in file_scan(root_path):
-        Indent()
-        fqn = os.path.join(root_path, name)
-        symlink = os.path.islink(fqn)
 
-        # directories are not explicitly checked, only implicitly based on actual files found
-        if not is_dir or symlink:
-            deb(f'{LIGHT_BLUE}Checking "{name}"')
+def match_entry(filters, name, is_dir, entry, counters=None, trace=None, verdict=None):
+    """
+    :return: the (hit, lstat, is_dir) to add to the scan result or None. 'verdict' is the
+             Filters.directory_verdict() of the directory of name if already known. The rule
+             lookups made are counted as 'pattern_evaluations' in the optional counters
+             dictionary and the decision is recorded in the optional cz_trace.Trace.
+    """
+    # directories are not explicitly checked, only implicitly based on actual files found
+    if is_dir and not entry.is_symlink():
+        return None
 
-            Indent()
-            hit = check_for_include_file(name, filters.include_files)
-            _dir = os.path.dirname(name)
+    match = None
+    evaluations = 1
+    if verdict is None:
+        evaluations += 2
+        verdict = filters.directory_verdict(os.path.dirname(name))
+    include_dir, exclude_dir = verdict
+    hit = filters.include_file(name)
 
-            if not hit:
-                hit = check_for_include_dir(_dir, name, filters.include_dirs)
+    if not hit and include_dir is not None:
+        hit = filters.include_dir(include_dir, name)
 
-            if hit:
-                if not check_for_exclude_dir(_dir, filters.exclude_dirs) and not check_for_exclude_file(name, filters.exclude_files):
-                    deb(f'{YELLOW}Adding file "{name}"')
-                    scan_result.add(hit)
-            Unindent()
-        Unindent()
+    if hit and exclude_dir is None:
+        evaluations += 1
+        if not filters.exclude_file(name):
+            match = (hit, entry.stat(follow_symlinks=False), is_dir)
+    if counters is not None:
+        counters['pattern_evaluations'] += evaluations
+    if trace:
+        trace.entry(filters, name, is_dir, match is not None)
+    return match
+
+
+def directory_verdict(filters, directory, counters):
+    """
+    Filters.directory_verdict() for all the entries in directory, counted as 'pattern_evaluations'.
+    """
+    counters['pattern_evaluations'] += 2
+    return filters.directory_verdict(directory)
+
+
+def cached_directory(root_path, filters, root, state, cached, trace=None):
+    """
+    The scan_directory result from a cz_cache.ScanCache entry, only the matched files are lstat'ed.
+    The trace only gets the matched files since the others are not known.
+    :return: the scan_directory result or None if a matched file is gone.
+    """
+    dirs, nof_files, cached_matches = cached
+    if debug_enabled():
+        deb(f'{WHITEBOLD}scan: cached cwd:"{root}" dirs:"{dirs}"{RESET}')
+    now = time.perf_counter()
+    matches = []
+    for name, key, pattern_length in cached_matches:
+        try:
+            lstat = os.lstat(os.path.join(root_path, name))
+        except OSError:
+            return None
+        matches.append(((key, name, pattern_length), lstat, False))
+    if trace:
+        for name, _key, _pattern_length in cached_matches:
+            trace.entry(filters, name, False, True)
+    counters = directory_counters(len(dirs), nof_files, walk_time=time.perf_counter() - now)
+    return matches, subdirectories(filters.pruner, root, state, dirs, trace), counters
+
+
+def directory_counters(nof_dirs, nof_files, walk_time=0.0, match_time=0.0):
+    """
+    :return: the cz_stats.Stats counters of a single directory, added to the stats by the walk.
+    """
+    return {'dirs_processed': nof_dirs, 'files_processed': nof_files, 'pattern_evaluations': 0,
+            'walk_time': walk_time, 'match_time': match_time}
+
+
+def scan_directory(root_path, filters, root, state, cache=None, trace=None):
+    """
+    The unit of work for the scan: list and match a single directory, or with a cz_cache.ScanCache
+    reuse the previous result if the directory is unchanged. The decisions are recorded in the
+    optional cz_trace.Trace.
+    :return: (matches in walk order, subdirectories to walk, directory_counters())
+    """
+    if not root and filters.pruner.targets is not None:
+        targeted = scan_targets(root_path, filters, trace)
+        if targeted:
+            return targeted
+
+    mtime_ns = None
+    if cache:
+        try:
+            mtime_ns = os.stat(os.path.join(root_path, root)).st_mtime_ns
+        except OSError:
+            pass
+        cached = cache.lookup(root, mtime_ns) if mtime_ns is not None else None
+        if cached:
+            result = cached_directory(root_path, filters, root, state, cached, trace)
+            if result:
+                return result
+
+    now = time.perf_counter()
+    listing = list_directory(root_path, root)
+    if not listing:
+        return [], [], directory_counters(0, 0, walk_time=time.perf_counter() - now)
+    dirs, files = listing
+    existing = list(existing_files(root, files))
+    listed = time.perf_counter()
+    counters = directory_counters(len(dirs), len(files), walk_time=listed - now)
 
+    matches = []
+    links = {}
+    verdict = directory_verdict(filters, root, counters) if dirs or existing else None
+    for entry in dirs:
+        match = match_entry(filters, os.path.join(root, entry.name), True, entry, counters, trace, verdict)
+        if match:
+            matches.append(match)
+            links[entry.name] = match[0]
+    for fqn, entry in existing:
+        match = match_entry(filters, fqn, False, entry, counters, trace, verdict)
+        if match:
+            matches.append(match)
+    skipped = skipped_links(root_path, filters, root, state, dirs, links, trace)
+    counters['match_time'] = time.perf_counter() - listed
+
+    if mtime_ns is not None and not any(entry.is_symlink() for entry in dirs + files):
+        cache.store(root, mtime_ns, [entry.name for entry in dirs], len(files),
+                    [(name, key, pattern_length) for (key, name, pattern_length), _lstat, _is_dir in matches])
+
+    names = [entry.name for entry in dirs if entry.name not in skipped]
+    return matches, subdirectories(filters.pruner, root, state, names, trace), counters
+
+
+def scan_directory_sections(root_path, sections, root, states, traces=None):
+    """
+    scan_directory for several compiled sections at once. The directory is listed once and matched
+    against every section that hasn't pruned it, 'states' holds the pruner state of each section or
+    None where the section pruned the directory. 'traces' is an optional cz_trace.Trace per section.
+    :return: (matches as (section index, hit, lstat, is_dir), subdirectories to walk, directory_counters())
+    """
+    now = time.perf_counter()
+    listing = list_directory(root_path, root)
+    if not listing:
+        return [], [], directory_counters(0, 0, walk_time=time.perf_counter() - now)
+    dirs, files = listing
+    files = list(existing_files(root, files))
+    names = [entry.name for entry in dirs]
+    listed = time.perf_counter()
+    counters = directory_counters(len(dirs), len(files), walk_time=listed - now)
+
+    matches = []
+    walks = []
+    for index, filters in enumerate(sections):
+        if states[index] is None:
+            walks.append({})
+            continue
+        trace = traces[index] if traces else None
+        verdict = directory_verdict(filters, root, counters) if dirs or files else None
+        section_matches = []
+        links = {}
+        for entry in dirs:
+            match = match_entry(filters, os.path.join(root, entry.name), True, entry, counters, trace, verdict)
+            if match:
+                section_matches.append(match)
+                links[entry.name] = match[0]
+        for fqn, entry in files:
+            match = match_entry(filters, fqn, False, entry, counters, trace, verdict)
+            if match:
+                section_matches.append(match)
+        skipped = skipped_links(root_path, filters, root, states[index], dirs, links, trace)
+        matches += [(index, *match) for match in section_matches]
+        walks.append(dict(subdirectories(filters.pruner, root, states[index],
+                                         [name for name in names if name not in skipped], trace)))
+    counters['match_time'] = time.perf_counter() - listed
+
+    walk = []
+    for name in names:
+        path = os.path.join(root, name)
+        children = tuple(section_walk[path] if path in section_walk else None for section_walk in walks)
+        if any(child is not None for child in children):
+            walk.append((path, children))
+    return matches, walk, counters
+
+
+def walk_directories(scan, state, stats):
+    """
+    Walk the directories depth first in listing order as os.walk(followlinks=True) would, with
+    scan(root, state) listing and matching each directory.
+    :return: the list of matches of each directory in walk order
+    """
+    pending = [('', state)]
+
+    while pending:
+        root, state = pending.pop()
+        matches, walk, counters = scan(root, state)
+        stats.add(**counters)
+        yield matches
+        pending.extend(reversed(walk))
+
+
+def walk_serial(scan, state, stats):
+    """
+    :return: the matches of all directories in walk order, see walk_directories.
+    """
+    for matches in walk_directories(scan, state, stats):
+        yield from matches
+
+
+def walk_pipelined(scan, state, stats, queue_size):
+    """
+    walk_serial in a thread of its own. The matches are handed over a directory at a time through a
+    queue holding at most 'queue_size' directories, so the caller can start on the first matches while
+    the walk goes on and the walk waits when the caller falls behind.
+    """
+    results = queue.Queue(queue_size)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def walker():
+        try:
+            for matches in walk_directories(scan, state, stats):
+                if stop.is_set():
+                    return
+                put(matches)
+            put(done)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=walker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield from item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def walk_parallel(scan, state, workers, stats):
+    """
+    Spread the directories across a thread pool. The per directory results are merged in the order
+    of a serial walk so the result is identical to walk_serial.
+    """
+    results = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(scan, '', state): ()}
+        while futures:
+            done, _pending = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                # the path of listing indices down to a directory sorts in the depth first walk order
+                order = futures.pop(future)
+                matches, walk, counters = future.result()
+                results[order] = matches
+                stats.add(**counters)
+                for index, (path, state) in enumerate(walk):
+                    futures[executor.submit(scan, path, state)] = order + (index,)
+
+    for order in sorted(results):
+        yield from results[order]
+
+
+def walk(scan, state, stats, workers=1):
+    if workers > 1:
+        return walk_parallel(scan, state, workers, stats)
+    return walk_serial(scan, state, stats)
+
+
+def find_files(root_path, filters, workers=1, cache=None, trace=None):
+    """
+    Match everything found below root_path against the compiled filters from parse_section.
+    With more than one worker the directories are listed and matched in a thread pool. With a
+    cz_cache.ScanCache unchanged directories are not listed and matched again. With a
+    cz_trace.Trace the decision for each file and pruned directory is recorded.
+    :return: sorted list of files and symlinks found. Normally directories are ignored but as a
+             special case also include directories that are in fact symlinks. The cz_stats.Stats
+             of the scan are in scan_result.stats.
+    """
+    def scan(root, state):
+        return scan_directory(root_path, filters, root, state, cache, trace)
+
+    now = time.time()
+    scan_result = ScanResult()
+    for hit, lstat, is_dir in walk(scan, filters.pruner.root, scan_result.stats, workers):
+        scan_result.add(hit, lstat, is_dir)
     scan_result.sort()
+    scan_result.stats.add(files_matched=scan_result.nof_files, scan_time=time.time() - now)
 
     return scan_result
+
+
+def iter_files(root_path, filters, queue_size=PIPELINE_QUEUE, stats=None, cache=None, trace=None):
+    """
+    find_files as the first stage of a pipeline: the tree is walked in a thread and the (hit, lstat, is_dir)
+    matches are yielded as they are found, through a queue of at most 'queue_size' directories. The order
+    is deterministic since the subdirectories are walked and the matches of each directory yielded in name
+    order, but it is not the order find_files sorts the files in. The scan counters are added to the
+    optional cz_stats.Stats.
+    """
+    def scan(root, state):
+        matches, walk, counters = scan_directory(root_path, filters, root, state, cache, trace)
+        return (sorted(matches, key=lambda match: match[0][1]), sorted(walk, key=lambda directory: directory[0]),
+                counters)
+
+    stats = stats or Stats()
+    now = time.time()
+    for match in walk_pipelined(scan, filters.pruner.root, stats, queue_size):
+        yield match
+        stats.add(files_matched=1)
+    stats.add(scan_time=time.time() - now)
+
+
+def find_files_sections(root_path, sections, workers=1, traces=None):
+    """
+    find_files for a list of compiled sections walking the directory tree once. A directory is
+    only walked if at least one section doesn't prune it. 'traces' is an optional cz_trace.Trace
+    per section.
+    :return: the scan result of each section, the same as find_files would have returned except
+             that they share the cz_stats.Stats of the single walk.
+    """
+    def scan(root, states):
+        return scan_directory_sections(root_path, sections, root, states, traces)
+
+    now = time.time()
+    stats = Stats()
+    scan_results = [ScanResult(stats) for _filters in sections]
+    for index, hit, lstat, is_dir in walk(scan, tuple(filters.pruner.root for filters in sections), stats, workers):
+        scan_results[index].add(hit, lstat, is_dir)
+    for scan_result in scan_results:
+        scan_result.sort()
+        stats.add(files_matched=scan_result.nof_files)
+    stats.add(scan_time=time.time() - now)
+
+    return scan_results
@@ -1,9 +1,7 @@
-import os, json, time, zipfile, tarfile, logging, pathlib, shutil, warnings
-from .log import inf, war, err, deb, logger as log
-from . import cz
-
-# force file collisions in zipfile to be fatal rather than a "UserWarning" log message
-warnings.filterwarnings("error")
+import io, os, json, contextlib, time, zipfile, tarfile, logging, pathlib, shutil, stat, pwd, grp
+import tempfile, threading, collections, concurrent.futures
+from .log import inf, war, err, deb, debug_enabled, logger as log
+from . import cz, cz_zip, cz_tar, cz_cache, cz_stats, cz_profile, cz_trace, cz_copy, cz_member_cache
 
 
 def load_config(config_name):
@@ -32,10 +30,41 @@ def minimal_config():
     return config
 
 
-def scan(root, config, section):
+def new_trace(trace_file):
+    """
+    :return: a cz_trace.Trace if the decisions are saved to 'trace_file' or logged, otherwise None.
+    """
+    if trace_file or debug_enabled():
+        return cz_trace.Trace(log=debug_enabled())
+    return None
+
+
+def open_member_cache(member_cache, member_cache_size=None):
+    """
+    :return: a cz_member_cache.MemberCache in the directory 'member_cache', or None without one.
+    """
+    if not member_cache:
+        return None
+    size = cz_member_cache.DEFAULT_SIZE if member_cache_size is None else member_cache_size
+    return cz_member_cache.MemberCache(member_cache, size)
+
+
+def close_member_cache(cache, stats):
+    """
+    Trim the member cache to its size and add its hits and misses to the cz_stats.Stats.
+    """
+    cache.trim()
+    cache.report()
+    stats.add(member_cache_hits=cache.hits, member_cache_misses=cache.misses)
+
+
+def scan(root, config, section, scan_workers=1, scan_cache=None, trace_file=None):
     """
     Load the section from the configuration and return the file list matching files and
-    directories to include and exclude.
+    directories to include and exclude. With scan_workers above 1 the directory tree is
+    listed and matched by a pool of threads. With a 'scan_cache' filename the directories
+    unchanged since the previous scan with the same rules are not listed again. With a
+    'trace_file' filename the decision for each file is saved as json, see cz_trace.
     """
     filters = cz.parse_section(config, section)
 
@@ -45,9 +74,20 @@ def scan(root, config, section):
     inf(f'  Include dirs: {filters.include_dirs}')
     inf(f'  Exclude dirs: {filters.exclude_dirs}')
 
-    inf('Scanning ...')
+    if scan_workers > 1:
+        inf(f'Scanning with {scan_workers} workers ...')
+    else:
+        inf('Scanning ...')
     now = time.time()
-    scan_result = cz.find_files(root, filters)
+    cache = cz_cache.ScanCache(scan_cache, root, filters) if scan_cache else None
+    trace = new_trace(trace_file)
+    scan_result = cz.find_files(root, filters, scan_workers, cache, trace)
+    if cache:
+        cache.save()
+        cache.report()
+    if trace_file:
+        trace.save(trace_file)
+        inf(f'Saved the scan trace to {trace_file}')
 
     inf(f'Matched {scan_result.nof_files} files')
 
@@ -64,49 +104,197 @@ def scan(root, config, section):
                     inf(' -- not listing additional files --')
                     break
 
-    nof_files_processed, nof_dirs_processed = cz.get_processed()
-
-    inf(f'Scanned {nof_files_processed} files and {nof_dirs_processed} '
+    stats = scan_result.stats
+    inf(f'Scanned {stats.files_processed} files and {stats.dirs_processed} '
         f'directories in {time.time() - now:0.3f} secs')
 
     return scan_result
 
 
-def write_archive(root, scan_result, archive, compress_method):
+def scan_sections(root, config, sections, scan_workers=1, trace_file=None):
+    """
+    scan() for several sections walking the directory tree once. The 'trace_file' gets the
+    trace of each section by section name.
+    :return: the scan result of each section
+    """
+    filters_list = [cz.parse_section(config, section) for section in sections]
+    inf(f'Scanning for sections {", ".join(sections)} ...')
+    now = time.time()
+    traces = [new_trace(trace_file) for _section in sections]
+    scan_results = cz.find_files_sections(root, filters_list, scan_workers, traces)
+    if trace_file:
+        cz_trace.save_sections(trace_file, dict(zip(sections, traces)))
+        inf(f'Saved the scan traces to {trace_file}')
+
+    for section, scan_result in zip(sections, scan_results):
+        inf(f'  Matched {scan_result.nof_files} files for section "{section}"')
+
+    stats = scan_results[0].stats
+    inf(f'Scanned {stats.files_processed} files and {stats.dirs_processed} '
+        f'directories in {time.time() - now:0.3f} secs')
+
+    return scan_results
+
+
+def profile_rules(root, config_or_file, section, sort='time', scan_workers=1):
+    """
+    Scan with a cz_profile.RuleProfile and report the evaluations, hits and time of each rule of the
+    section, together with the rules that never matched, only matched after an earlier rule or were
+    inherited more than once. The scan result is discarded.
+    :return: the cz_profile.RuleProfile
+    """
+    if isinstance(config_or_file, str):
+        config = load_config(config_or_file)
+        inf(f'Loading configuration file "{config_or_file}" section "{section}"')
+    else:
+        config = config_or_file
+
+    filters = cz.parse_section(config, section)
+    profile = cz_profile.RuleProfile(filters)
+    inf(f'Profiling the rules of section "{section}" ...')
+    scan_result = cz.find_files(root, filters, scan_workers)
+    inf(f'Matched {scan_result.nof_files} files, scanned {scan_result.stats.files_processed} files and '
+        f'{scan_result.stats.dirs_processed} directories in {scan_result.stats.scan_time:0.3f} secs')
+    profile.report(sort)
+
+    return profile
+
+
+user_names = {}
+group_names = {}
+
+
+def tar_add(_tarfile, filename, arcname, lstat, opener=None):
     """
-    Compress the file list. This is insanely slow, all files are added individually.
+    TarFile.add() for a regular file or a symlink using the lstat record from the scan rather than
+    letting TarFile.gettarinfo() call os.lstat again. Hardlinks are detected as TarFile.add() does.
+    Regular files are opened with cz_zip.open_source().
     """
-    # Since the zip thing is done when located in the source root then figure out the
-    # relative path 'rel_archive' to where the archive should be written accordingly.
-    abs_root = os.path.abspath(root)
-    abs_archive = os.path.abspath(archive)
-    rel_archive = os.path.relpath(abs_archive, abs_root)
+    tarinfo = _tarfile.tarinfo(arcname)
+    tarinfo.mode = lstat.st_mode
+    tarinfo.uid = lstat.st_uid
+    tarinfo.gid = lstat.st_gid
+    tarinfo.mtime = lstat.st_mtime
+
+    if stat.S_ISLNK(lstat.st_mode):
+        tarinfo.type = tarfile.SYMTYPE
+        tarinfo.linkname = os.readlink(filename)
+    else:
+        inode = (lstat.st_ino, lstat.st_dev)
+        if lstat.st_nlink > 1 and inode in _tarfile.inodes and arcname != _tarfile.inodes[inode]:
+            tarinfo.type = tarfile.LNKTYPE
+            tarinfo.linkname = _tarfile.inodes[inode]
+        else:
+            tarinfo.size = lstat.st_size
+            if inode[0]:
+                _tarfile.inodes[inode] = arcname
+
+    if tarinfo.uid not in user_names:
+        try:
+            user_names[tarinfo.uid] = pwd.getpwuid(tarinfo.uid)[0]
+        except KeyError:
+            user_names[tarinfo.uid] = ''
+    tarinfo.uname = user_names[tarinfo.uid]
+    if tarinfo.gid not in group_names:
+        try:
+            group_names[tarinfo.gid] = grp.getgrgid(tarinfo.gid)[0]
+        except KeyError:
+            group_names[tarinfo.gid] = ''
+    tarinfo.gname = group_names[tarinfo.gid]
+
+    if tarinfo.isreg():
+        with cz_zip.open_source(filename, opener) as f:
+            _tarfile.addfile(tarinfo, f)
+    else:
+        _tarfile.addfile(tarinfo)
+
 
+def is_stream(archive):
+    """
+    True if the archive is a file object rather than a filename.
+    """
+    return archive is not None and not isinstance(archive, str)
+
+
+def prepare_archive(archive):
+    """
+    Construct the path for the archive if missing.
+    """
     archive_path = os.path.dirname(archive)
 
     if archive_path and not os.path.exists(archive_path):
         inf(f'Constructing the path {archive_path}')
         pathlib.Path(archive_path).mkdir(parents=True)
 
-    inf(f'Compressing {scan_result.nof_files} files to {archive}')
-    now = time.time()
 
-    zip_compression = compress_method in (zipfile.ZIP_LZMA, zipfile.ZIP_BZIP2, zipfile.ZIP_DEFLATED)
+@contextlib.contextmanager
+def archive_file(archive, filename, previous=None):
+    """
+    Open filename for writing the archive, or use the archive as is if it is a stream. A file left
+    incomplete by an exception is removed, the previous archive of an incremental build is closed and
+    left as it was.
+    """
+    if is_stream(archive):
+        yield archive
+        return
+    try:
+        with open(filename, 'wb') as f:
+            yield f
+    except Exception:
+        if previous:
+            previous.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(filename)
+        raise
+
+
+def archive_writer(root, scan_result, archive, compress_method, compress_workers=1, store_policy=None,
+                   incremental=False, opener=None, stats=None, entries=None, member_cache=None):
+    """
+    The write_archive() work as a generator yielding after each member so several archives can be
+    written side by side. Files are opened with 'opener' if given, see SharedSources. The reading
+    and writing is accounted in the optional cz_stats.Stats. The members written are the 'entries'
+    if given, as (path, destination, lstat, is_dir), otherwise scan_result.entries(). Zip style
+    members are taken from and stored in the optional cz_member_cache.MemberCache.
+    """
+    stats = stats or cz_stats.Stats()
+    entries = scan_result.entries() if entries is None else entries
 
-    pwd = os.getcwd()
-    os.chdir(root)
+    def source_opener(filename):
+        return cz_stats.TimedReader(cz_zip.open_source(filename, opener), stats)
+
+    zip_compression = compress_method in (zipfile.ZIP_LZMA, zipfile.ZIP_BZIP2, zipfile.ZIP_DEFLATED)
+    stream = is_stream(archive)
+
+    previous = None
+    if incremental:
+        if stream:
+            inf('Incremental rebuilds need the previous archive file, making a full rebuild')
+        elif zip_compression:
+            previous = cz_zip.PreviousArchive.open(archive)
+        else:
+            inf('Incremental rebuilds are only supported for zip style archives, making a full rebuild')
+    if member_cache and not zip_compression:
+        inf('The member cache is only used for zip style archives, tar archives are compressed as a whole')
 
     if zip_compression:
-        with zipfile.ZipFile(rel_archive, 'w', compress_method) as _zipfile:
-            for _file, _dest in scan_result.as_source_and_dest():
-                if os.path.islink(_file):
+        # with a previous archive the new archive is written next to it and replaces it when complete.
+        # ZipFile uses data descriptors by itself when the stream isn't seekable.
+        zip_archive = archive + '.incremental' if previous else archive
+        with archive_file(archive, zip_archive, previous) as f, \
+                zipfile.ZipFile(output := cz_stats.TimedWriter(f, stats), 'w', compress_method) as _zipfile, \
+                cz_zip.zip_writer(_zipfile, compress_workers, store_policy, previous, source_opener,
+                                  member_cache) as writer:
+            for _file, _dest, lstat, _is_dir in entries:
+                source = os.path.join(root, _file)
+                if stat.S_ISLNK(lstat.st_mode):
                     # First go at supporting symlinks
                     zip_info = zipfile.ZipInfo(_dest)
                     zip_info.create_system = 3  # unix
-                    mode = os.lstat(_file).st_mode
+                    mode = lstat.st_mode
                     zip_info.external_attr |= mode << 16
 
-                    link = os.readlink(_file)
+                    link = os.readlink(source)
 
                     deb(f'archive symlink "{_file}" pointing to "{link}" as "{_dest}" ')
 
@@ -115,37 +303,302 @@ def write_archive(root, scan_result, archive, compress_method):
                         # The occasional incorrect assumption is that the destination is always present for same directory symlinks.
                         if not scan_result.target_file_exist(_dest):
                             war(f'skipping symlink {_file} since {_dest} is not included')
+                            stats.add(symlinks_skipped=1)
                             continue
                     if os.path.isabs(link):
                         if not link.startswith(root):
                             war(f'symlink {_file} -> {link} has reference outside root, ignored')
+                            stats.add(symlinks_skipped=1)
                             continue
-                    try:
-                        _zipfile.writestr(zip_info, link)
-                    except UserWarning:
-                        raise Exception(f'Name collision in zip archive when writing symlink {_file} as {_dest}')
+                    writer.writestr(zip_info, link)
+                    stats.add(symlinks_written=1)
                 else:
-                    try:
-                        _zipfile.write(_file, arcname=_dest)
-                    except UserWarning:
-                        raise Exception(f'Name collision in zip archive when writing file {_file} as {_dest}')
+                    writer.write(source, cz_zip.zip_info_from_lstat(_dest, lstat, compress_method))
+                    stats.add(files_written=1)
+                yield
+        if previous:
+            previous.close()
+            os.replace(zip_archive, archive)
+            previous.report()
+        if store_policy:
+            store_policy.report()
+    elif compress_workers > 1:
+        with archive_file(archive, archive) as f, \
+                cz_tar.BlockCompressor(output := cz_stats.TimedWriter(f, stats), compress_method,
+                                       compress_workers) as compressor, \
+                tarfile.open(fileobj=compressor, mode='w') as _tarfile:
+            for _file, _dest, lstat, _is_dir in entries:
+                tar_add(_tarfile, os.path.join(root, _file), _dest, lstat, source_opener)
+                stats.add(**{'symlinks_written' if stat.S_ISLNK(lstat.st_mode) else 'files_written': 1})
+                yield
     else:
-        with tarfile.open(rel_archive, compress_method) as _tarfile:
-            for _file, _dest in scan_result.as_source_and_dest():
-                _tarfile.add(_file, arcname=_dest)
+        # a stream is written in the tarfile stream mode, e.g. 'w|gz' rather than 'w:gz'. A file is
+        # still opened by name since gzip records the name in its header.
+        mode = compress_method.replace(':', '|') if stream else compress_method
+        with archive_file(archive, archive) as f, \
+                tarfile.open(None if stream else archive, mode, output := cz_stats.TimedWriter(f, stats)) as _tarfile:
+            for _file, _dest, lstat, _is_dir in entries:
+                tar_add(_tarfile, os.path.join(root, _file), _dest, lstat, source_opener)
+                stats.add(**{'symlinks_written' if stat.S_ISLNK(lstat.st_mode) else 'files_written': 1})
+                yield
 
-    os.chdir(pwd)
+    stats.add(bytes_out=output.written if stream else os.path.getsize(archive))
+
+
+def write_archive(root, scan_result, archive, compress_method, compress_workers=1, store_policy=None,
+                  incremental=False, stats=None, member_cache=None):
+    """
+    Compress the file list. All files are added individually, for the zip style compressions
+    they can be compressed by 'compress_workers' threads in parallel and the optional
+    cz_zip.StorePolicy can choose to store members uncompressed. For the tar style
+    compressions the tar stream is compressed in blocks in parallel instead.
+
+    With 'incremental' the unchanged members of an existing zip style archive are copied
+    to the new archive without compressing them again, the result is the same as a full rebuild.
+    If writing fails the incomplete archive is removed and a previous archive is left as it was.
+    Likewise members found in the optional cz_member_cache.MemberCache, kept between runs, are
+    copied from the cache and the members compressed are stored in it.
+
+    'archive' is a filename or a writable binary file object. File objects don't need to be
+    seekable, zip archives are then written with data descriptors and tar archives in stream mode.
+
+    The timings and counters of the archive are added to the optional cz_stats.Stats.
+    :return: the elapsed time
+    """
+    if is_stream(archive):
+        inf(f'Compressing {scan_result.nof_files} files to stream')
+    else:
+        prepare_archive(archive)
+        inf(f'Compressing {scan_result.nof_files} files to {archive}')
+    stats = stats or cz_stats.Stats()
+    io_time = stats.io_time()
+    now = time.time()
+
+    for _ in archive_writer(root, scan_result, archive, compress_method, compress_workers, store_policy,
+                            incremental, stats=stats, member_cache=member_cache):
+        pass
 
-    return time.time() - now
+    elapsed = time.time() - now
+    stats.add_archive_time(elapsed, io_time)
+    return elapsed
 
 
-def compress(root, config_or_file, section, archive, dry_run=False, compression=None):
+def pipelined_entries(scan_result, matches, archive):
+    """
+    Add the matches from cz.iter_files() to scan_result as they come and pass them on as the entries
+    for archive_writer(). Name collisions are raised as soon as they show up.
+    """
+    stream = is_stream(archive)
+    for hit, lstat, is_dir in matches:
+        scan_result.add(hit, lstat, is_dir)
+        scan_result.check_collisions()
+        if not stream and scan_result.target_file_exist(archive):
+            raise Exception(f'Can\'t append archive {archive} to itself (fix the rules or delete the archive first)')
+        yield hit[1], scan_result.entry_destination(scan_result.nof_files - 1), lstat, is_dir
+
+
+def write_archive_pipelined(root, filters, archive, compress_method, compress_workers=1, store_policy=None,
+                            incremental=False, cache=None, trace=None, member_cache=None):
+    """
+    Scan and compress at the same time. The walk runs ahead of the archive writer in a thread of its
+    own, see cz.iter_files(), while the 'compress_workers' read and compress the files already found.
+    The file contents in memory are bounded by the cz.PIPELINE_QUEUE directories the walk can be
+    ahead and by the compress window, the scan result still has an entry per member. The members
+    are in the per directory name order of cz.iter_files() rather than sorted. An incomplete
+    archive is removed if the scan fails, e.g. on a name collision.
+    :return: the scan result, with the cz_stats.Stats of the scan and the archive
+    """
+    stream = is_stream(archive)
+    if stream:
+        inf('Scanning and compressing to stream')
+    else:
+        prepare_archive(archive)
+        inf(f'Scanning and compressing to {archive}')
+    scan_result = cz.ScanResult()
+    stats = scan_result.stats
+    io_time = stats.io_time()
+    now = time.time()
+
+    matches = cz.iter_files(root, filters, stats=stats, cache=cache, trace=trace)
+    for _ in archive_writer(root, scan_result, archive, compress_method, compress_workers, store_policy,
+                            incremental, stats=stats, entries=pipelined_entries(scan_result, matches, archive),
+                            member_cache=member_cache):
+        pass
+    if not scan_result.nof_files:
+        if not stream:
+            os.remove(archive)
+        raise Exception('Found no files ?')
+
+    stats.add_archive_time(time.time() - now, io_time)
+    return scan_result
+
+
+# the most bytes of file content SharedSources keeps for the archives still to read it
+SHARED_LIMIT = 256 * 1024 * 1024
+
+
+class SharedSources:
+    """
+    Opens the files for several archives written side by side so a file included in more than one
+    archive is read once. The content is kept, in memory or in a temporary file if large, until
+    the last archive including the file has opened it. When the archives come to their files in
+    different orders more than 'limit' bytes (default SHARED_LIMIT) could pile up, files beyond
+    that are not kept and are read again by the next archive instead. Thread safe.
+    """
+    def __init__(self, root, scan_results, limit=None):
+        self.users = collections.Counter(os.path.join(root, _file) for scan_result in scan_results
+                                         for _file, _dest, lstat, _is_dir in scan_result.entries()
+                                         if not stat.S_ISLNK(lstat.st_mode))
+        self.limit = SHARED_LIMIT if limit is None else limit
+        self.content = {}
+        self.sizes = {}
+        self.kept = 0
+        self.lock = threading.Lock()
+        self.reads = 0
+        self.reused = 0
+        self.not_kept = 0
+
+    def open(self, filename):
+        with self.lock:
+            self.users[filename] -= 1
+            last = self.users[filename] <= 0
+            content = self.content.pop(filename, None) if last else self.content.get(filename)
+            if content is None:
+                self.reads += 1
+                if last:
+                    return open(filename, 'rb')
+                size = os.path.getsize(filename)
+                if self.kept + size > self.limit:
+                    self.not_kept += 1
+                    return open(filename, 'rb')
+                content = self.read(filename)
+                self.content[filename] = content
+                self.sizes[filename] = size
+                self.kept += size
+            else:
+                self.reused += 1
+                if last:
+                    self.kept -= self.sizes.pop(filename)
+        if isinstance(content, bytes):
+            return io.BytesIO(content)
+        f = open(content, 'rb')
+        if last:
+            os.remove(content)
+        return f
+
+    @staticmethod
+    def read(filename):
+        """
+        :return: the file content or for large files the name of a temporary copy.
+        """
+        with open(filename, 'rb') as src:
+            content = src.read(cz_zip.SPOOL_SIZE + 1)
+            if len(content) <= cz_zip.SPOOL_SIZE:
+                return content
+            with tempfile.NamedTemporaryFile(delete=False) as dst:
+                dst.write(content)
+                shutil.copyfileobj(src, dst)
+                return dst.name
+
+    def close(self):
+        """
+        Remove the temporary copies of files some archive decided not to add after all.
+        """
+        for content in self.content.values():
+            if not isinstance(content, bytes):
+                os.remove(content)
+        self.content = {}
+        self.sizes = {}
+        self.kept = 0
+
+    def report(self):
+        inf(f'Read {self.reads} files for all archives, reused {self.reused} reads')
+        if self.not_kept:
+            inf(f'{self.not_kept} reads were not kept for the other archives to stay under {self.limit} bytes')
+
+
+def write_archives(root, jobs, compress_method, compress_workers=1, incremental=False, stats=None,
+                   member_cache=None):
+    """
+    Write several archives side by side, one member of each in turn. 'jobs' are (scan result, archive,
+    store policy). Files included in more than one archive are read once, see SharedSources. The timings and counters of
+    all archives are added to the optional cz_stats.Stats. The optional cz_member_cache.MemberCache
+    is shared by all archives.
+    :return: the elapsed time
+    """
+    for _scan_result, archive, _store_policy in jobs:
+        prepare_archive(archive)
+    stats = stats or cz_stats.Stats()
+    io_time = stats.io_time()
+    now = time.time()
+    shared = SharedSources(root, [scan_result for scan_result, _archive, _store_policy in jobs])
+
+    writers = []
+    for scan_result, archive, store_policy in jobs:
+        inf(f'Compressing {scan_result.nof_files} files to {archive}')
+        writers.append(archive_writer(root, scan_result, archive, compress_method, compress_workers,
+                                      store_policy, incremental, shared.open, stats, member_cache=member_cache))
+    try:
+        while writers:
+            for writer in list(writers):
+                if next(writer, StopIteration) is StopIteration:
+                    writers.remove(writer)
+    finally:
+        shared.close()
+
+    shared.report()
+
+    elapsed = time.time() - now
+    stats.add_archive_time(elapsed, io_time)
+    return elapsed
+
+
+def compression_method(compression):
+    """
+    :return: (compress method, archive extension) for the compression name
+    """
+    if compression == 'lzma':
+        return zipfile.ZIP_LZMA, '.lzma'
+    if compression == 'bz2':
+        return zipfile.ZIP_BZIP2, '.bz2'
+    if compression == 'zip':
+        return zipfile.ZIP_DEFLATED, '.zip'
+    if compression == 'tar.gz':
+        return 'w:gz', '.tar.gz'
+    if compression == 'tar.bz2':
+        return 'w:bz2', '.tar.bz2'
+    if compression == 'tar.xz':
+        return 'w:xz', '.tar.xz'
+    raise Exception(f'Don\'t understand the compression {compression} ?')
+
+
+def compress(root, config_or_file, section, archive, dry_run=False, compression=None, scan_workers=1,
+             compress_workers=None, incremental=False, scan_cache=None, trace_file=None, pipeline=False,
+             member_cache=None, member_cache_size=None):
     """
     The all in one cargozhipsrc operation.
     Scans for files according to a configuration file or dictionary and then writes the archive.
 
     'config_or_file' can be either a filename to a json configuration file or it can be a
     dictionary with the configuration directly.
+
+    'compress_workers' overrules the 'compress_workers' entry in the configuration, default is 1.
+
+    With 'incremental' an existing zip style archive is updated by only compressing new and changed files.
+    With a 'scan_cache' filename the scan reuses what it can from the previous scan, and with a
+    'trace_file' filename the decision for each file is saved as json, see scan().
+
+    'archive' can also be a writable binary file object, e.g. sys.stdout.buffer, see write_archive().
+
+    With 'pipeline' the archive is written while the tree is scanned, see write_archive_pipelined().
+    The members are then in per directory order and 'scan_workers' is not used.
+
+    With a 'member_cache' directory the compressed zip style members are kept between runs and
+    reused for files with the same content, see cz_member_cache. The cache is trimmed to
+    'member_cache_size' bytes afterwards, default cz_member_cache.DEFAULT_SIZE.
+
+    Nothing is shared between calls so compress() can run in several threads at once.
+    :return: the cz_stats.Stats of the scan and of writing the archive
     """
 
     inf(f'Packaging root "{root}"')
@@ -166,95 +619,298 @@ def compress(root, config_or_file, section, archive, dry_run=False, compression=
     else:
         _compression = settings_config['compression']
 
-    if _compression == 'lzma':
-        compress_method = zipfile.ZIP_LZMA
-        archive = archive + '.lzma'
-    elif _compression == 'bz2':
-        compress_method = zipfile.ZIP_BZIP2
-        archive = archive + '.bz2'
-    elif _compression == 'zip':
-        compress_method = zipfile.ZIP_DEFLATED
-        archive = archive + '.zip'
-    elif _compression == 'tar.gz':
-        compress_method = 'w:gz'
-        archive = archive + '.tar.gz'
-    elif _compression == 'tar.bz2':
-        compress_method = 'w:bz2'
-        archive = archive + '.tar.bz2'
-    elif _compression == 'tar.xz':
-        compress_method = 'w:xz'
-        archive = archive + '.tar.xz'
+    compress_method, extension = compression_method(_compression)
+    stream = is_stream(archive)
+    if stream:
+        inf('Destination archive: stream')
     else:
-        raise Exception(f'Don\'t understand the compression {compression} ?')
+        archive = archive + extension
+        inf(f'Destination archive: {archive}')
 
-    inf(f'Destination archive: {archive}')
+    if pipeline and not dry_run:
+        return compress_pipelined(root, config, section, archive, compress_method, compress_workers,
+                                  incremental, scan_cache, trace_file, member_cache, member_cache_size)
 
-    scan_result = scan(root, config, section)
+    scan_result = scan(root, config, section, scan_workers, scan_cache, trace_file)
 
     if not scan_result.nof_files:
         raise Exception('Found no files ?')
 
-    if archive in scan_result.all_destinations():
+    scan_result.check_collisions()
+
+    if not stream and scan_result.target_file_exist(archive):
         raise Exception(f'Can\'t append archive {archive} to itself (fix the rules or delete the archive first)')
 
     if dry_run:
         inf('Dry run, not writing archive')
     else:
-        elapsed = write_archive(root, scan_result, archive, compress_method)
+        if not compress_workers:
+            compress_workers = settings_config.get('compress_workers', 1)
+        store_policy = cz_zip.StorePolicy.from_config(settings_config)
+        cache = open_member_cache(member_cache, member_cache_size)
+        elapsed = write_archive(root, scan_result, archive, compress_method, compress_workers, store_policy,
+                                incremental, scan_result.stats, cache)
+        if cache:
+            close_member_cache(cache, scan_result.stats)
+
+        if stream:
+            inf(f'Generated archive stream in {elapsed:0.3f} secs')
+        else:
+            inf(f'Generated archive {archive} '
+                f'in {elapsed:0.3f} secs ({os.path.getsize(archive)} bytes)')
+
+    return scan_result.stats
+
+
+def compress_pipelined(root, config, section, archive, compress_method, compress_workers=None, incremental=False,
+                       scan_cache=None, trace_file=None, member_cache=None, member_cache_size=None):
+    """
+    The compress() work with the scan and the archive writer running at the same time.
+    :return: the cz_stats.Stats of the scan and of writing the archive
+    """
+    settings_config = config['config']
+    filters = cz.parse_section(config, section)
+    cache = cz_cache.ScanCache(scan_cache, root, filters) if scan_cache else None
+    trace = new_trace(trace_file)
+    if not compress_workers:
+        compress_workers = settings_config.get('compress_workers', 1)
+    store_policy = cz_zip.StorePolicy.from_config(settings_config)
+    _member_cache = open_member_cache(member_cache, member_cache_size)
+
+    scan_result = write_archive_pipelined(root, filters, archive, compress_method, compress_workers, store_policy,
+                                          incremental, cache, trace, _member_cache)
+    if _member_cache:
+        close_member_cache(_member_cache, scan_result.stats)
+    if cache:
+        cache.save()
+        cache.report()
+    if trace_file:
+        trace.save(trace_file)
+        inf(f'Saved the scan trace to {trace_file}')
+
+    stats = scan_result.stats
+    inf(f'Matched {scan_result.nof_files} files, scanned {stats.files_processed} files and '
+        f'{stats.dirs_processed} directories')
+    if is_stream(archive):
+        inf(f'Generated archive stream in {stats.archive_time:0.3f} secs')
+    else:
+        inf(f'Generated archive {archive} in {stats.archive_time:0.3f} secs ({os.path.getsize(archive)} bytes)')
+    return stats
+
+
+def compress_sections(root, config_or_file, sections, archive, dry_run=False, compression=None, scan_workers=1,
+                      compress_workers=None, incremental=False, trace_file=None, member_cache=None,
+                      member_cache_size=None):
+    """
+    compress() for a list of sections, writing an archive '<archive>_<section>' for each. The source
+    tree is walked once for all sections and a file included in several archives is read once as long
+    as SharedSources can keep it until the other archives get to it. A 'member_cache' is shared by all
+    archives, so a file in several zip style archives is compressed once.
+    :return: the cz_stats.Stats of the scan and of writing all archives
+    """
+    inf(f'Packaging root "{root}"')
+
+    if isinstance(config_or_file, str):
+        config = load_config(config_or_file)
+        inf(f'Loading configuration file "{config_or_file}" sections "{", ".join(sections)}"')
+    else:
+        config = config_or_file
+
+    settings_config = config['config']
+
+    if not archive:
+        archive = os.path.join(os.getcwd(), root)
+    elif is_stream(archive):
+        raise Exception('Several sections can\'t be written to a single stream')
+
+    compress_method, extension = compression_method(compression or settings_config['compression'])
+    archives = [f'{archive}_{section}{extension}' for section in sections]
+
+    scan_results = scan_sections(root, config, sections, scan_workers, trace_file)
+
+    for section, scan_result in zip(sections, scan_results):
+        if not scan_result.nof_files:
+            raise Exception(f'Found no files for section "{section}" ?')
+        scan_result.check_collisions()
+        for _archive in archives:
+            if scan_result.target_file_exist(_archive):
+                raise Exception(f'Can\'t append archive {_archive} to itself '
+                                f'(fix the rules or delete the archive first)')
+
+    if dry_run:
+        inf('Dry run, not writing archives')
+    else:
+        if not compress_workers:
+            compress_workers = settings_config.get('compress_workers', 1)
+        jobs = [(scan_result, _archive, cz_zip.StorePolicy.from_config(settings_config))
+                for scan_result, _archive in zip(scan_results, archives)]
+        cache = open_member_cache(member_cache, member_cache_size)
+        elapsed = write_archives(root, jobs, compress_method, compress_workers, incremental, scan_results[0].stats,
+                                 cache)
+        if cache:
+            close_member_cache(cache, scan_results[0].stats)
+
+        for _archive in archives:
+            inf(f'Generated archive {_archive} ({os.path.getsize(_archive)} bytes)')
+        inf(f'Generated {len(archives)} archives in {elapsed:0.3f} secs')
+
+    return scan_results[0].stats
+
+
+def member_path(destpath, name):
+    """
+    The path to extract an archive member to, sanitized as ZipFile.extract() does it so nothing
+    ends up outside destpath.
+    """
+    parts = [part for part in name.split('/') if part not in ('', '.', '..')]
+    return os.path.join(destpath, *parts)
 
-        inf(f'Generated archive {archive} '
-            f'in {elapsed:0.3f} secs ({os.path.getsize(archive)} bytes)')
+
+def open_for_extract(path, force):
+    """
+    Open a file for writing without following a symlink in its place. With force an existing
+    symlink is replaced, and this only costs a syscall when there is one.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_NOFOLLOW', 0)
+    try:
+        return os.fdopen(os.open(path, flags, 0o666), 'wb')
+    except OSError:
+        if not force or not os.path.islink(path):
+            raise
+        os.remove(path)
+        return os.fdopen(os.open(path, flags, 0o666), 'wb')
+
+
+def extract_file(_zipfile, info, path, force):
+    with _zipfile.open(info) as src, open_for_extract(path, force) as dst:
+        shutil.copyfileobj(src, dst, cz_zip.CHUNK_SIZE)
+    mode = stat.S_IMODE(info.external_attr >> 16)
+    if mode:
+        os.chmod(path, mode)
 
 
-def decompress(archive, destpath, force=False):
+def extract_symlink(_zipfile, info, path, force):
+    link = _zipfile.read(info).decode()
+    deb(f'symlink "{path}" destination "{link}"')
+    try:
+        os.symlink(link, path)
+    except FileExistsError:
+        if not force:
+            raise
+        if os.path.isdir(path) and not os.path.islink(path):
+            os.rmdir(path)
+        else:
+            os.remove(path)
+        os.symlink(link, path)
+
+
+def tar_extract_filter(member, path):
+    """
+    The tarfile 'tar' extraction filter refusing members ending up outside path, but keeping
+    the group and other write permissions as packed.
+    """
+    filtered = tarfile.tar_filter(member, path)
+    if filtered is None or filtered.mode is None:
+        return filtered
+    return filtered.replace(mode=member.mode & 0o777, deep=False)
+
+
+def decompress(archive, destpath, force=False, workers=1):
     """
     Not really part of the core business, but its an odd thing to miss support
     for unpacking an archive right after having packed one.
+
+    For the zip style archives the directories are made up front, symlinks are made directly
+    from the member data and the files are decompressed by 'workers' threads in parallel.
+    Tar archives are extracted by tarfile.
+    :return: the cz_stats.Stats with the files and symlinks written, the size of the archive as
+             bytes_in and the size of the files as bytes_out
     """
     try:
         os.makedirs(destpath, exist_ok=force)
     except:
         err(f'destination {destpath} already exist ?')
 
-    extension = os.path.splitext(archive)[1]
+    stats = cz_stats.Stats()
+    now = time.time()
+    if archive.endswith(('.tar.gz', '.tar.bz2', '.tar.xz')):
+        with tarfile.open(archive, 'r:*') as _tarfile:
+            members = _tarfile.getmembers()
+            if hasattr(tarfile, 'tar_filter'):
+                _tarfile.extractall(destpath, filter=tar_extract_filter)
+            else:
+                _tarfile.extractall(destpath)
+        stats.add(files_written=sum(member.isfile() for member in members),
+                  symlinks_written=sum(member.issym() for member in members),
+                  bytes_in=os.path.getsize(archive),
+                  bytes_out=sum(member.size for member in members if member.isfile()),
+                  archive_time=time.time() - now)
+        return stats
 
-    if extension in ('.lzma', '.bz2', '.zip'):
-        with zipfile.ZipFile(archive, mode='r') as _zipfile:
-            for info in _zipfile.infolist():
-                if force:
-                    try:
-                        os.remove(os.path.join(destpath, info.filename))
-                    except:
-                        pass
-                is_symlink = bool(info.external_attr & 0x20000000)
-                deb(f'decompressing {info.filename}  {"symlink" if is_symlink else ""}')
-                _zipfile.extract(info.filename, path=destpath)
-
-                if is_symlink:
-                    symlink = os.path.join(destpath, info.filename)
-                    with open(symlink) as f:
-                        symlink_dest = f.read()
-                        try:
-                            os.remove(symlink)
-                        except:
-                            os.rmdir(symlink)
-                        deb(f'symlink destination "{symlink_dest}"')
-                        os.symlink(symlink_dest, symlink)
-
-    elif extension in ('.tar.gz', '.tar.bz2', '.xz'):
-        with tarfile.ZipFile(archive, 'r') as _tarfile:
-            _tarfile.extractall(destpath)
-    else:
+    extension = os.path.splitext(archive)[1]
+    if extension not in ('.lzma', '.bz2', '.zip'):
         raise Exception(f'Cannot decompress from filename extension "{extension}" ?')
 
+    with zipfile.ZipFile(archive, mode='r') as _zipfile:
+        files = []
+        symlinks = []
+        directories = set()
+        for info in _zipfile.infolist():
+            path = member_path(destpath, info.filename)
+            if info.is_dir():
+                directories.add(path)
+                continue
+            directories.add(os.path.dirname(path))
+            if stat.S_ISLNK(info.external_attr >> 16):
+                symlinks.append((info, path))
+            else:
+                files.append((info, path))
+
+        # directories reached through a symlinked directory are made after the symlinks
+        symlink_paths = {path for _info, path in symlinks}
+        through_symlink = set()
+        for directory in directories:
+            parent = directory
+            while len(parent) > len(destpath):
+                if parent in symlink_paths:
+                    through_symlink.add(directory)
+                    break
+                parent = os.path.dirname(parent)
+
+        for directory in sorted(directories - through_symlink):
+            os.makedirs(directory, exist_ok=True)
+        for info, path in symlinks:
+            extract_symlink(_zipfile, info, path, force)
+        for directory in sorted(through_symlink):
+            os.makedirs(directory, exist_ok=True)
+
+        inf(f'Decompressing {len(files)} files and {len(symlinks)} symlinks to {destpath}')
+        if workers > 1:
+            # ZipFile serializes the reads from the archive, the decompression itself runs in parallel
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(extract_file, _zipfile, info, path, force) for info, path in files]
+                for future in futures:
+                    future.result()
+        else:
+            for info, path in files:
+                deb(f'decompressing {info.filename}')
+                extract_file(_zipfile, info, path, force)
+    stats.add(files_written=len(files), symlinks_written=len(symlinks), bytes_in=os.path.getsize(archive),
+              bytes_out=sum(info.file_size for info, _path in files), archive_time=time.time() - now)
+    return stats
+
 
-def copy(root, config_or_file, section, destination, require_empty_destination=True):
+def copy(root, config_or_file, section, destination, require_empty_destination=True, scan_workers=1,
+         scan_cache=None, trace_file=None, copy_workers=1, strategy='auto'):
     """
     Also not part of the core business, but support a copy operation using a cargozhipsrc configuration
     file (or a configuration dictionary).
     This allows for a faster/different/otherwise better compression tool to be used rather than the
     native python compressors in case cargozhipsrc is still useful for just extracting files.
     The result hopefully matches the result of a compress() followed by a decompress().
+    The destination directories are made up front and the files are copied by 'copy_workers' threads
+    with the cz_copy strategy 'strategy'.
+    :return: the cz_stats.Stats of the scan and of the copy
     """
     if not destination:
         err('missing a destination')
@@ -276,54 +932,52 @@ def copy(root, config_or_file, section, destination, require_empty_destination=T
     else:
         config = config_or_file
 
-    scan_result = scan(root, config, section)
-    symlinked_paths = []
+    scan_result = scan(root, config, section, scan_workers, scan_cache, trace_file)
+    stats = scan_result.stats
+    engine = cz_copy.CopyEngine(strategy, stats)
+    now = time.time()
+
+    files = []
+    links = []
+    for _source, _dest, lstat, is_dir in scan_result.entries():
+        if stat.S_ISLNK(lstat.st_mode):
+            links.append((_source, _dest, is_dir))
+        else:
+            files.append((_source, _dest, lstat))
+    link_dests = [_dest for _source, _dest, _is_dir in links]
+    cz_copy.make_directories(destination, [_dest for _source, _dest, _lstat in files] + link_dests, set(link_dests))
 
-    for _source, _dest in scan_result.as_source_and_dest():
+    symlinked_paths = set()
+    for _source, _dest, is_dir in links:
         src_file = os.path.join(root, _source)
         dst_file = os.path.join(destination, _dest)
-
-        duplicate = False
-        for sl_path in symlinked_paths:
-            if dst_file == sl_path:
-                duplicate = True
-                break
-
-        if duplicate:
+        if dst_file in symlinked_paths:
             continue
 
-        if not os.path.islink(src_file):
-            try:
-                shutil.copy(src_file, dst_file)
-            except FileNotFoundError:
-                dst_file_path = os.path.dirname(dst_file)
-                inf(f'Constructing destination path {dst_file_path}')
-                pathlib.Path(dst_file_path).mkdir(parents=True, exist_ok=True)
-                shutil.copy(src_file, dst_file)
-        else:
-            abs_src_file = os.path.abspath(src_file)
-            abs_link_target = os.path.realpath(src_file)
-            link = os.path.relpath(abs_link_target, abs_src_file)[3:]
-            is_dir = not os.path.isfile(src_file)
-
-            try:
-                os.symlink(src=link, dst=dst_file, target_is_directory=is_dir)
-                symlinked_paths.append(dst_file)
-            except FileExistsError:
-                if require_empty_destination:
-                    err(f'got FileExists error making symlink {link} to {dst_file}')
-            except FileNotFoundError:
-                try:
-                    # and the destination path is still missing in case this was also a move
-                    dst_path = os.path.dirname(dst_file)
-                    pathlib.Path(dst_path).mkdir(parents=True, exist_ok=True)
-                    os.symlink(src=link, dst=dst_file, target_is_directory=is_dir)
-                    symlinked_paths.append(dst_file)
-                except:
-                    err(f'failed making symlink {link} to {dst_file} after making {dst_path}')
-            except NotADirectoryError:
-                err(f'failed making symlink {link} to {dst_file} (perhaps a name clash?)')
-            except:
-                err(f'failed making symlink {link} to {dst_file}')
-
+        abs_src_file = os.path.abspath(src_file)
+        abs_link_target = os.path.realpath(src_file)
+        link = os.path.relpath(abs_link_target, abs_src_file)[3:]
+
+        try:
+            os.symlink(src=link, dst=dst_file, target_is_directory=is_dir)
+            symlinked_paths.add(dst_file)
+            stats.add(symlinks_written=1)
+        except FileExistsError:
+            if require_empty_destination:
+                err(f'got FileExists error making symlink {link} to {dst_file}')
+        except NotADirectoryError:
+            err(f'failed making symlink {link} to {dst_file} (perhaps a name clash?)')
+        except:
+            err(f'failed making symlink {link} to {dst_file}')
+
+    def copy_entry(_source, _dest, lstat):
+        engine.copy(os.path.join(root, _source), os.path.join(destination, _dest), lstat)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(copy_workers, 1)) as executor:
+        for future in [executor.submit(copy_entry, *entry) for entry in files]:
+            future.result()
+
+    stats.add(copy_time=time.time() - now)
     inf(f'copy complete to {destination}')
+
+    return stats
@@ -0,0 +1,87 @@
+# Persistent scan cache.
+#
+# A directory listing only changes when the mtime of the directory changes, so a scan can reuse the
+# subdirectories and the match results of a directory from the previous scan as long as its mtime is
+# the same and the rules are the same. The matched files are still lstat'ed since their content can
+# change without the directory changing. Directories containing symlinks are always listed since the
+# symlink targets can change behind the back of the directory.
+#
+import os, json, time, hashlib, threading
+from .log import inf, war
+
+CACHE_VERSION = 1
+# directories modified this close to the scan start might change again within the mtime resolution
+RACY_NS = 2 * 1000 * 1000 * 1000
+
+
+def rules_digest(filters):
+    """
+    :return: a digest of the rules the cached match results were made with.
+    """
+    rules = [CACHE_VERSION, filters.include_files, filters.include_dirs, filters.exclude_files, filters.exclude_dirs]
+    return hashlib.sha256(json.dumps(rules).encode()).hexdigest()
+
+
+class ScanCache:
+    """
+    The per directory listings and match results of a scan of 'root_path' with the given filters,
+    loaded from and saved to 'filename'. Lookups and stores are thread safe.
+    """
+    def __init__(self, filename, root_path, filters):
+        self.filename = filename
+        self.root = os.path.abspath(root_path)
+        self.rules = rules_digest(filters)
+        self.previous = {}
+        self.directories = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.start_ns = time.time_ns()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                cache = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            war(f'ignoring unreadable scan cache {self.filename} ({e})')
+            return
+        if cache.get('root') != self.root or cache.get('rules') != self.rules:
+            inf(f'Scan cache {self.filename} was made for other rules or another root, rescanning')
+            return
+        self.previous = cache['directories']
+
+    def save(self):
+        cache = {'root': self.root, 'rules': self.rules, 'directories': self.directories}
+        temporary = self.filename + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(cache, f)
+        os.replace(temporary, self.filename)
+
+    def lookup(self, root, mtime_ns):
+        """
+        :return: the cached (dirs, nof files, matches) for the directory root or None if it changed.
+        """
+        cached = self.previous.get(root)
+        with self.lock:
+            if cached is None or cached['mtime'] != mtime_ns:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.directories[root] = cached
+        return cached['dirs'], cached['files'], cached['matches']
+
+    def store(self, root, mtime_ns, dirs, nof_files, matches):
+        """
+        Cache the listing of directory root. 'matches' are the matched files as (name, destination key,
+        pattern length), symlinks are never cached so they are all regular files.
+        """
+        if mtime_ns >= self.start_ns - RACY_NS:
+            return
+        with self.lock:
+            self.directories[root] = {'mtime': mtime_ns, 'dirs': dirs, 'files': nof_files, 'matches': matches}
+
+    def report(self):
+        inf(f'Scan cache: reused {self.hits} directories, listed {self.misses}')
@@ -0,0 +1,139 @@
+# File copying for cz_api.copy().
+#
+# A CopyEngine copies a file with the first strategy in its fallback chain that works. A reflink
+# (FICLONE) shares the data blocks on copy on write filesystems such as btrfs and xfs, a hardlink
+# shares the inode itself so changing one changes the other (only used when asked for),
+# os.copy_file_range copies inside the kernel and the plain copy reads and writes through python.
+# A strategy the filesystems don't support is dropped from the chain after the first failure, so
+# the remaining files go straight to the next one.
+#
+import os, stat, errno, shutil, threading, time
+from .log import deb, inf
+from . import cz_stats
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+
+STRATEGIES = ('auto', 'reflink', 'hardlink', 'range', 'copy')
+FALLBACKS = {
+    'auto': ('reflink', 'range', 'copy'),
+    'reflink': ('reflink', 'range', 'copy'),
+    'hardlink': ('hardlink', 'reflink', 'range', 'copy'),
+    'range': ('range', 'copy'),
+    'copy': ('copy',)
+}
+# errors telling that a strategy isn't supported here rather than that the copy failed
+UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM, errno.EMLINK,
+               errno.EBADF}
+
+
+def copy_file(src_file, dst_file, lstat, stats=None):
+    """
+    shutil.copy() with the permission bits taken from the lstat record from the scan. The reading
+    and writing is accounted in the optional cz_stats.Stats.
+    """
+    stats = stats or cz_stats.Stats()
+    with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+        output = cz_stats.TimedWriter(dst, stats)
+        shutil.copyfileobj(cz_stats.TimedReader(src, stats), output)
+    stats.add(bytes_out=output.written)
+    os.chmod(dst_file, stat.S_IMODE(lstat.st_mode))
+
+
+class CopyEngine:
+    """
+    Copies files with the 'strategy', one of STRATEGIES, falling back along FALLBACKS[strategy].
+    The files copied are accounted in the optional cz_stats.Stats, as files_written and per strategy
+    as reflinks, hardlinks and range_copies. Thread safe.
+    """
+    def __init__(self, strategy='auto', stats=None):
+        if strategy not in STRATEGIES:
+            raise Exception(f'Unknown copy strategy "{strategy}", use one of {", ".join(STRATEGIES)}')
+        self.strategy = strategy
+        self.chain = list(FALLBACKS[strategy])
+        self.stats = stats or cz_stats.Stats()
+        self.lock = threading.Lock()
+
+    def _drop(self, method, error):
+        with self.lock:
+            if method in self.chain:
+                self.chain.remove(method)
+                # only worth telling if the strategy was asked for
+                log = inf if method == self.strategy else deb
+                log(f'Copy strategy "{method}" not available ({error}), using "{self.chain[0]}"')
+
+    def copy(self, src_file, dst_file, lstat):
+        """
+        Copy the regular file src_file to dst_file with the permission bits from lstat.
+        """
+        for method in list(self.chain):
+            try:
+                getattr(self, f'_{method}')(src_file, dst_file, lstat)
+                break
+            except OSError as e:
+                if method == 'copy' or e.errno not in UNSUPPORTED:
+                    raise
+                self._drop(method, e)
+        self.stats.add(files_written=1)
+
+    def _reflink(self, src_file, dst_file, lstat):
+        if not fcntl:
+            raise OSError(errno.ENOSYS, 'no fcntl')
+        now = time.perf_counter()
+        with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        os.chmod(dst_file, stat.S_IMODE(lstat.st_mode))
+        self.stats.add(reflinks=1, bytes_in=lstat.st_size, bytes_out=lstat.st_size,
+                       write_time=time.perf_counter() - now)
+
+    def _hardlink(self, src_file, dst_file, lstat):
+        now = time.perf_counter()
+        try:
+            os.link(src_file, dst_file)
+        except FileExistsError:
+            os.remove(dst_file)
+            os.link(src_file, dst_file)
+        self.stats.add(hardlinks=1, bytes_in=lstat.st_size, bytes_out=lstat.st_size,
+                       write_time=time.perf_counter() - now)
+
+    def _range(self, src_file, dst_file, lstat):
+        if not hasattr(os, 'copy_file_range'):
+            raise OSError(errno.ENOSYS, 'no os.copy_file_range')
+        now = time.perf_counter()
+        copied = 0
+        with open(src_file, 'rb') as src, open(dst_file, 'wb') as dst:
+            while True:
+                size = os.copy_file_range(src.fileno(), dst.fileno(), max(lstat.st_size - copied, 1024 * 1024))
+                if not size:
+                    break
+                copied += size
+        os.chmod(dst_file, stat.S_IMODE(lstat.st_mode))
+        self.stats.add(range_copies=1, bytes_in=copied, bytes_out=copied, write_time=time.perf_counter() - now)
+
+    def _copy(self, src_file, dst_file, lstat):
+        copy_file(src_file, dst_file, lstat, self.stats)
+
+
+def make_directories(destination, dests, links):
+    """
+    Create the destination directories for the files 'dests' in one pass, leaving out those at or
+    below the symlinks in the set 'links' since they appear when the symlinks are made.
+    """
+    directories = set()
+    for dest in dests:
+        directory = os.path.dirname(dest)
+        while directory and directory not in directories:
+            directories.add(directory)
+            directory = os.path.dirname(directory)
+    for directory in sorted(directories):
+        parent = directory
+        while parent and parent not in links:
+            parent = os.path.dirname(parent)
+        if not parent:
+            deb(f'Constructing destination path {directory}')
+            os.makedirs(os.path.join(destination, directory), exist_ok=True)
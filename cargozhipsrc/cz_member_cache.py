@@ -0,0 +1,135 @@
+# Content addressed cache of compressed archive members, shared between runs.
+#
+# Compressing is the expensive part of writing a zip style archive, and most files are the same
+# from one build to the next even when the archive itself is new, e.g. for another section or
+# another destination. The compressed bytes of each member are stored in a local directory keyed by
+# the sha256 of the file content, the compress method and the level, and a later run finding the
+# same key copies the bytes into the archive raw instead of compressing the file again. The result
+# is the same archive as without the cache.
+#
+# Each entry is a file with a small header (crc and uncompressed size) followed by the compressed
+# bytes. The mtime of an entry is its last use, and trim() evicts the least recently used entries
+# once the cache grows past its size.
+#
+import os, struct, tempfile, threading, contextlib
+from .log import inf, war, deb
+
+DEFAULT_SIZE = 1024 * 1024 * 1024
+# magic, crc and uncompressed size
+HEADER = struct.Struct('<4sLQ')
+MAGIC = b'CZM1'
+
+
+class MemberCache:
+    """
+    The compressed members in 'directory', trimmed to 'max_size' bytes by trim(). Lookups and stores
+    are thread safe, and several runs can share the directory since entries are replaced atomically.
+    """
+    def __init__(self, directory, max_size=DEFAULT_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.stored = 0
+        self.evicted = 0
+
+    @staticmethod
+    def key(digest, compress_type, level=None):
+        """
+        :return: the cache key of content with the sha256 hex 'digest' compressed with compress_type and level.
+        """
+        return f'{digest}-{compress_type}-{"default" if level is None else level}'
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """
+        :return: (crc, file size, compressed size, file object reading the compressed bytes) or None on a miss.
+        """
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return None
+        magic, crc, file_size = HEADER.unpack(f.read(HEADER.size).ljust(HEADER.size, b'\0'))
+        if magic != MAGIC:
+            f.close()
+            war(f'discarding unreadable member cache entry {path}')
+            with contextlib.suppress(OSError):
+                os.remove(path)
+            with self.lock:
+                self.misses += 1
+            return None
+        compress_size = os.fstat(f.fileno()).st_size - HEADER.size
+        # the mtime is the last use for trim()
+        with contextlib.suppress(OSError):
+            os.utime(path)
+        with self.lock:
+            self.hits += 1
+            self.hit_bytes += compress_size
+        return crc, file_size, compress_size, f
+
+    def put(self, key, crc, file_size, data):
+        """
+        Store the compressed bytes read from the file object 'data'. A failing store is logged and
+        otherwise ignored, the archive doesn't depend on the cache.
+        """
+        path = self.path(key)
+        tmp = None
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.', delete=False) as f:
+                tmp = f.name
+                f.write(HEADER.pack(MAGIC, crc, file_size))
+                while chunk := data.read(1024 * 1024):
+                    f.write(chunk)
+            os.replace(tmp, path)
+        except OSError as e:
+            war(f'can\'t store member cache entry {path} ({e})')
+            if tmp:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp)
+            return
+        with self.lock:
+            self.stored += 1
+
+    def entries(self):
+        """
+        :return: (mtime, size, path) of the entries in the cache, leaving out stores in progress.
+        """
+        entries = []
+        with os.scandir(self.directory) as subdirs:
+            for subdir in subdirs:
+                if not subdir.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(subdir.path) as files:
+                    for entry in files:
+                        if not entry.name.startswith('.'):
+                            lstat = entry.stat(follow_symlinks=False)
+                            entries.append((lstat.st_mtime_ns, lstat.st_size, entry.path))
+        return entries
+
+    def trim(self):
+        """
+        Evict the least recently used entries until the cache is at most max_size bytes.
+        """
+        entries = sorted(self.entries())
+        size = sum(entry_size for _mtime, entry_size, _path in entries)
+        for _mtime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            deb(f'evicting member cache entry {path}')
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            size -= entry_size
+            self.evicted += 1
+
+    def report(self):
+        inf(f'Member cache {self.directory}: {self.hits} hits ({self.hit_bytes} compressed bytes), '
+            f'{self.misses} misses, stored {self.stored}, evicted {self.evicted}')
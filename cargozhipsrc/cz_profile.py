@@ -0,0 +1,166 @@
+# Per rule profiling of a scan.
+#
+# The Matcher merges the rules into as few regexes as possible so the time spent on a single rule
+# can't be told apart. A RuleProfile replaces the matchers of compiled filters with matchers trying
+# each rule on its own, in the same order, and records how often each rule was evaluated, how often
+# it decided a match and the time spent on it. The rules after the deciding rule are tried as well
+# (without counting them as evaluations) to find rules that only ever match what an earlier rule
+# already matched. The include_dirs and exclude_dirs rules are tried once per directory rather than
+# once per file, see Filters.directory_verdict(). The exclude_dirs rules are also tried by the pruner
+# and against the parent directory, which tries a directory already tried, so a rule is accounted
+# once per directory whichever of these tries it first. The scan result is the same as without
+# profiling, only slower.
+#
+import re, threading, time
+from wcmatch import glob as wcg
+from .log import inf
+
+SORT_KEYS = ('time', 'evaluations', 'hits', 'order')
+
+
+class RuleStats:
+    """
+    The profile of a single rule. 'kind' is the filters list the rule is in, e.g. 'exclude_dirs'.
+    """
+    def __init__(self, kind, index, rule, section, duplicate_of=None):
+        self.kind = kind
+        self.index = index
+        self.rule = rule
+        self.section = section
+        self.duplicate_of = duplicate_of
+        # times tried before a decision was made, times it decided and times it matched after an earlier rule
+        self.evaluations = 0
+        self.hits = 0
+        self.shadowed = 0
+        self.time = 0.0
+
+    def verdict(self):
+        """
+        :return: 'duplicate', 'dead' (never matched), 'shadowed' (only matched after an earlier rule) or ''
+        """
+        if self.duplicate_of is not None:
+            return 'duplicate'
+        if self.hits:
+            return ''
+        if self.shadowed:
+            return 'shadowed'
+        return 'dead'
+
+    def describe(self):
+        """
+        :return: the rule as written in the configuration, include_files rules with their destination.
+        """
+        if self.kind == 'include_files':
+            dest, pattern = self.rule
+            return f'{dest} {pattern}' if dest else pattern
+        return self.rule
+
+    def as_dict(self):
+        return {'kind': self.kind, 'index': self.index, 'rule': self.rule, 'section': self.section,
+                'evaluations': self.evaluations, 'hits': self.hits, 'shadowed': self.shadowed,
+                'time': self.time, 'verdict': self.verdict(), 'duplicate_of': self.duplicate_of}
+
+
+def compile_rule(pattern):
+    """
+    :return: the match function for a single rule with the semantics it has in a Matcher.
+    """
+    if pattern.startswith('!'):
+        return re.compile(pattern[1:]).search
+    include, _exclude = wcg.translate(pattern, flags=wcg.GLOBSTAR)
+    return re.compile('|'.join(include)).fullmatch
+
+
+class ProfilingMatcher:
+    """
+    A drop in for a Matcher trying the rules one at a time and accounting in the RuleStats given
+    for each pattern. Matchers sharing a 'tried' set account a rule only once per name. Thread safe.
+    """
+    def __init__(self, patterns, rules, lock, tried=None):
+        self.patterns = patterns
+        self.matchers = [compile_rule(pattern) for pattern in patterns]
+        self.rules = rules
+        self.lock = lock
+        self.tried = tried
+
+    def match(self, name):
+        """
+        Return the index of the first rule matching name or None.
+        """
+        first = None
+        timings = []
+        for index, match in enumerate(self.matchers):
+            now = time.perf_counter()
+            hit = match(name)
+            timings.append((time.perf_counter() - now, hit))
+            if hit and first is None:
+                first = index
+
+        with self.lock:
+            for index, (elapsed, hit) in enumerate(timings):
+                rule = self.rules[index]
+                counted = first is None or index <= first or hit
+                if counted and self.tried is not None:
+                    if (rule.index, name) in self.tried:
+                        continue
+                    self.tried.add((rule.index, name))
+                if first is None or index <= first:
+                    rule.evaluations += 1
+                    rule.time += elapsed
+                    if index == first:
+                        rule.hits += 1
+                elif hit:
+                    rule.shadowed += 1
+        return first
+
+
+class RuleProfile:
+    """
+    Profiles the rules of compiled filters from cz.parse_section() during the following find_files().
+    Rules dropped by parse_section as duplicates are reported too, and never evaluated.
+    """
+    def __init__(self, filters):
+        self.lock = threading.Lock()
+        self.rules = []
+        by_kind = {}
+        for kind in ('include_files', 'include_dirs', 'exclude_files', 'exclude_dirs'):
+            patterns = getattr(filters, kind)
+            by_kind[kind] = [RuleStats(kind, index, pattern, filters.sections[kind][index])
+                             for index, pattern in enumerate(patterns)]
+            self.rules += by_kind[kind]
+        for kind, rule, section, first_section in filters.duplicates:
+            self.rules.append(RuleStats(kind, None, rule, section, first_section))
+
+        def matcher(kind, patterns, tried=None):
+            rules = [by_kind[kind][getattr(filters, kind).index(pattern)] for pattern in patterns]
+            return ProfilingMatcher(patterns, rules, self.lock, tried)
+
+        include_files = [pattern for _dest, pattern in filters.include_files]
+        filters.include_files_matcher = ProfilingMatcher(include_files, by_kind['include_files'], self.lock)
+        filters.include_dirs_matcher = matcher('include_dirs', filters.include_dirs)
+        filters.exclude_files_matcher = matcher('exclude_files', filters.exclude_files)
+        # the parent directory and pruning matchers try subsets of the exclude_dirs rules on directories the
+        # exclude_dirs matcher tries as well, each directory is accounted once per rule
+        tried = set()
+        filters.exclude_dirs_matcher = matcher('exclude_dirs', filters.exclude_dirs, tried)
+        filters.exclude_parent_dirs_matcher = matcher('exclude_dirs', filters.exclude_parent_dirs_matcher.patterns,
+                                                      tried)
+        filters.pruner.exclude_regexes = matcher('exclude_dirs', filters.pruner.exclude_regexes.patterns, tried)
+
+    def ranking(self, sort='time'):
+        """
+        :return: the RuleStats sorted by 'sort', one of SORT_KEYS, most expensive first.
+        """
+        if sort == 'order':
+            return list(self.rules)
+        if sort not in SORT_KEYS:
+            raise Exception(f'Can\'t sort the rule profile by "{sort}", use one of {", ".join(SORT_KEYS)}')
+        return sorted(self.rules, key=lambda rule: getattr(rule, sort), reverse=True)
+
+    def report(self, sort='time'):
+        inf(f'{"kind":<14}{"section":<16}{"evaluations":>12}{"hits":>8}{"shadowed":>10}{"secs":>10}  '
+            f'{"verdict":<10}rule')
+        for rule in self.ranking(sort):
+            first = f' (already added by section "{rule.duplicate_of}")' if rule.duplicate_of is not None else ''
+            inf(f'{rule.kind:<14}{rule.section:<16}{rule.evaluations:>12}{rule.hits:>8}{rule.shadowed:>10}'
+                f'{rule.time:>10.4f}  {rule.verdict():<10}{rule.describe()}{first}')
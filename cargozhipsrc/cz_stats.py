@@ -0,0 +1,116 @@
+# Timings and counters of a scan and of writing the archive or copy.
+#
+# The scan counts per directory and merges the counts in the walking thread, reading and writing are
+# measured by wrapping the source and destination file objects. Times spent in worker threads are
+# summed so with several workers the phase times can add up to more than the elapsed time.
+#
+import json, threading, time
+
+
+class Stats:
+    """
+    The statistics of a single operation, returned by the cz_api functions and written by --stats.
+    Updates through add() are thread safe.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # scan
+        self.dirs_processed = 0
+        self.files_processed = 0
+        self.files_matched = 0
+        self.pattern_evaluations = 0
+        self.walk_time = 0.0
+        self.match_time = 0.0
+        self.scan_time = 0.0
+        # archive or copy
+        self.files_written = 0
+        self.symlinks_written = 0
+        self.symlinks_skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.read_time = 0.0
+        self.compress_time = 0.0
+        self.write_time = 0.0
+        self.archive_time = 0.0
+        self.copy_time = 0.0
+        # files copied by cz_copy.CopyEngine without reading them
+        self.reflinks = 0
+        self.hardlinks = 0
+        self.range_copies = 0
+        # zip style members taken from or compressed into cz_member_cache.MemberCache
+        self.member_cache_hits = 0
+        self.member_cache_misses = 0
+
+    def add(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def io_time(self):
+        return self.read_time + self.write_time
+
+    def add_archive_time(self, elapsed, io_time):
+        """
+        Account for writing archives in 'elapsed' secs. The compress_time is the part of it not spent
+        reading and writing, 'io_time' is the io_time() from before the archives were written.
+        """
+        self.add(archive_time=elapsed, compress_time=max(elapsed - (self.io_time() - io_time), 0.0))
+
+    def as_dict(self):
+        return {name: value for name, value in vars(self).items() if name != 'lock'}
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+
+
+class TimedReader:
+    """
+    A source file object accounting the time spent reading it and the bytes read as read_time and bytes_in.
+    """
+    def __init__(self, f, stats):
+        self.f = f
+        self.stats = stats
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.f.close()
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def read(self, size=-1):
+        now = time.perf_counter()
+        data = self.f.read(size)
+        self.stats.add(read_time=time.perf_counter() - now, bytes_in=len(data))
+        return data
+
+    def readinto(self, buffer):
+        now = time.perf_counter()
+        size = self.f.readinto(buffer)
+        self.stats.add(read_time=time.perf_counter() - now, bytes_in=size or 0)
+        return size
+
+
+class TimedWriter:
+    """
+    A destination file object accounting the time spent writing to it as write_time. The bytes
+    written are counted in 'written' rather than in bytes_out since seekable archives rewrite some
+    of them. Closing the file is left to the owner of it.
+    """
+    def __init__(self, f, stats):
+        self.f = f
+        self.stats = stats
+        self.written = 0
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+    def write(self, data):
+        now = time.perf_counter()
+        size = self.f.write(data)
+        self.stats.add(write_time=time.perf_counter() - now)
+        self.written += len(data)
+        return size
@@ -0,0 +1,81 @@
+# Block parallel compression of tar archives.
+#
+# The tar stream is cut into blocks that are compressed independently by a thread pool and written
+# in order as concatenated gzip members, bz2 streams or xz streams, the way pigz, pbzip2 and xz -T
+# do it. gzip, bzip2, xz and the python tarfile module all read such a file as a single stream.
+#
+import gzip, bz2, lzma, time, functools, collections, concurrent.futures
+
+# larger blocks compress better, xz gets blocks of three times its default 8 MiB dictionary as xz -T
+BLOCK_SIZES = {
+    'w:gz': 4 * 1024 * 1024,
+    'w:bz2': 4 * 1024 * 1024,
+    'w:xz': 24 * 1024 * 1024
+}
+
+
+def block_compressor(compress_method):
+    """
+    The function compressing a single block with the same settings as tarfile.open(..., compress_method).
+    """
+    if compress_method == 'w:gz':
+        return functools.partial(gzip.compress, compresslevel=9, mtime=int(time.time()))
+    if compress_method == 'w:bz2':
+        return functools.partial(bz2.compress, compresslevel=9)
+    if compress_method == 'w:xz':
+        return functools.partial(lzma.compress, format=lzma.FORMAT_XZ)
+    raise Exception(f'No block compressor for "{compress_method}"')
+
+
+class BlockCompressor:
+    """
+    A write only file object for tarfile.open(fileobj=..., mode='w') compressing what is written to it
+    in blocks by 'workers' threads. The compressed blocks are written to fileobj in order and at most
+    'window' blocks are pending at any time.
+    """
+    def __init__(self, fileobj, compress_method, workers, block_size=None, window=None):
+        self.fileobj = fileobj
+        self.compress = block_compressor(compress_method)
+        self.block_size = block_size or BLOCK_SIZES[compress_method]
+        self.window = window or workers * 2
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown()
+
+    def write(self, data):
+        self.buffer += data
+        self.offset += len(data)
+        while len(self.buffer) >= self.block_size:
+            self.pending.append(self.executor.submit(self.compress, bytes(self.buffer[:self.block_size])))
+            del self.buffer[:self.block_size]
+            self.flush(self.window)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self, keep=0):
+        """
+        Write compressed blocks in order until at most 'keep' are pending.
+        """
+        while len(self.pending) > keep:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffer or not self.offset:
+            self.pending.append(self.executor.submit(self.compress, bytes(self.buffer)))
+            self.buffer = bytearray()
+        self.flush()
+        self.executor.shutdown()
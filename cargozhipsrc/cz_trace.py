@@ -0,0 +1,73 @@
+# Per file decision trace of a scan.
+#
+# The scan itself only decides if an entry is added. With a Trace given to find_files each entry is
+# explained afterwards by Filters.explain(), naming the rule including it and the rule excluding it,
+# together with the reason for every directory pruned. Without a trace the scan doesn't build any
+# trace messages at all. The decisions can be logged as they are made (the --verbose logging) and
+# saved as json.
+#
+import json, threading
+from .log import deb, GREEN, YELLOW, WHITEBOLD, RESET
+
+
+def describe_rule(filters, kind, index):
+    """
+    :return: the rule 'index' of the filters list 'kind' as a dictionary for the trace.
+    """
+    rule = getattr(filters, kind)[index]
+    described = {'kind': kind, 'rule': rule, 'section': filters.sections[kind][index]}
+    if kind == 'include_files':
+        described['dest'], described['rule'] = rule
+    return described
+
+
+class Trace:
+    """
+    The decisions of a scan in the order they are made, which is the walk order for a serial scan.
+    With 'log' the decisions are also logged with deb() as they are made. Thread safe.
+    """
+    def __init__(self, log=False):
+        self.log = log
+        self.decisions = []
+        self.lock = threading.Lock()
+
+    def _add(self, decision):
+        with self.lock:
+            self.decisions.append(decision)
+
+    def entry(self, filters, name, is_dir, added):
+        """
+        Record why the file (or symlinked directory if is_dir) 'name' was added to the scan result or not.
+        """
+        included, excluded = filters.explain(name)
+        decision = {'name': name, 'is_dir': is_dir, 'added': added,
+                    'included_by': describe_rule(filters, *included) if included else None,
+                    'excluded_by': describe_rule(filters, *excluded) if excluded else None}
+        self._add(decision)
+        if self.log:
+            if added:
+                deb(f'{YELLOW}adding "{name}"{RESET}, {GREEN}included{RESET} by "{decision["included_by"]["rule"]}"')
+            elif excluded:
+                deb(f'skipping "{name}", {GREEN}excluded{RESET} by "{decision["excluded_by"]["rule"]}"')
+            else:
+                deb(f'skipping "{name}", no include rule')
+
+    def pruned(self, path, reason):
+        """
+        Record that the directory 'path' was not walked.
+        """
+        self._add({'name': path, 'is_dir': True, 'pruned': reason})
+        if self.log:
+            deb(f'{WHITEBOLD}scan: pruning "{path}", {reason}{RESET}')
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.decisions, f, indent=1)
+
+
+def save_sections(filename, traces):
+    """
+    Save the traces of a multi section scan, 'traces' is a dictionary with the Trace of each section.
+    """
+    with open(filename, 'w') as f:
+        json.dump({section: trace.decisions for section, trace in traces.items()}, f, indent=1)
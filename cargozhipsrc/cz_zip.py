@@ -0,0 +1,463 @@
+# Parallel compression of zip archive members.
+#
+# The zip, bz2 and lzma compressors release the GIL while compressing so the members are
+# compressed by a thread pool into spooled temporary files and then appended to the archive
+# in the scan order. The bytes written are the same as ZipFile.write() would have written.
+#
+# For incremental rebuilds the unchanged members of the previous archive are copied over with
+# their compressed bytes as is, which also gives the same bytes as compressing them again. The
+# same goes for members found in the optional cz_member_cache.MemberCache shared between runs.
+#
+import io, os, copy, time, zlib, struct, shutil, hashlib, tempfile, zipfile, contextlib
+import threading, concurrent.futures, collections
+from .log import inf, war, deb
+
+# compressed members larger than this are spooled to disk rather than kept in memory
+SPOOL_SIZE = 16 * 1024 * 1024
+CHUNK_SIZE = 1024 * 1024
+# the start of a file compressed to detect if it is worth compressing
+SAMPLE_SIZE = 64 * 1024
+# zip general purpose flag bits, the zipfile names for them are private and only there from python 3.11
+FLAG_COMPRESS_OPTION_1 = 0x02
+FLAG_DATA_DESCRIPTOR = 0x08
+
+
+class StorePolicy:
+    """
+    Decides per member if it is worth compressing. Members with an extension listed in the configuration
+    'store_extensions' are stored (ZIP_STORED) and with 'store_detect' enabled so are members where a
+    sample compressed with a fast zlib compresses to more than 'store_detect_ratio' of its size.
+    The policy can be shared by writer threads and keeps the statistics for the report.
+    """
+    def __init__(self, store_extensions=(), detect=False, ratio=0.95):
+        self.store_extensions = {extension.lower() for extension in store_extensions}
+        self.detect = detect
+        self.ratio = ratio
+        self.lock = threading.Lock()
+        self.members = 0
+        self.stored_by_extension = 0
+        self.stored_by_detection = 0
+        self.stored_bytes = 0
+        self.estimated_bytes = 0
+        self.detected_bytes = 0
+        self.detect_time = 0.0
+        self.compressed_bytes = 0
+        self.compress_time = 0.0
+
+    @staticmethod
+    def from_config(settings_config):
+        """
+        :return: the policy from the configuration 'config' section or None if there isn't any.
+        """
+        store_extensions = settings_config.get('store_extensions', [])
+        detect = settings_config.get('store_detect', False)
+        if not store_extensions and not detect:
+            return None
+        return StorePolicy(store_extensions, detect, settings_config.get('store_detect_ratio', 0.95))
+
+    def compress_type(self, filename, compress_type, file_size, source):
+        """
+        The detection reads a sample from the file object 'source' opened for filename, and leaves it
+        wherever the sample ended.
+        :return: the compress type to use for filename, either the given or ZIP_STORED.
+        """
+        if compress_type == zipfile.ZIP_STORED:
+            return compress_type
+        if os.path.splitext(filename)[1].lower() in self.store_extensions:
+            deb(f'storing "{filename}" uncompressed, extension')
+            with self.lock:
+                self.stored_by_extension += 1
+            return zipfile.ZIP_STORED
+        if self.detect:
+            start = time.time()
+            sample = source.read(SAMPLE_SIZE)
+            ratio = len(zlib.compress(sample, 1)) / len(sample) if sample else 0.0
+            with self.lock:
+                self.detect_time += time.time() - start
+                if ratio > self.ratio:
+                    self.stored_by_detection += 1
+                    self.detected_bytes += file_size
+                    self.estimated_bytes += int(file_size * min(ratio, 1.0))
+            if ratio > self.ratio:
+                deb(f'storing "{filename}" uncompressed, sample compression ratio {ratio:0.3f}')
+                return zipfile.ZIP_STORED
+        return compress_type
+
+    def record(self, zip_info, elapsed, reused=False):
+        """
+        Account for a member written in 'elapsed' seconds. Members reused from a previous archive
+        are not part of the measured compression rate.
+        """
+        with self.lock:
+            self.members += 1
+            if zip_info.compress_type == zipfile.ZIP_STORED:
+                self.stored_bytes += zip_info.file_size
+            elif not reused:
+                self.compressed_bytes += zip_info.file_size
+                self.compress_time += elapsed
+
+    def report(self):
+        stored = self.stored_by_extension + self.stored_by_detection
+        inf(f'Stored {stored} of {self.members} members uncompressed ({self.stored_by_extension} by extension, '
+            f'{self.stored_by_detection} detected), {self.stored_bytes} bytes')
+        if self.compressed_bytes and self.compress_time:
+            rate = self.compressed_bytes / self.compress_time
+            inf(f'Skipped compressing {self.stored_bytes} bytes, saving an estimated {self.stored_bytes / rate:0.3f} '
+                f'secs at the measured {rate / 1e6:0.1f} MB/s. Detection took {self.detect_time:0.3f} secs')
+        if self.stored_by_detection:
+            inf(f'The detected members would have compressed to an estimated {self.estimated_bytes} of their '
+                f'{self.detected_bytes} bytes')
+
+
+class PreviousArchive:
+    """
+    The members of a previous build of an archive. A member is unchanged if the name, size, timestamp,
+    mode, compress type and finally the crc of the file to add are the same as in the previous archive,
+    and its compressed bytes can then be copied to the new archive raw. Lookups are thread safe.
+    """
+    def __init__(self, filename):
+        self.zipfile = zipfile.ZipFile(filename)
+        self.members = {info.filename: info for info in self.zipfile.infolist()}
+        self.fp = open(filename, 'rb')
+        self.lock = threading.Lock()
+        self.reused = 0
+        self.reused_bytes = 0
+        self.changed = 0
+
+    @staticmethod
+    def open(filename):
+        """
+        :return: the previous archive or None if there isn't a readable one.
+        """
+        if not os.path.exists(filename):
+            return None
+        try:
+            return PreviousArchive(filename)
+        except zipfile.BadZipFile as e:
+            war(f'can\'t read previous archive {filename} ({e}), making a full rebuild')
+            return None
+
+    def close(self):
+        self.fp.close()
+        self.zipfile.close()
+
+    def unchanged(self, filename, zip_info, source):
+        """
+        The crc is read from the file object 'source' opened for filename, if it comes to that.
+        :return: the ZipInfo of the previous member if filename can be reused as is, otherwise None.
+        """
+        old = self.members.get(zip_info.filename)
+        reusable = old is not None and not old.flag_bits & 0x1
+        if reusable:
+            # the archive timestamps have a two second resolution
+            fields = (old.compress_type, old.file_size, old.date_time[:5], old.date_time[5] // 2, old.external_attr)
+            reusable = fields == (zip_info.compress_type, zip_info.file_size, zip_info.date_time[:5],
+                                  zip_info.date_time[5] // 2, zip_info.external_attr)
+        reusable = reusable and file_crc(source) == old.CRC
+        with self.lock:
+            if reusable:
+                self.reused += 1
+                self.reused_bytes += old.compress_size
+            else:
+                self.changed += 1
+        if not reusable:
+            deb(f'compressing new or changed "{filename}"')
+            return None
+        return old
+
+    def raw(self, zip_info):
+        """
+        :return: a file object reading the compressed bytes of the previous member.
+        """
+        self.fp.seek(zip_info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, self.fp.read(zipfile.sizeFileHeader))
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f'Bad magic number for file header of {zip_info.filename}')
+        self.fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        return io.BufferedReader(_RawMember(self.fp, zip_info.compress_size))
+
+    def report(self):
+        inf(f'Reused {self.reused} unchanged members ({self.reused_bytes} compressed bytes) from the previous '
+            f'archive, compressed {self.changed} new or changed')
+
+
+class _RawMember(io.RawIOBase):
+    def __init__(self, fp, size):
+        self.fp = fp
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.fp.read(min(len(buffer), self.remaining))
+        self.remaining -= len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def file_crc(f):
+    crc = 0
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return crc
+        crc = zlib.crc32(chunk, crc)
+
+
+def zip_info_from_lstat(arcname, lstat, compress_type):
+    """
+    The ZipInfo that ZipFile.write() would have made, using the lstat record from the scan.
+    """
+    zip_info = zipfile.ZipInfo(os.path.normpath(arcname), time.localtime(lstat.st_mtime)[0:6])
+    zip_info.external_attr = (lstat.st_mode & 0xFFFF) << 16
+    zip_info.file_size = lstat.st_size
+    zip_info.compress_type = compress_type
+    return zip_info
+
+
+def open_source(filename, opener=None):
+    """
+    Open a file to add for reading, with 'opener' if given.
+    """
+    return opener(filename) if opener else open(filename, 'rb')
+
+
+def read_hashed(f):
+    """
+    Read the file object f into a spooled temporary file.
+    :return: (sha256 hex digest of the content, spooled file positioned at the start)
+    """
+    digest = hashlib.sha256()
+    spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        spool.write(chunk)
+    spool.seek(0)
+    return digest.hexdigest(), spool
+
+
+def plan_member(source, filename, zip_info, policy=None, previous=None):
+    """
+    Decide how to add filename from the file object 'source' opened for it: the compress type the
+    policy chooses and, if the file is unchanged in the previous archive, the previous ZipInfo.
+    The source is rewound afterwards.
+    :return: (compress type, previous ZipInfo or None)
+    """
+    compress_type = zip_info.compress_type
+    if policy:
+        compress_type = policy.compress_type(filename, compress_type, zip_info.file_size, source)
+        source.seek(0)
+    old = None
+    if previous:
+        candidate = copy.copy(zip_info)
+        candidate.compress_type = compress_type
+        old = previous.unchanged(filename, candidate, source)
+        source.seek(0)
+    return compress_type, old
+
+
+def compress_source(source, compress_type, cache=None):
+    """
+    Compress the file object 'source' with the compressor zipfile would have used for compress_type.
+    With a cz_member_cache.MemberCache the compressed data is taken from the cache if the content was
+    compressed before, and stored in it otherwise.
+    :return: (crc, file size, compressed size, file object reading the compressed data)
+    """
+    compressor = zipfile._get_compressor(compress_type)
+    key = None
+    if cache and compressor:
+        # the content is needed for the key before it is known if it needs compressing
+        digest, source = read_hashed(source)
+        key = cache.key(digest, compress_type)
+        hit = cache.get(key)
+        if hit:
+            source.close()
+            return hit
+    spool = tempfile.SpooledTemporaryFile(SPOOL_SIZE)
+    crc = 0
+    file_size = 0
+    with source if key else contextlib.nullcontext(source) as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            spool.write(compressor.compress(chunk) if compressor else chunk)
+    if compressor:
+        spool.write(compressor.flush())
+    compress_size = spool.tell()
+    if key:
+        spool.seek(0)
+        cache.put(key, crc, file_size, spool)
+    spool.seek(0)
+    return crc, file_size, compress_size, spool
+
+
+def compress_member(filename, zip_info, policy=None, previous=None, opener=None, cache=None):
+    """
+    Compress a file with the compressor zipfile would have used, or store it if the policy says so.
+    If the file is unchanged in the previous archive it is not compressed and the previous ZipInfo
+    is returned instead of the compressed data, see plan_member() and compress_source(). The file is
+    opened once with open_source() and everything read from it is read through that.
+    :return: (compress type, crc, file size, compressed size, spooled file with the compressed data, elapsed,
+              previous ZipInfo or None)
+    """
+    start = time.time()
+    with open_source(filename, opener) as source:
+        compress_type, old = plan_member(source, filename, zip_info, policy, previous)
+        if old:
+            return compress_type, old.CRC, old.file_size, old.compress_size, None, time.time() - start, old
+        crc, file_size, compress_size, data = compress_source(source, compress_type, cache)
+    return compress_type, crc, file_size, compress_size, data, time.time() - start, None
+
+
+def write_compressed(_zipfile, zip_info, crc, file_size, compress_size, data):
+    """
+    Append an already compressed member to an open ZipFile. This is what ZipFile.open(zip_info, 'w')
+    and closing the returned handle would have done, the sizes and crc are just known in advance.
+    """
+    # copied from ZipFile._open_to_write() and _ZipWriteFile.close(), which is why the private ZipFile
+    # attributes are used here and nowhere else
+    if _zipfile._writing:
+        raise ValueError('Can\'t write to the ZIP file while there is another write handle open on it')
+
+    zip_info.flag_bits = 0x00
+    if zip_info.compress_type == zipfile.ZIP_LZMA:
+        # compressed data includes an end-of-stream (EOS) marker
+        zip_info.flag_bits |= FLAG_COMPRESS_OPTION_1
+    if not _zipfile._seekable:
+        zip_info.flag_bits |= FLAG_DATA_DESCRIPTOR
+    if not zip_info.external_attr:
+        zip_info.external_attr = 0o600 << 16
+
+    zip64 = zip_info.file_size * 1.05 > zipfile.ZIP64_LIMIT
+    if not _zipfile._allowZip64 and zip64:
+        raise zipfile.LargeZipFile('Filesize would require ZIP64 extensions')
+    if not zip64 and (file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT):
+        raise RuntimeError(f'{zip_info.filename} changed size while compressing, too large without ZIP64')
+
+    if _zipfile._seekable:
+        _zipfile.fp.seek(_zipfile.start_dir)
+    zip_info.header_offset = _zipfile.fp.tell()
+    _zipfile._writecheck(zip_info)
+    _zipfile._didModify = True
+
+    zip_info.CRC = crc
+    zip_info.file_size = file_size
+    zip_info.compress_size = compress_size
+
+    _zipfile.fp.write(zip_info.FileHeader(zip64))
+    while True:
+        chunk = data.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        _zipfile.fp.write(chunk)
+    if zip_info.flag_bits & FLAG_DATA_DESCRIPTOR:
+        fmt = '<LLQQ' if zip64 else '<LLLL'
+        _zipfile.fp.write(struct.pack(fmt, zipfile._DD_SIGNATURE, crc, compress_size, file_size))
+    _zipfile.start_dir = _zipfile.fp.tell()
+
+    _zipfile.filelist.append(zip_info)
+    _zipfile.NameToInfo[zip_info.filename] = zip_info
+
+
+class ZipWriter:
+    """
+    Writes files and strings to an open ZipFile one at a time, the ZipFile.write() and
+    ZipFile.writestr() equivalents taking the ZipInfo made from the scan. Unchanged members
+    of the optional PreviousArchive and members in the optional MemberCache are copied rather
+    than compressed. Files are opened with open_source() and the optional 'opener'.
+    """
+    def __init__(self, _zipfile, policy=None, previous=None, opener=None, cache=None):
+        self.zipfile = _zipfile
+        self.policy = policy
+        self.previous = previous
+        self.opener = opener
+        self.cache = cache
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def write(self, filename, zip_info):
+        start = time.time()
+        with open_source(filename, self.opener) as src:
+            zip_info.compress_type, old = plan_member(src, filename, zip_info, self.policy, self.previous)
+            if old:
+                with self.previous.raw(old) as raw:
+                    write_compressed(self.zipfile, zip_info, old.CRC, old.file_size, old.compress_size, raw)
+            elif self.cache and zip_info.compress_type != zipfile.ZIP_STORED:
+                crc, file_size, compress_size, data = compress_source(src, zip_info.compress_type, self.cache)
+                with data:
+                    write_compressed(self.zipfile, zip_info, crc, file_size, compress_size, data)
+            else:
+                with self.zipfile.open(zip_info, 'w') as dest:
+                    shutil.copyfileobj(src, dest, 1024 * 8)
+        if self.policy:
+            self.policy.record(zip_info, time.time() - start, old is not None)
+
+    def writestr(self, zip_info, data):
+        self.zipfile.writestr(zip_info, data)
+
+
+class ParallelZipWriter(ZipWriter):
+    """
+    Writes files and strings to an open ZipFile in the order given while compressing the files in
+    a thread pool. At most 'window' members are pending at any time which bounds the memory and
+    temporary disk space used.
+    """
+    def __init__(self, _zipfile, workers, policy=None, window=None, previous=None, opener=None, cache=None):
+        super().__init__(_zipfile, policy, previous, opener, cache)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.window = window or workers * 4
+        self.pending = collections.deque()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            for _zip_info, item in self.pending:
+                if isinstance(item, concurrent.futures.Future):
+                    item.cancel()
+            self.executor.shutdown()
+
+    def write(self, filename, zip_info):
+        future = self.executor.submit(compress_member, filename, zip_info, self.policy, self.previous, self.opener,
+                                      self.cache)
+        self.pending.append((zip_info, future))
+        self.flush(self.window)
+
+    def writestr(self, zip_info, data):
+        self.pending.append((zip_info, data))
+        self.flush(self.window)
+
+    def flush(self, keep=0):
+        """
+        Write members in order until at most 'keep' are pending.
+        """
+        while len(self.pending) > keep:
+            zip_info, item = self.pending.popleft()
+            if isinstance(item, concurrent.futures.Future):
+                zip_info.compress_type, crc, file_size, compress_size, spool, elapsed, old = item.result()
+                if old:
+                    spool = self.previous.raw(old)
+                with spool:
+                    write_compressed(self.zipfile, zip_info, crc, file_size, compress_size, spool)
+                if self.policy:
+                    self.policy.record(zip_info, elapsed, old is not None)
+            else:
+                self.zipfile.writestr(zip_info, item)
+
+
+def zip_writer(_zipfile, workers=1, policy=None, previous=None, opener=None, cache=None):
+    if workers > 1:
+        return ParallelZipWriter(_zipfile, workers, policy, previous=previous, opener=opener, cache=cache)
+    return ZipWriter(_zipfile, policy, previous, opener, cache)
@@ -1,21 +1,24 @@
 # This is a minimal logging module without external dependencies as if that was a quality
 # in itself. Otherwise check out 'coloredlogs' which is the real thing.
 #
-import logging, sys
+import logging, sys, threading
 
-indent = ''
+# the indentation is per thread so concurrent jobs and scan workers don't indent each other
+local = threading.local()
+
+
+def get_indent():
+    return getattr(local, 'indent', '')
 
 
 class Indent():
     def __init__(self):
-        global indent
-        indent += '   '
+        local.indent = get_indent() + '   '
 
 
 class Unindent():
     def __init__(self):
-        global indent
-        indent = indent[:-3]
+        local.indent = get_indent()[:-3]
 
 
 GREY = '\033[0;37m'
@@ -28,8 +31,20 @@ LIGHT_BLUE = '\033[1;34m'
 REDINVERSE = '\033[1;37;41m'
 RESET = '\033[0m'
 
+
+class Formatter(logging.Formatter):
+    """
+    Ends each record with a newline unless it was logged with newline=False. The line end is part of the
+    record rather than the handler terminator so threads logging at the same time can't change each
+    other's line ends.
+    """
+    def format(self, record):
+        return super().format(record) + ('\n' if getattr(record, 'newline', True) else '')
+
+
 handler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter(f'{indent}%(levelname)s %(message)s{RESET}')
+handler.terminator = ''
+formatter = Formatter(f'%(levelname)s %(message)s{RESET}')
 handler.setFormatter(formatter)
 logger = logging.getLogger()
 logger.addHandler(handler)
@@ -51,24 +66,23 @@ def set_log_colors():
         logging.addLevelName(logging.CRITICAL, f'{logging.getLevelName(logging.CRITICAL):.3}')
 
 
+def debug_enabled():
+    """
+    True if deb() messages are logged. Used to skip building messages in the scan when they would be dropped anyway.
+    """
+    return logger.isEnabledFor(logging.DEBUG)
+
+
 def deb(msg, newline=True):
-    if not newline:
-        handler.terminator = ''
-    logger.debug('%s%s', indent, msg)
-    if not newline:
-        handler.terminator = '\n'
+    logger.debug('%s%s', get_indent(), msg, extra={'newline': newline})
 
 
 def inf(msg, newline=True):
-    if not newline:
-        handler.terminator = ''
-    logger.info('%s%s', indent, msg)
-    if not newline:
-        handler.terminator = '\n'
+    logger.info('%s%s', get_indent(), msg, extra={'newline': newline})
 
 
 def war(msg):
-    logger.warning('%s%s%s%s', REDINVERSE, indent, msg, RESET)
+    logger.warning('%s%s%s%s', REDINVERSE, get_indent(), msg, RESET)
 
 
 def err(msg):
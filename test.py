@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
-import json, os, inspect, sys, pathlib, shutil, traceback, filecmp, logging, subprocess
+import json, os, inspect, sys, pathlib, shutil, traceback, filecmp, logging, subprocess, tarfile, io
+import gzip, bz2, lzma, zipfile, stat, concurrent.futures
 import cargozhipsrc.cz_api as cz_api
-from cargozhipsrc.log import inf, war, err, LIGHT_BLUE, RESET, set_log_colors, logger as log
+import cargozhipsrc.cz as cz
+import cargozhipsrc.cz_tar as cz_tar
+import cargozhipsrc.cz_cache as cz_cache
+import cargozhipsrc.cz_zip as cz_zip
+import cargozhipsrc.cz_profile as cz_profile
+import cargozhipsrc.cz_copy as cz_copy
+import cargozhipsrc.cz_member_cache as cz_member_cache
+from cargozhipsrc.log import inf, war, err, LIGHT_BLUE, RESET, set_log_colors, logger as log, handler
 
 TESTOUTPUT = 'testoutput'
 
@@ -26,6 +34,14 @@ def delfilelist(names):
 def delpath(path):
     shutil.rmtree(path, ignore_errors=True)
 
+def fresh_path(name):
+    """
+    :return: the path 'name' under TESTOUTPUT, removed first so a test starts from scratch.
+    """
+    path = os.path.join(TESTOUTPUT, name)
+    delpath(path)
+    return path
+
 
 def run_test_configuration_test_sections():
     """
@@ -52,6 +68,253 @@ def run_test_configuration_test_sections():
             inf('')
 
 
+def run_parallel_scan_test_sections():
+    """
+    Scanning with a thread pool should give exactly the same result as the plain serial scan.
+    """
+    function_title()
+    config_name = 'test/cargozhip.json'
+    config = cz_api.load_config(config_name)
+    for section in config.keys():
+        if section.startswith('test_'):
+            serial = cz_api.scan('test', config, section)
+            parallel = cz_api.scan('test', config, section, scan_workers=4)
+            if serial.all_destinations() != parallel.all_destinations() or \
+                    serial.pattern_length != parallel.pattern_length or \
+                    (serial.stats.files_processed, serial.stats.dirs_processed) != \
+                    (parallel.stats.files_processed, parallel.stats.dirs_processed):
+                err(f'parallel scan differs for {section}')
+
+
+def run_targeted_scan_tests():
+    """
+    Going straight to the literal paths of the include rules should give the same result as walking the whole tree.
+    """
+    function_title()
+    config = cz_api.load_config('test/cargozhip.json')
+    config['targets'] = {'include_files': ['file', 'symlinks/folder_2', 'symlinks/folder_2/file_2', 'missing/file',
+                                           'folder_1/folder_1_1/file_1_1_1', 'folder_1/folder_1_2/*'],
+                         'include_dirs': ['folder_2']}
+    config['targets_excluded'] = {'include_files': ['folder_1/folder_1_1/file_1_1_1', 'symlinks/**'],
+                                  'exclude_dirs': ['folder_1']}
+    config['targets_root'] = {'include_files': ['file', 'folder_2/*', '*.json']}
+    for section in config.keys():
+        if section.startswith(('test_', 'targets')):
+            for workers in (1, 4):
+                targeted_filters = cz.parse_section(config, section)
+                filters = cz.parse_section(config, section)
+                filters.pruner.targets = None
+                targeted = cz.find_files('test', targeted_filters, workers)
+                walked = cz.find_files('test', filters, workers)
+                if list(targeted.entries()) != list(walked.entries()):
+                    err(f'targeted scan differs for {section} with {workers} workers')
+
+    if cz.parse_section(config, 'targets_root').pruner.targets is not None:
+        err('a rule matching at the root level should walk the whole tree')
+    scan_result = cz_api.scan('test', config, 'targets')
+    if scan_result.stats.files_processed != 6 or scan_result.stats.dirs_processed != 2:
+        err('targeted scan listed more than the targets')
+
+
+def run_symlink_loop_tests():
+    """
+    Symlinked directories pointing back up the tree should not be walked, and neither should a symlinked directory
+    added as a link when the rules add the same through the directory it points at. Every other one should.
+    """
+    function_title()
+    test_dest = fresh_path('symlink_loop_tests')
+    source = os.path.join(test_dest, 'source')
+    outside = os.path.join(test_dest, 'outside')
+    pathlib.Path(os.path.join(source, 'assets', 'textures')).mkdir(parents=True)
+    pathlib.Path(outside).mkdir()
+    open(os.path.join(source, 'assets', 'textures', 'texture'), 'a').close()
+    open(os.path.join(outside, 'shared'), 'a').close()
+    os.symlink('..', os.path.join(source, 'assets', 'up'))
+    os.symlink('textures', os.path.join(source, 'assets', 'sibling'))
+    os.symlink(os.path.join('..', 'outside'), os.path.join(source, 'outside'))
+    os.symlink('.', os.path.join(outside, 'loop'))
+
+    config = cz_api.minimal_config()
+    config['assets'] = {'include_files': ['assets/**', 'outside/**']}
+    # the loops are added as symlinks when a rule matches them, and so is the sibling since textures is walked
+    # with the same rules. The outside symlink points out of the tree and is walked.
+    expected = ['assets/sibling', 'assets/textures/texture', 'assets/up', 'outside', 'outside/loop', 'outside/shared']
+    for section in ('everything', 'assets'):
+        for workers in (1, 4):
+            scan_result = cz_api.scan(source, config, section, scan_workers=workers)
+            _expected = [name for name in expected if section == 'everything' or name != 'outside']
+            if sorted(scan_result.all_destinations()) != _expected:
+                err(f'symlink loops walked for {section} with {workers} workers')
+            if not all(scan_result.is_symlink(name) for name in ('assets/sibling', 'assets/up', 'outside/loop')):
+                err(f'symlink loops not added as symlinks for {section} with {workers} workers')
+    sections = cz.find_files_sections(source, [cz.parse_section(config, 'everything')])
+    if sorted(sections[0].all_destinations()) != expected:
+        err('symlink loops walked by a multi section scan')
+
+    # a symlinked directory is walked even if its real path is walked too when the rules could add something
+    # else through each of the paths, otherwise it is added as a link
+    source = os.path.join(test_dest, 'sibling')
+    pathlib.Path(os.path.join(source, 'folder_2')).mkdir(parents=True)
+    pathlib.Path(os.path.join(source, 'symlinks')).mkdir()
+    open(os.path.join(source, 'folder_2', 'file_2'), 'a').close()
+    open(os.path.join(source, 'folder_2', 'other'), 'a').close()
+    os.symlink(os.path.join('..', 'folder_2'), os.path.join(source, 'symlinks', 'folder_2'))
+    through_link = ['symlinks/folder_2', 'symlinks/folder_2/file_2', 'symlinks/folder_2/other']
+    config['partial'] = {'include_files': ['symlinks/**', 'folder_2/other']}
+    config['excluded'] = {'include_files': ['**'], 'exclude_files': ['folder_2/file_2']}
+    config['files'] = {'include_files': ['**/file_2']}
+    config['relocated'] = {'include_files': ['folder_2/*'], 'include_files_2': ['@@@dest', 'symlinks/**']}
+    config['linked'] = {'include_files': ['**'], 'exclude_dirs': ['**/cache']}
+    for section, _expected in (('linked', ['folder_2/file_2', 'folder_2/other', 'symlinks/folder_2']),
+                               ('partial', ['folder_2/other'] + through_link),
+                               ('excluded', ['folder_2/other'] + through_link),
+                               ('files', ['folder_2/file_2', 'symlinks/folder_2/file_2']),
+                               ('relocated', ['dest/folder_2', 'dest/folder_2/file_2', 'dest/folder_2/other',
+                                              'folder_2/file_2', 'folder_2/other'])):
+        for workers in (1, 4):
+            scan_result = cz_api.scan(source, config, section, scan_workers=workers)
+            if sorted(scan_result.all_destinations()) != _expected:
+                err(f'symlinked directory to a walked directory lost files for {section} with {workers} workers')
+            if section != 'files' and not scan_result.is_symlink('symlinks/folder_2'):
+                err(f'symlinked directory not added as a symlink for {section} with {workers} workers')
+    sections = cz.find_files_sections(source, [cz.parse_section(config, section) for section in ('linked', 'partial')])
+    if [len(scan_result.all_destinations()) for scan_result in sections] != [3, 4]:
+        err('symlinked directory to a walked directory differs in a multi section scan')
+
+    # the link unpacks to the directory it points at
+    archive = os.path.join(test_dest, 'linked')
+    cz_api.compress(source, config, 'linked', archive)
+    cz_api.decompress(archive + '.zip', os.path.join(test_dest, 'unpacked'))
+    compare_trees(source, os.path.join(test_dest, 'unpacked'))
+    delpath(test_dest)
+
+
+def run_scan_cache_tests():
+    """
+    A scan reusing the scan cache should give the same result as a full scan and notice changes.
+    """
+    function_title()
+    test_dest = fresh_path('scan_cache_tests')
+    source = os.path.join(test_dest, 'source')
+    cache_file = os.path.join(test_dest, 'scan_cache.json')
+    # copytree keeps the old directory mtimes so the directories are not too recent to be cached
+    shutil.copytree('test', source, symlinks=True)
+    config = cz_api.load_config('test/cargozhip.json')
+    for section in config.keys():
+        if section.startswith('test_'):
+            expected = cz_api.scan(source, config, section).all_destinations()
+            for _ in range(2):
+                filters = cz.parse_section(config, section)
+                cache = cz_cache.ScanCache(cache_file, source, filters)
+                scan_result = cz.find_files(source, filters, cache=cache)
+                cache.save()
+                if scan_result.all_destinations() != expected:
+                    err(f'scan with scan cache differs for {section}')
+            if not cache.hits:
+                err(f'scan cache not used for {section}')
+
+    cz_api.scan(source, config, 'test_204', scan_cache=cache_file)
+    with open(os.path.join(source, 'folder_1', 'new_file'), 'w') as f:
+        f.write('new')
+    scan_result = cz_api.scan(source, config, 'test_204', scan_cache=cache_file)
+    if 'folder_1/new_file' not in scan_result.all_destinations():
+        err('scan cache missed a new file')
+    delpath(test_dest)
+
+
+def run_multi_section_scan_tests():
+    """
+    Scanning all sections in one walk should give each section the same result as scanning it alone.
+    """
+    function_title()
+    config = cz_api.load_config('test/cargozhip.json')
+    sections = [section for section in config.keys() if section.startswith('test_')]
+    for workers in (1, 4):
+        scan_results = cz.find_files_sections('test', [cz.parse_section(config, section) for section in sections],
+                                              workers)
+        for section, scan_result in zip(sections, scan_results):
+            if scan_result.all_destinations() != cz_api.scan('test', config, section).all_destinations():
+                err(f'multi section scan differs for {section} with {workers} workers')
+
+
+def run_rule_profile_tests():
+    """
+    Profiling the rules should not change the scan result, and should find dead, shadowed and duplicated rules.
+    """
+    function_title()
+    config = cz_api.load_config('test/cargozhip.json')
+    for section in config.keys():
+        if section.startswith('test_'):
+            filters = cz.parse_section(config, section)
+            profile = cz_profile.RuleProfile(filters)
+            scan_result = cz.find_files('test', filters)
+            if scan_result.all_destinations() != cz_api.scan('test', config, section).all_destinations():
+                err(f'profiled scan differs for {section}')
+            # include_dirs rules are only tried once per directory
+            directories = {os.path.dirname(path) for path, _dest, _lstat, _is_dir in scan_result.entries()}
+            if sum(rule.hits for rule in profile.rules if rule.kind.startswith('include')) < len(directories):
+                err(f'profiled scan of {section} miscounted the hits')
+
+    config = {
+        'config': {'compression': 'zip'},
+        'base': {'include_files': ['**/file*', 'nothing_here'], 'exclude_dirs': ['!nothing_here']},
+        'other': {'inherit': ['base'], 'include_files': ['folder_1/*', 'folder_2/*']},
+        'profiled': {'inherit': ['base', 'other'], 'include_files': ['file']}
+    }
+    profile = cz_api.profile_rules('test', config, 'profiled', sort='order')
+    verdicts = {(rule.section, rule.describe()): rule.verdict() for rule in profile.rules if rule.index is not None}
+    if verdicts != {('profiled', 'file'): '', ('base', '**/file*'): '', ('base', 'nothing_here'): 'dead',
+                    ('other', 'folder_1/*'): '', ('other', 'folder_2/*'): 'shadowed',
+                    ('base', '!nothing_here'): 'dead'} or \
+            [(rule.kind, rule.rule, rule.duplicate_of) for rule in profile.rules if rule.verdict() == 'duplicate'] != \
+            [('include_files', (None, '**/file*'), 'base'), ('include_files', (None, 'nothing_here'), 'base'),
+             ('exclude_dirs', '!nothing_here', 'base')]:
+        err(f'rule profile got {verdicts}')
+    if [rule.evaluations for rule in profile.ranking('evaluations')] != \
+            sorted((rule.evaluations for rule in profile.rules), reverse=True):
+        err('rule profile not sorted')
+
+    # the exclude_dirs rules are tried by the pruner, on the directory and on its parent, each directory counts once
+    config['excluded'] = {'include_files': ['**'],
+                          'exclude_dirs': ['folder_1/folder_1_1', '!folder_1_2$', 'folder_1/*/folder_1_3_1']}
+    directories = len(list(os.walk('test', followlinks=True)))
+    profile = cz_api.profile_rules('test', config, 'excluded', sort='order')
+    if any(rule.evaluations > directories for rule in profile.rules if rule.kind == 'exclude_dirs') or \
+            [rule.hits for rule in profile.rules if rule.kind == 'exclude_dirs'] != [1, 1, 0]:
+        err('exclude_dirs rules counted more than once per directory')
+
+
+def run_trace_tests():
+    """
+    The scan trace should explain every file added and every file left out by a rule.
+    """
+    function_title()
+    test_dest = fresh_path('trace_tests')
+    os.makedirs(test_dest)
+    config = cz_api.load_config('test/cargozhip.json')
+    for section in config.keys():
+        if section.startswith('test_'):
+            trace_file = os.path.join(test_dest, f'{section}.json')
+            scan_result = cz_api.scan('test', config, section, trace_file=trace_file)
+            with open(trace_file) as f:
+                decisions = json.load(f)
+            added = sorted(decision['name'] for decision in decisions if decision.get('added'))
+            if added != sorted(_file for _file, _dest in scan_result.as_source_and_dest()):
+                err(f'trace of {section} differs from the scan result')
+            for decision in decisions:
+                if 'pruned' in decision:
+                    continue
+                if decision['added'] != (decision['included_by'] is not None and decision['excluded_by'] is None):
+                    err(f'trace of {section} can\'t explain {decision}')
+
+    traces_file = os.path.join(test_dest, 'sections.json')
+    cz_api.scan_sections('test', config, ['test_204', 'test_205'], trace_file=traces_file)
+    with open(traces_file) as f:
+        if list(json.load(f)) != ['test_204', 'test_205']:
+            err('multi section trace is missing sections')
+    delpath(test_dest)
+
+
 def run_test_configuration_exception_sections():
     """
     For now just verify that an exception is thrown
@@ -126,6 +389,19 @@ def run_failing_examples():
     except:
         pass
 
+    # and this neither, relocating both testfile and sub/testfile to the root makes a name collision
+    pathlib.Path('sub').mkdir()
+    open('sub/testfile', 'a').close()
+    config['collision'] = {'include_files': ['@', '**/testfile']}
+    archive = 'collision'
+    try:
+        cz_api.compress(root='.', config_or_file=config, section='collision', archive=archive)
+        err(archive)
+    except:
+        pass
+    if os.path.exists(archive + '.zip'):
+        err('name collision should be detected before writing the archive')
+
     os.chdir('../..')
 
 
@@ -148,18 +424,482 @@ config_file = (
 
 def run_decompressor_tests():
     function_title()
-    test_dest = os.path.join(TESTOUTPUT, 'decompressor_tests')
+    test_dest = fresh_path('decompressor_tests')
     test_output = os.path.join(TESTOUTPUT, 'decompressor_tests/output')
     config = cz_api.minimal_config()
-    cz_api.compress(root='test', config_or_file=config, section='everything', archive=os.path.join(test_dest, 'test'))
+    compressed = cz_api.compress(root='test', config_or_file=config, section='everything',
+                                 archive=os.path.join(test_dest, 'test'))
     compression = config['config']['compression']
     archivename = 'test.' + compression
-    cz_api.decompress(archive=os.path.join(test_dest, archivename), destpath=test_output)
+    stats = cz_api.decompress(archive=os.path.join(test_dest, archivename), destpath=test_output)
+    compare_decompress_stats(compressed, stats, os.path.join(test_dest, archivename))
     # compare the original with the decompressed
     _dircmp = filecmp.dircmp('test', test_output)
     if _dircmp.left_only or _dircmp.right_only:
         err(f'directories test and {test_output} differs')
 
+    # again on top of the first with parallel extraction, and the tar archives
+    cz_api.decompress(os.path.join(test_dest, archivename), test_output, force=True, workers=4)
+    compare_trees('test', test_output)
+    for compression in ('tar.gz', 'tar.bz2', 'tar.xz'):
+        compressed = cz_api.compress('test', config, 'everything', os.path.join(test_dest, 'test'),
+                                     compression=compression)
+        output = os.path.join(test_dest, compression)
+        stats = cz_api.decompress(os.path.join(test_dest, f'test.{compression}'), output)
+        compare_decompress_stats(compressed, stats, os.path.join(test_dest, f'test.{compression}'))
+        compare_trees('test', output)
+    delpath(test_dest)
+
+
+def compare_decompress_stats(compressed, decompressed, archive):
+    """
+    A decompress writes what the compress read, from an archive of the size the compress wrote.
+    """
+    if (decompressed.files_written, decompressed.symlinks_written, decompressed.bytes_out) != \
+            (compressed.files_written, compressed.symlinks_written, compressed.bytes_in):
+        err(f'decompress statistics of {archive} don\'t match the compress statistics')
+    if decompressed.bytes_in != os.path.getsize(archive) or decompressed.bytes_in != compressed.bytes_out:
+        err(f'decompress statistics of {archive} have the wrong archive size')
+
+
+def compare_trees(original, copy):
+    """
+    Verify that copy has the same files, content, modes and symlinks as original.
+    """
+    for path, dirs, files in os.walk(original):
+        for name in dirs + files:
+            source = os.path.join(path, name)
+            target = os.path.join(copy, os.path.relpath(source, original))
+            if os.path.islink(source):
+                if not os.path.islink(target) or os.readlink(source) != os.readlink(target):
+                    err(f'symlink {target} differs from {source}')
+            elif os.path.isfile(source):
+                if not filecmp.cmp(source, target, shallow=False) or \
+                        os.stat(source).st_mode != os.stat(target).st_mode:
+                    err(f'file {target} differs from {source}')
+
+
+def archive_members(archive):
+    """
+    :return: the members of a zip or tar archive by name, regardless of their order.
+    """
+    if tarfile.is_tarfile(archive):
+        with tarfile.open(archive) as _tarfile:
+            return {info.name: (info.get_info(), _tarfile.extractfile(info).read() if info.isreg() else None)
+                    for info in _tarfile}
+    with zipfile.ZipFile(archive) as _zipfile:
+        return {info.filename: (info.CRC, info.external_attr, _zipfile.read(info)) for info in _zipfile.infolist()}
+
+
+def compare_archives(expected, archive, message):
+    """
+    Verify that archive is the same as expected. Tar archives are compared by their members in order since
+    the block compressed ones differ in their compressed bytes, zip archives byte for byte.
+    """
+    if tarfile.is_tarfile(expected):
+        same = list(archive_members(expected).items()) == list(archive_members(archive).items())
+    else:
+        same = filecmp.cmp(expected, archive, shallow=False)
+    if not same:
+        err(message)
+
+
+def run_parallel_compression_tests():
+    """
+    Compressing the members in parallel should give exactly the same archives as the serial writer.
+    """
+    function_title()
+    test_dest = fresh_path('parallel_compression_tests')
+    config = cz_api.minimal_config()
+    for compression in ('zip', 'bz2', 'lzma', 'tar.gz', 'tar.bz2', 'tar.xz'):
+        serial = os.path.join(test_dest, 'serial')
+        parallel = os.path.join(test_dest, 'parallel')
+        cz_api.compress('test', config, 'everything', serial, compression=compression)
+        cz_api.compress('test', config, 'everything', parallel, compression=compression, compress_workers=4)
+        compare_archives(f'{serial}.{compression}', f'{parallel}.{compression}',
+                         f'parallel {compression} compression differs from the serial one')
+
+    # and force a lot of small blocks
+    data = os.urandom(100000)
+    for compress_method, decompress in (('w:gz', gzip.decompress), ('w:bz2', bz2.decompress),
+                                        ('w:xz', lzma.decompress)):
+        output = io.BytesIO()
+        with cz_tar.BlockCompressor(output, compress_method, 4, block_size=999) as compressor:
+            for offset in range(0, len(data), 333):
+                compressor.write(data[offset:offset + 333])
+        if decompress(output.getvalue()) != data:
+            err(f'block compression {compress_method} failed')
+
+    delpath(test_dest)
+
+
+def run_write_compressed_tests():
+    """
+    Appending an already compressed member should write the same bytes as zipfile writing it, to a file
+    and to a stream with data descriptors.
+    """
+    function_title()
+    data = b'compress me ' * 10000
+    for compress_type in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA):
+        for output_type in (io.BytesIO, NonSeekable):
+            outputs = []
+            for spliced in (False, True):
+                output = output_type()
+                zip_info = zipfile.ZipInfo('member', (2020, 1, 1, 0, 0, 0))
+                zip_info.compress_type = compress_type
+                zip_info.file_size = len(data)
+                with zipfile.ZipFile(output, 'w') as _zipfile:
+                    if spliced:
+                        member = cz_zip.compress_source(io.BytesIO(data), compress_type)
+                        cz_zip.write_compressed(_zipfile, zip_info, *member)
+                    else:
+                        with _zipfile.open(zip_info, 'w') as f:
+                            f.write(data)
+                outputs.append(output.getvalue() if output_type is io.BytesIO else output.output.getvalue())
+            if outputs[0] != outputs[1]:
+                err(f'compressed member {compress_type} written to {output_type.__name__} differs from zipfile')
+
+
+def run_multi_section_compression_tests():
+    """
+    The archives written side by side from one scan should be the same as when compressed one by one.
+    """
+    function_title()
+    test_dest = fresh_path('multi_section_compression_tests')
+    config = cz_api.load_config('test/cargozhip.json')
+    sections = ['test_204', 'test_205', 'test_440_copy_symlinks_with_dest']
+    spool_size = cz_zip.SPOOL_SIZE
+    try:
+        # also share files through temporary copies
+        for compression, workers, cz_zip.SPOOL_SIZE in (('zip', 1, spool_size), ('lzma', 4, 10), ('tar.gz', 1, 10)):
+            cz_api.compress_sections('test', config, sections, os.path.join(test_dest, 'multi'),
+                                     compression=compression, compress_workers=workers)
+            for section in sections:
+                single = os.path.join(test_dest, f'single_{section}')
+                cz_api.compress('test', config, section, single, compression=compression)
+                compare_archives(f'{single}.{compression}', os.path.join(test_dest, f'multi_{section}.{compression}'),
+                                 f'multi section {compression} archive differs for {section}')
+    finally:
+        cz_zip.SPOOL_SIZE = spool_size
+    delpath(test_dest)
+
+
+def run_shared_sources_tests():
+    """
+    Every read of a file by the archives written side by side should go through SharedSources and the
+    content kept for the other archives should stay under the limit.
+    """
+    function_title()
+    test_dest = fresh_path('shared_sources_tests')
+    config = cz_api.load_config('test/cargozhip.json')
+    sections = ['test_205', 'test_207_pruned_subtrees']
+    scan_results = [cz_api.scan('test', config, section) for section in sections]
+    names = [os.path.join('test', _file) for _file, _dest, lstat, _is_dir in scan_results[0].entries()
+             if stat.S_ISREG(lstat.st_mode) and lstat.st_size]
+    size = sum(os.path.getsize(name) for name in names)
+    # the second archive reads the files in the opposite order, so all are kept until it gets to them
+    for limit in (0, size // 2, size):
+        shared = cz_api.SharedSources('test', scan_results[:1] * 2, limit)
+        for name in names + names[::-1]:
+            with shared.open(name) as f, open(name, 'rb') as original:
+                if f.read() != original.read():
+                    err('shared source content differs')
+            if shared.kept > limit:
+                err(f'shared sources kept {shared.kept} bytes over the limit {limit}')
+        if shared.kept or shared.content:
+            err(f'shared sources not released with limit {limit}')
+        if shared.reads != {0: len(names) * 2, size: len(names)}.get(limit, shared.reads):
+            err(f'shared sources read {shared.reads} times with limit {limit}')
+
+    # the store detection and the crc check of an incremental build read the shared sources as well
+    config['config'].update({'store_detect': True})
+    archive = os.path.join(test_dest, 'multi')
+    for incremental in (False, True):
+        cz_api.compress_sections('test', config, sections, archive, compression='zip', incremental=incremental)
+    for section in sections:
+        single = os.path.join(test_dest, f'single_{section}')
+        cz_api.compress('test', config, section, single, compression='zip')
+        compare_archives(f'{single}.zip', f'{archive}_{section}.zip',
+                         f'incremental multi section archive with store detection differs for {section}')
+    delpath(test_dest)
+
+
+class NonSeekable(io.RawIOBase):
+    """
+    A write only stream such as a pipe.
+    """
+    def __init__(self):
+        self.output = io.BytesIO()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.output.write(data)
+
+
+def run_streaming_tests():
+    """
+    Archives written to a non seekable stream should have the same content as archives written to a file.
+    """
+    function_title()
+    test_dest = fresh_path('streaming_tests')
+    config = cz_api.minimal_config()
+    for compression in ('zip', 'lzma', 'tar.gz', 'tar.xz'):
+        archive = os.path.join(test_dest, 'archive')
+        cz_api.compress('test', config, 'everything', archive, compression=compression)
+        for workers in (1, 4):
+            stream = NonSeekable()
+            cz_api.compress('test', config, 'everything', stream, compression=compression, compress_workers=workers)
+            if compression.startswith('tar'):
+                streamed = os.path.join(test_dest, f'streamed.{compression}')
+                with open(streamed, 'wb') as f:
+                    f.write(stream.output.getvalue())
+                compare_archives(f'{archive}.{compression}', streamed,
+                                 f'streamed {compression} archive differs with {workers} workers')
+            else:
+                streamed = io.BytesIO(stream.output.getvalue())
+                with zipfile.ZipFile(f'{archive}.{compression}') as a, zipfile.ZipFile(streamed) as s:
+                    if s.testzip() or [(i.filename, i.CRC, i.external_attr) for i in a.infolist()] != \
+                            [(i.filename, i.CRC, i.external_attr) for i in s.infolist()]:
+                        err(f'streamed {compression} archive differs with {workers} workers')
+                    if not all(i.flag_bits & 0x08 for i in s.infolist() if not i.is_dir()):
+                        err(f'streamed {compression} archive without data descriptors')
+    delpath(test_dest)
+
+
+def run_concurrent_jobs_tests():
+    """
+    Compress jobs running concurrently in threads should not disturb each other.
+    """
+    function_title()
+    test_dest = fresh_path('concurrent_jobs_tests')
+    config = cz_api.load_config('test/cargozhip.json')
+    sections = [section for section in config.keys() if section.startswith('test_')]
+
+    def job(section, name, workers):
+        return cz_api.compress('test', config, section, os.path.join(test_dest, name), compression='zip',
+                               scan_workers=workers, compress_workers=workers)
+
+    expected = {section: job(section, f'serial_{section}', 1) for section in sections}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futures = {section: executor.submit(job, section, f'concurrent_{section}', 2) for section in sections}
+    for section in sections:
+        stats = futures[section].result()
+        if (stats.files_processed, stats.dirs_processed) != \
+                (expected[section].files_processed, expected[section].dirs_processed):
+            err(f'concurrent job {section} got other statistics')
+        compare_archives(os.path.join(test_dest, f'serial_{section}.zip'),
+                         os.path.join(test_dest, f'concurrent_{section}.zip'),
+                         f'concurrent job {section} made another archive')
+    delpath(test_dest)
+
+
+def run_concurrent_logging_tests():
+    """
+    Messages logged without a newline from one thread should not take the newline of another thread's message.
+    """
+    function_title()
+    stream = io.StringIO()
+    previous = handler.setStream(stream)
+    try:
+        def job(index):
+            for _ in range(100):
+                inf(f'<{index}', newline=False)
+                inf(f'{index}>')
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(job, range(8)))
+    finally:
+        handler.setStream(previous)
+    lines = stream.getvalue().split('\n')
+    if len(lines) != 8 * 100 + 1 or lines[-1] or handler.terminator:
+        err('log lines from several threads changed each other\'s line ends')
+
+
+def run_store_policy_tests():
+    """
+    Members with a listed extension or that hardly compress should be stored rather than compressed.
+    """
+    function_title()
+    test_dest = fresh_path('store_policy_tests')
+    source = os.path.join(test_dest, 'source')
+    pathlib.Path(source).mkdir(parents=True)
+    with open(os.path.join(source, 'text.txt'), 'w') as f:
+        f.write('compress me ' * 1000)
+    with open(os.path.join(source, 'random.bin'), 'wb') as f:
+        f.write(os.urandom(100000))
+    with open(os.path.join(source, 'image.PNG'), 'w') as f:
+        f.write('compressible but stored by extension ' * 1000)
+
+    config = cz_api.minimal_config()
+    config['config'].update({'compression': 'lzma', 'store_extensions': ['.png'], 'store_detect': True})
+    expected = {'text.txt': zipfile.ZIP_LZMA, 'random.bin': zipfile.ZIP_STORED, 'image.PNG': zipfile.ZIP_STORED}
+    archive = os.path.join(test_dest, 'archive')
+    cz_api.compress(source, config, 'everything', archive)
+    with zipfile.ZipFile(archive + '.lzma') as _zipfile:
+        if {info.filename: info.compress_type for info in _zipfile.infolist()} != expected:
+            err('store policy not applied')
+        if _zipfile.testzip():
+            err('store policy archive is broken')
+    delpath(test_dest)
+
+
+def run_incremental_tests():
+    """
+    An incremental rebuild should only compress new and changed files and give the same archive as a full rebuild.
+    """
+    function_title()
+    test_dest = fresh_path('incremental_tests')
+    source = os.path.join(test_dest, 'source')
+    shutil.copytree('test', source, symlinks=True)
+    changed = os.path.join(source, 'incremental.txt')
+    with open(changed, 'w') as f:
+        f.write('first version ' * 1000)
+
+    config = cz_api.minimal_config()
+    config['config'].update({'compression': 'zip', 'store_extensions': ['.png']})
+    archive = os.path.join(test_dest, 'archive')
+    cz_api.compress(source, config, 'everything', archive)
+
+    # same size and timestamp, only the crc tells it changed
+    lstat = os.lstat(changed)
+    with open(changed, 'w') as f:
+        f.write('other version ' * 1000)
+    os.utime(changed, ns=(lstat.st_atime_ns, lstat.st_mtime_ns))
+    with open(os.path.join(source, 'new.txt'), 'w') as f:
+        f.write('new file ' * 1000)
+
+    full = os.path.join(test_dest, 'full')
+    cz_api.compress(source, config, 'everything', full)
+    cz_api.compress(source, config, 'everything', archive, incremental=True)
+    compare_archives(full + '.zip', archive + '.zip', 'incremental rebuild differs from a full rebuild')
+    if os.path.exists(archive + '.zip.incremental'):
+        err('incremental rebuild left its temporary archive')
+
+    # a failing rebuild leaves the previous archive as it was and removes its temporary archive
+    scan_result = cz_api.scan(source, config, 'everything')
+    os.remove(changed)
+    with open(archive + '.zip', 'rb') as f:
+        before = f.read()
+    try:
+        cz_api.write_archive(source, scan_result, archive + '.zip', zipfile.ZIP_DEFLATED, incremental=True)
+        err('incremental rebuild of a missing file didn\'t fail')
+    except FileNotFoundError:
+        pass
+    if os.path.exists(archive + '.zip.incremental'):
+        err('failed incremental rebuild left its temporary archive')
+    with open(archive + '.zip', 'rb') as f:
+        if f.read() != before:
+            err('failed incremental rebuild changed the previous archive')
+    delpath(test_dest)
+
+
+def run_pipeline_tests():
+    """
+    Compressing while scanning should give the same members as scanning first, just in another order.
+    """
+    function_title()
+    test_dest = fresh_path('pipeline_tests')
+    config = cz_api.load_config('test/cargozhip.json')
+    for section in ('test_204', 'test_440_copy_symlinks_with_dest'):
+        for compression in ('zip', 'tar.gz'):
+            scanned = os.path.join(test_dest, 'scanned')
+            cz_api.compress('test', config, section, scanned, compression=compression)
+            expected = archive_members(f'{scanned}.{compression}')
+            for workers in (1, 4):
+                pipelined = os.path.join(test_dest, f'pipelined_{workers}')
+                stats = cz_api.compress('test', config, section, pipelined, compression=compression,
+                                        compress_workers=workers, pipeline=True)
+                if archive_members(f'{pipelined}.{compression}') != expected:
+                    err(f'pipelined {compression} archive differs for {section} with {workers} workers')
+                if stats.files_matched != len(expected) or not stats.dirs_processed:
+                    err(f'pipelined {compression} statistics are off for {section}')
+
+    # an incremental pipelined rebuild is the same as a full one
+    full = os.path.join(test_dest, 'full')
+    pipelined = os.path.join(test_dest, 'incremental')
+    cz_api.compress('test', config, 'test_204', full, compression='zip', pipeline=True)
+    cz_api.compress('test', config, 'test_204', pipelined, compression='zip', pipeline=True)
+    cz_api.compress('test', config, 'test_204', pipelined, compression='zip', pipeline=True, incremental=True)
+    compare_archives(f'{full}.zip', f'{pipelined}.zip', 'incremental pipelined rebuild differs from a full one')
+
+    # a name collision is only found while writing, the incomplete archive should be removed
+    source = os.path.join(test_dest, 'source')
+    pathlib.Path(os.path.join(source, 'sub')).mkdir(parents=True)
+    open(os.path.join(source, 'testfile'), 'a').close()
+    open(os.path.join(source, 'sub', 'testfile'), 'a').close()
+    config = cz_api.minimal_config()
+    config['collision'] = {'include_files': ['@', '**/testfile']}
+    archive = os.path.join(test_dest, 'collision')
+    try:
+        cz_api.compress(source, config, 'collision', archive, pipeline=True)
+        err('pipelined name collision not detected')
+    except Exception:
+        pass
+    if os.path.exists(archive + '.zip'):
+        err('pipelined name collision left an incomplete archive')
+    delpath(test_dest)
+
+
+def run_member_cache_tests():
+    """
+    Members taken from the member cache should give the same archive as compressing them, and the
+    cache should be trimmed to its size least recently used first.
+    """
+    function_title()
+    test_dest = fresh_path('member_cache_tests')
+    source = os.path.join(test_dest, 'source')
+    pathlib.Path(os.path.join(source, 'sub')).mkdir(parents=True)
+    for name, content in (('a.txt', 'first ' * 1000), ('b.txt', 'second ' * 1000), ('sub/a.txt', 'first ' * 1000),
+                          ('empty.txt', '')):
+        with open(os.path.join(source, name), 'w') as f:
+            f.write(content)
+    member_cache = os.path.join(test_dest, 'cache')
+
+    config = cz_api.minimal_config()
+    for compression in ('zip', 'lzma'):
+        full = os.path.join(test_dest, f'full_{compression}')
+        cz_api.compress(source, config, 'everything', full, compression=compression)
+        # the parallel writer takes the members stored by the serial one
+        for run, workers in (('cold', 1), ('warm', 4)):
+            archive = os.path.join(test_dest, f'cached_{compression}_{run}')
+            stats = cz_api.compress(source, config, 'everything', archive, compression=compression,
+                                    compress_workers=workers, member_cache=member_cache)
+            compare_archives(f'{full}.{compression}', f'{archive}.{compression}',
+                             f'{run} member cache {compression} archive differs')
+            if stats.member_cache_hits + stats.member_cache_misses != 4:
+                err(f'{run} member cache {compression} lookups are off')
+            if run == 'warm' and stats.member_cache_hits != 4:
+                err(f'warm member cache {compression} run compressed files again')
+        # members from the cache are written with data descriptors to a stream, also by the serial writer
+        streamed, cached = NonSeekable(), NonSeekable()
+        cz_api.compress(source, config, 'everything', streamed, compression=compression)
+        stats = cz_api.compress(source, config, 'everything', cached, compression=compression,
+                                member_cache=member_cache)
+        if stats.member_cache_hits != 4 or streamed.output.getvalue() != cached.output.getvalue():
+            err(f'streamed member cache {compression} archive differs')
+
+    # the tar archives are compressed as a whole and don't use the cache
+    stats = cz_api.compress(source, config, 'everything', os.path.join(test_dest, 'tar'), compression='tar.gz',
+                            member_cache=member_cache)
+    if stats.member_cache_hits or stats.member_cache_misses:
+        err('member cache used for a tar archive')
+
+    # 3 contents for 2 methods, a lookup makes an entry the most recently used
+    cache = cz_member_cache.MemberCache(member_cache)
+    if len(cache.entries()) != 6:
+        err('member cache has the wrong number of entries')
+    for _mtime, _size, path in cache.entries():
+        os.utime(path, ns=(0, 0))
+    key = cache.key(cz_zip.read_hashed(io.BytesIO(b'first ' * 1000))[0], zipfile.ZIP_DEFLATED)
+    cache.get(key)[3].close()
+    cache = cz_member_cache.MemberCache(member_cache, os.path.getsize(cache.path(key)))
+    cache.trim()
+    if [path for _mtime, _size, path in cache.entries()] != [cache.path(key)] or cache.evicted != 5:
+        err('member cache not trimmed least recently used first')
+    delpath(test_dest)
+
 
 def run_copy_without_archiving():
     function_title()
@@ -172,6 +912,84 @@ def run_copy_without_archiving():
         err(f'directories test and {TESTOUTPUT}/copy_test differs')
 
 
+def run_copy_strategy_tests():
+    """
+    Every copy strategy, falling back where the filesystem doesn't support it, should give the same copy.
+    """
+    function_title()
+    test_dest = fresh_path('copy_strategy_tests')
+    config = cz_api.load_config('test/cargozhip.json')
+    expected = os.path.join(test_dest, 'expected')
+    cz_api.copy('test', config, 'test_440_copy_symlinks_with_dest', expected, strategy='copy')
+    for strategy in cz_copy.STRATEGIES:
+        destination = os.path.join(test_dest, strategy)
+        stats = cz_api.copy('test', config, 'test_440_copy_symlinks_with_dest', destination, strategy=strategy)
+        copied = sorted(str(path.relative_to(destination)) for path in pathlib.Path(destination).rglob('*'))
+        if copied != sorted(str(path.relative_to(expected)) for path in pathlib.Path(expected).rglob('*')):
+            err(f'copy with {strategy} made other files')
+        for name in copied:
+            _copied, _expected = os.path.join(destination, name), os.path.join(expected, name)
+            if os.path.islink(_copied) != os.path.islink(_expected):
+                err(f'copy with {strategy} differs for {name}')
+            if os.path.isfile(_copied) and not os.path.islink(_copied):
+                if not filecmp.cmp(_copied, _expected, shallow=False) or \
+                        os.stat(_copied).st_mode != os.stat(_expected).st_mode:
+                    err(f'copy with {strategy} differs for {name}')
+        if stats.files_written + stats.symlinks_written != stats.files_matched or stats.bytes_in != stats.bytes_out:
+            err(f'copy with {strategy} statistics are off')
+        if strategy == 'hardlink' and stats.hardlinks and \
+                not os.path.samefile(os.path.join(destination, 'file'), os.path.join('test', 'file')):
+            err('hardlink copy made a new file')
+    try:
+        cz_copy.CopyEngine('teleport')
+        err('unknown copy strategy accepted')
+    except Exception:
+        pass
+    delpath(test_dest)
+
+
+def run_stats_tests():
+    """
+    The statistics returned should account for what was scanned and written.
+    """
+    function_title()
+    test_dest = fresh_path('stats_tests')
+    config = cz_api.minimal_config()
+    for compression in ('zip', 'tar.gz'):
+        archive = os.path.join(test_dest, 'archive')
+        stats = cz_api.compress('test', config, 'everything', archive, compression=compression)
+        scan_result = cz_api.scan('test', config, 'everything')
+        files = [_file for _file, _dest in scan_result.as_source_and_dest() if not scan_result.is_symlink(_file)]
+        if stats.files_matched != scan_result.nof_files or stats.files_written != len(files) or \
+                stats.files_written + stats.symlinks_written + stats.symlinks_skipped != scan_result.nof_files:
+            err(f'{compression} statistics miscounted the files')
+        if stats.bytes_in != sum(os.path.getsize(os.path.join('test', _file)) for _file in files) or \
+                stats.bytes_out != os.path.getsize(f'{archive}.{compression}'):
+            err(f'{compression} statistics miscounted the bytes')
+        times = (stats.walk_time, stats.match_time, stats.scan_time, stats.read_time, stats.write_time,
+                 stats.archive_time)
+        if not stats.dirs_processed or stats.pattern_evaluations < stats.files_processed or \
+                not all(time > 0 for time in times):
+            err(f'{compression} statistics are incomplete')
+
+    destination = os.path.join(test_dest, 'copy')
+    stats = cz_api.copy('test', config, 'everything', destination)
+    if stats.bytes_in != stats.bytes_out or not stats.copy_time or \
+            stats.files_written + stats.symlinks_written != stats.files_matched:
+        err('copy statistics are incomplete')
+
+    # the directory rules are looked up once for the directory, only the file rules for each file
+    textures = os.path.join(test_dest, 'source', 'textures')
+    pathlib.Path(textures).mkdir(parents=True)
+    for index in range(100):
+        open(os.path.join(textures, f'texture_{index}.png'), 'a').close()
+    config['textures'] = {'include_dirs': ['textures'], 'exclude_dirs': ['textures/cache']}
+    scan_result = cz_api.scan(os.path.join(test_dest, 'source'), config, 'textures')
+    if scan_result.nof_files != 100 or scan_result.stats.pattern_evaluations != 2 + 100 * 2:
+        err(f'scan made {scan_result.stats.pattern_evaluations} rule lookups for 100 files in one directory')
+    delpath(test_dest)
+
+
 def cmdline_test(title, arguments, expect=0):
     inf('')
     inf(f'   ------- {title} ------')
@@ -190,7 +1008,8 @@ def cmdline_compressor_test(compression):
 
 def run_command_line_compress():
     function_title()
-    delfilelist(['demo.zip', 'demo2.zip', 'demo3.zip'])
+    delfilelist(['demo.zip', 'demo2.zip', 'demo3.zip', 'demo4.zip', 'demo4.json', 'demo5_dev.zip', 'demo5_rel.zip',
+                 'demo6.zip', 'demo7.zip'])
 
     # the example from the readme. Config will be loaded from source 'demo' and archive will be 'demo.zip'
     cmdline_test("cmd test 100", "--compress demo --section dev")
@@ -201,8 +1020,29 @@ def run_command_line_compress():
     # finally explicitly set the config file to use
     cmdline_test("cmd test 100", "--compress demo --section dev --archive demo3 --config demo/cargozhip.json")
     isfile('demo3.zip')
+    # and scan with a thread pool
+    cmdline_test("cmd test 100", "--compress demo --section dev --archive demo4 --scan-workers 4 --stats demo4.json")
+    isfile('demo4.zip')
+    with open('demo4.json') as f:
+        if json.load(f)['bytes_out'] != os.path.getsize('demo4.zip'):
+            err('statistics written with --stats are wrong')
+    # and several sections from one scan
+    cmdline_test("cmd test 100", "--compress demo --section dev,rel --archive demo5")
+    isfile('demo5_dev.zip')
+    isfile('demo5_rel.zip')
+    cmdline_test("cmd test 100", "--compress demo --section dev,rel --archive demo5 --pipeline", 1)
+    # and to stdout
+    cmdline_test("cmd test 100", "--compress demo --section dev --archive - | cat > demo6.zip")
+    with zipfile.ZipFile('demo6.zip') as _zipfile:
+        if _zipfile.testzip() or not _zipfile.namelist():
+            err('archive streamed to stdout is broken')
+    # a failure while streaming to stdout keeps the error out of the archive
+    cmdline_test("cmd test 100", "--compress demo --section nosuchsection --archive - > demo7.zip", 1)
+    if os.path.getsize('demo7.zip'):
+        err('error text was written to the archive streamed to stdout')
 
-    delfilelist(['demo.zip', 'demo2.zip', 'demo3.zip'])
+    delfilelist(['demo.zip', 'demo2.zip', 'demo3.zip', 'demo4.zip', 'demo4.json', 'demo5_dev.zip', 'demo5_rel.zip',
+                 'demo6.zip', 'demo7.zip'])
 
 
 def run_command_line_decompress():
@@ -220,6 +1060,12 @@ def run_command_line_decompress():
     cmdline_test("cmd test 202 (should fail)", f"--archive {archive} --decompress {destination}", 1)
     # add a --force and it should run again
     cmdline_test("cmd test 203", f"--archive {archive}.zip --decompress {destination} --force")
+    # with the statistics of the decompress
+    cmdline_test("cmd test 204", f"--archive {archive}.zip --decompress {destination} --force --stats {archive}.json")
+    with open(f'{archive}.json') as f:
+        if not json.load(f)['files_written']:
+            err('statistics written with --stats for --decompress are wrong')
+    cmdline_test("cmd test 205 (should fail)", f"--profile demo --section dev --stats {archive}.json", 1)
 
     delpath(TESTOUTPUT)
 
@@ -234,6 +1080,23 @@ def run_command_line_copy():
 
     delpath('copytest')
 
+def run_benchmark_smoke_test():
+    """
+    Just verify that a tiny benchmark runs and writes its results.
+    """
+    function_title()
+    results_file = os.path.join(TESTOUTPUT, 'bench.json')
+    command = f'./bench.py --files 30 --repeat 1 --formats zip,tar.xz --workdir {TESTOUTPUT}/bench ' \
+              f'--output {results_file}'
+    if subprocess.call(command, shell=True):
+        err('benchmark failed')
+    with open(results_file) as f:
+        results = json.load(f)
+    for phase in ('walk', 'match', 'scan', 'compress_zip', 'decompress_zip', 'compress_tar.xz', 'copy'):
+        if phase not in results['phases']:
+            err(f'benchmark results without {phase}')
+
+
 def run_command_line_compressor_tests():
     function_title()
     pathlib.Path(TESTOUTPUT).mkdir(exist_ok=True)
@@ -250,19 +1113,40 @@ try:
 
     run_test_configuration_test_sections()
     run_test_configuration_exception_sections()
+    run_parallel_scan_test_sections()
+    run_targeted_scan_tests()
+    run_symlink_loop_tests()
+    run_scan_cache_tests()
+    run_multi_section_scan_tests()
+    run_rule_profile_tests()
+    run_trace_tests()
 
     # test native python api
     run_minimal_example()
     run_minimal_example_a_section_with_only_a_depends()
     run_failing_examples()
     run_decompressor_tests()
+    run_parallel_compression_tests()
+    run_write_compressed_tests()
+    run_multi_section_compression_tests()
+    run_shared_sources_tests()
+    run_streaming_tests()
+    run_concurrent_jobs_tests()
+    run_concurrent_logging_tests()
+    run_store_policy_tests()
+    run_incremental_tests()
+    run_pipeline_tests()
+    run_member_cache_tests()
     run_copy_without_archiving()
+    run_copy_strategy_tests()
+    run_stats_tests()
 
     # call cargozhip.py from commandline. Just verify that all invocations complete with an expected exit code
     run_command_line_compress()
     run_command_line_decompress()
     run_command_line_copy()
     run_command_line_compressor_tests()
+    run_benchmark_smoke_test()
 
     print('\n---------------')
     print(' Test pass')